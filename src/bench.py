@@ -0,0 +1,310 @@
+#!/bin/env python3
+
+import argparse
+import importlib.util
+import json
+import os
+import pathlib
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+# The hack script is no importable module (due to the dash in its name),
+# therefore it is loaded directly from its file.
+_spec = importlib.util.spec_from_file_location('hack_game', pathlib.Path(__file__).with_name('hack-game.py'))
+hack_game = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(hack_game)
+
+# The root of the repository. The hack script refers to its assets relative to it.
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+# The numbers of lines of the synthetic puzzle files, from a hand-written list
+# up to a whole scraped corpus
+PUZZLE_FILE_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+# The dataclasses of the custom hacks (see okto_patches-en/custom_hacks.py)
+CUSTOM_HACKS_HEADER = '''\
+import pathlib
+from dataclasses import dataclass
+
+@dataclass
+class ReplaceTilesHack:
+    msg:        str
+    image_path: pathlib.Path
+    addr_range: range
+
+@dataclass
+class ReplaceBytesHack:
+    msg:        str
+    new_bytes:  bytes
+    addr_range: range
+
+@dataclass
+class ReplaceSingleBytesHack:
+    msg:        str
+    new_bytes:  dict[int, int]
+
+@dataclass
+class ReplaceTblTextHack:
+    msg:        str
+    text:       str
+    addr_range: range
+
+'''
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'Benchmark the stages of the hack script on synthetic ROMs, puzzle files and images')
+
+    parser.add_argument(      '--sizes',       type=int, nargs='+', default=PUZZLE_FILE_SIZES,       help='the numbers of lines of the synthetic puzzle files to benchmark with')
+    parser.add_argument(      '--tile-sheets', type=int, nargs='+', default=[64, 128, 256],           help='the widths (and heights) in pixels of the synthetic tile sheets to benchmark with')
+    parser.add_argument(      '--hacks',       type=int,            default=100,                      help='the number of synthetic custom hacks to benchmark with')
+    parser.add_argument(      '--presets',     choices=hack_game.PRESETS, nargs='+', default=list(hack_game.PRESETS), help='the presets to generate synthetic ROMs for')
+    parser.add_argument(      '--repeat',      type=int,            default=3,                        help='the number of runs per benchmark (the fastest one is reported)')
+    parser.add_argument(      '--seed',        type=int,            default=0,                        help='the seed for generating the synthetic data')
+    parser.add_argument('-o', '--output',      type=pathlib.Path,                                     help='the file to write the results (JSON) to (default: stdout)')
+
+    return parser.parse_args()
+
+
+def synthetic_encoded_puzzles(count: int, rnd: random.Random) -> list[bytes]:
+    """
+    Generate 'count' encoded puzzles with random lengths like the real ones.
+    """
+    return [bytes(rnd.randrange(0x41, 0x5b) for _ in range(rnd.randint(3, 40))) for _ in range(count)]
+
+
+def synthetic_rom(preset: hack_game.Preset, rnd: random.Random) -> bytes:
+    """
+    Generate a ROM of random bytes that covers all address ranges of 'preset'.
+
+    Like a real ROM it consists of a 16 byte header and a power of two of
+    data. Its SHA-1 matches no known ROM, so the preset always has to be given
+    explicitly.
+    """
+    highest_addr = max(value.stop for value in vars(preset).values() if isinstance(value, range))
+    size = 16 + (1 << (highest_addr - 16).bit_length())
+    return rnd.randbytes(size)
+
+
+def synthetic_word(rnd: random.Random) -> str:
+    return ''.join(rnd.choice('ABCDEFGHIJKLMNOPRSTUW') for _ in range(rnd.randint(2, 6)))
+
+
+def write_synthetic_puzzle_file(path: pathlib.Path, lines: int, categories: int, rnd: random.Random) -> None:
+    """
+    Write a puzzle file with 'lines' lines, evenly split into 'categories' categories.
+
+    About every tenth puzzle is wrapped explicitly by “@”.
+    """
+    # With fewer lines than categories each line starts a category
+    lines_per_category = max(1, lines // categories)
+    with open(path, 'w') as f:
+        for line_no in range(lines):
+            if line_no % lines_per_category == 0 and line_no // lines_per_category < categories:
+                f.write(f'[CAT{line_no // lines_per_category}]\n')
+                continue
+            words = [synthetic_word(rnd) for _ in range(rnd.randint(1, 3))]
+            separator = '@' if rnd.random() < 0.1 else ' '
+            f.write(separator.join(words) + '\n')
+
+
+def write_synthetic_tile_sheet(path: pathlib.Path, size: int, rnd: random.Random) -> None:
+    """
+    Write an indexed image of 'size' x 'size' pixels with 4 colors.
+
+    The tiles are picked from a limited set of random tiles, so that there are
+    duplicates for the tilemap generation to find.
+    """
+    tile_pool = [rnd.randbytes(64) for _ in range(max(1, (size // 8) ** 2 // 4))]
+    image = Image.new('P', (size, size))
+    image.putpalette([0, 0, 0, 85, 85, 85, 170, 170, 170, 255, 255, 255])
+    for ty in range(size // 8):
+        for tx in range(size // 8):
+            tile = rnd.choice(tile_pool)
+            tile_image = Image.frombytes('P', (8, 8), bytes(b & 3 for b in tile))
+            image.paste(tile_image, (tx * 8, ty * 8))
+    image.save(path)
+
+
+def write_synthetic_custom_hacks(path: pathlib.Path, count: int, rom_size: int, image_path: pathlib.Path, image_bytes: int, rnd: random.Random) -> None:
+    """
+    Write a custom hacks script with 'count' hacks of all supported types to random ROM addresses.
+    """
+    hacks = []
+    for i in range(count):
+        addr = rnd.randrange(0x10, rom_size - max(64, image_bytes))
+        hack_type = i % 4
+        if hack_type == 0:
+            hacks.append(f'ReplaceBytesHack("bytes {i}", {rnd.randbytes(32)!r}, range({addr}, {addr + 32}))')
+        elif hack_type == 1:
+            new_bytes = {addr + offset: rnd.randrange(256) for offset in range(8)}
+            hacks.append(f'ReplaceSingleBytesHack("single bytes {i}", {new_bytes!r})')
+        elif hack_type == 2:
+            hacks.append(f'ReplaceTilesHack("tiles {i}", pathlib.Path({str(image_path)!r}), range({addr}, {addr + image_bytes}))')
+        else:
+            text = synthetic_word(rnd)
+            hacks.append(f'ReplaceTblTextHack("text {i}", {text!r}, range({addr}, {addr + len(text)}))')
+
+    with open(path, 'w') as f:
+        f.write(CUSTOM_HACKS_HEADER)
+        f.write('custom_hacks = [\n' + ''.join(f'    {hack},\n' for hack in hacks) + ']\n')
+
+
+def timed(func, repeat: int) -> float:
+    """
+    Run 'func' 'repeat' times and return the seconds of the fastest run.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def uncached(func):
+    """
+    Wrap 'func' to run without the results cached by previous runs.
+    """
+    def run():
+        hack_game.layout_puzzle.cache_clear()
+        hack_game.image_cache.clear()
+        return func()
+    return run
+
+
+def bench_reduce_to_bounds(size: int, rnd: random.Random, repeat: int) -> float:
+    # Select half of the puzzles into a budget that forces many swaps, but
+    # can still be met.
+    puzzles = synthetic_encoded_puzzles(size, rnd)
+    puzzle_count = size // 2
+    budget = sum(sorted(len(p) for p in puzzles)[:puzzle_count]) * 11 // 10
+
+    return timed(lambda: hack_game.reduce_to_bounds(puzzles, puzzle_count, budget), repeat)
+
+
+def bench_puzzles(puzzle_file: pathlib.Path, preset: hack_game.Preset, repeat: int) -> dict[str, float]:
+    """
+    Time the steps of importing the puzzles of the given file and the whole puzzles stage.
+    """
+    encode = hack_game.encode_classic_puzzle if preset.puzzle_hack_function == 'classic' else hack_game.encode_family_puzzle
+
+    categories = hack_game.read_puzzle_file(puzzle_file)
+    puzzles = [puzzle for category in categories for puzzle in category.puzzles]
+    sane_puzzles = hack_game.sanitize_puzzles(puzzles)
+    encoded_puzzles = [encode(puzzle) for puzzle in sane_puzzles]
+    while len(encoded_puzzles) < preset.no_of_puzzles:
+        encoded_puzzles.extend(encoded_puzzles)
+
+    return {
+        'read_puzzle_file': timed(lambda: hack_game.read_puzzle_file(puzzle_file), repeat),
+        'sanitize_puzzles': timed(uncached(lambda: hack_game.sanitize_puzzles(puzzles)), repeat),
+        'encode':           timed(lambda: [encode(puzzle) for puzzle in sane_puzzles], repeat),
+        'reduce_to_bounds': timed(lambda: hack_game.reduce_to_bounds(encoded_puzzles, preset.no_of_puzzles, len(preset.puzzle_addr_range)), repeat),
+        'stage_puzzles':    timed(uncached(lambda: hack_game.hack_puzzles(hack_game.PatchPlan(), categories)), repeat),
+        'sample_puzzle_file': timed(uncached(lambda: hack_game.sample_puzzle_file(puzzle_file, random.Random(0))), repeat),
+    }
+
+
+def bench_tile_sheet(image_path: pathlib.Path, repeat: int) -> dict[str, float]:
+    tiles = hack_game.image_to_nes(image_path)
+    return {
+        'image_to_nes':      timed(lambda: hack_game.image_to_nes(image_path), repeat),
+        'generate_tilemap2': timed(lambda: hack_game.generate_tilemap2(tiles), repeat),
+    }
+
+
+def bench_build(rom_file: pathlib.Path, rom: bytes, args: argparse.Namespace, repeat: int) -> dict[str, float]:
+    """
+    Time the custom hacks, a whole build and writing its output in each format.
+    """
+    hacks = hack_game.load_custom_hacks(args.custom_hacks)
+    results = {
+        'custom_hacks': timed(uncached(lambda: hack_game.apply_custom_hacks(hack_game.PatchPlan(), hacks)), repeat),
+        'build':        timed(uncached(lambda: hack_game.build_changes(rom, args)), repeat),
+    }
+
+    changes = hack_game.build_changes(rom, args)
+    for output_format in hack_game.OUTPUT_FORMATS:
+        outfile = rom_file.with_suffix('.' + output_format)
+        results['write_' + output_format] = timed(lambda: hack_game.write_output(rom, changes, outfile, output_format, True), repeat)
+    return results
+
+
+def run_benchmarks(args: argparse.Namespace, work_dir: pathlib.Path) -> list[dict]:
+    results = []
+
+    def record(benchmark: str, seconds: float, **params):
+        results.append({'benchmark': benchmark, **params, 'seconds': seconds})
+        print(f'{benchmark:<18} {" ".join(f"{key}={value}" for key, value in params.items()):<36} {seconds * 1000:10.2f} ms', file=sys.stderr)
+
+    for size in args.sizes:
+        record('reduce_to_bounds', bench_reduce_to_bounds(size, random.Random(args.seed), args.repeat), preset=None, size=size)
+
+    tile_sheets = {}
+    for size in args.tile_sheets:
+        image_path = work_dir / f'tiles-{size}.png'
+        write_synthetic_tile_sheet(image_path, size, random.Random(args.seed))
+        tile_sheets[size] = image_path
+        for benchmark, seconds in bench_tile_sheet(image_path, args.repeat).items():
+            record(benchmark, seconds, preset=None, size=size)
+
+    for preset_name in args.presets:
+        rnd = random.Random(args.seed)
+        preset = hack_game.PRESETS[preset_name]
+        hack_game.preset = preset
+
+        rom = synthetic_rom(preset, rnd)
+        rom_file = work_dir / f'{preset_name}.nes'
+        rom_file.write_bytes(rom)
+
+        puzzle_files = {}
+        for size in args.sizes:
+            puzzle_files[size] = work_dir / f'puzzles-{preset_name}-{size}'
+            write_synthetic_puzzle_file(puzzle_files[size], size, preset.no_of_categories, rnd)
+            for benchmark, seconds in bench_puzzles(puzzle_files[size], preset, args.repeat).items():
+                record(benchmark, seconds, preset=preset_name, size=size)
+
+        image_path = tile_sheets[min(tile_sheets)] if tile_sheets else None
+        image_bytes = len(hack_game.image_to_nes(image_path)) * 16 if image_path else 0
+        hacks_file = work_dir / f'custom_hacks-{preset_name}.py'
+        write_synthetic_custom_hacks(hacks_file, args.hacks if image_path else 0, len(rom), image_path, image_bytes, rnd)
+
+        build_args = hack_game.parse_arguments([str(rom_file), str(rom_file.with_suffix('.out')), '--preset', preset_name,
+                                                '--puzzles', str(puzzle_files[min(args.sizes)]), '--custom-hacks', str(hacks_file),
+                                                '--no-harm', '--timers', '99'])
+        for benchmark, seconds in bench_build(rom_file, rom, build_args, args.repeat).items():
+            record(benchmark, seconds, preset=preset_name, size=min(args.sizes))
+
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    os.chdir(REPO_DIR)
+    hack_game.log_level = hack_game.LOG_ERROR
+    hack_game.tbl = hack_game.tbl_codec(hack_game.TBL_FILE)
+    hack_game.chr_cache_dir = None
+
+    with tempfile.TemporaryDirectory(prefix='octowheel-bench-') as work_dir:
+        results = run_benchmarks(args, pathlib.Path(work_dir))
+
+    report = {
+        'python':  platform.python_version(),
+        'numpy':   hack_game.np is not None,
+        'repeat':  args.repeat,
+        'seed':    args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
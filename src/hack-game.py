@@ -2,16 +2,42 @@
 
 import argparse
 import ast
+import bisect
+import contextlib
 import copy
+import cProfile
+import heapq
+import itertools
+import json
+import mmap
+import os
 import pathlib
+import pstats
 import random
 import re
+import sqlite3
+import struct
 import sys
-
-from collections import OrderedDict
-from dataclasses import dataclass
-from hashlib     import sha1
-from PIL         import Image
+import time
+import tomllib
+import zlib
+
+from array               import array
+from collections         import OrderedDict
+from collections.abc     import Sequence
+from concurrent.futures  import ProcessPoolExecutor
+from dataclasses         import dataclass
+from functools           import cache, lru_cache
+from hashlib             import sha1
+from multiprocessing     import shared_memory
+from PIL                 import Image
+from urllib.parse        import parse_qs
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional. Without it images are converted by plain python.
+    np = None
 
 COL_RST = '\033[0m'
 COL_BLD = '\033[1m'
@@ -42,13 +68,116 @@ LOG_LEVELS = OrderedDict({
         'ERROR':   M_ERR,
         })
 LOG_LEVELS_ORDER = ['DEBUG', 'VERBOSE', 'INFO', 'WARN', 'ERROR']
-log_level = 2
+LOG_DEBUG, LOG_VERBOSE, LOG_INFO, LOG_WARN, LOG_ERROR = range(len(LOG_LEVELS_ORDER))
+LOG_FORMATS = ['text', 'json']
+log_level  = LOG_INFO
+log_format = 'text'
+log_stage  = None  # the stage currently run, added to all log records
 
 
 PATTERN_CATEGORY_LINE = re.compile("\s*\[([a-zA-Z0-9 '$?-]+)\]\s*")
 
 TBL_FILE = "assets/wheel.tbl"
 
+PATTERN_NON_ZERO_BYTES = re.compile(b'[^\\x00]+')
+
+OUTPUT_FORMATS  = ['nes', 'ips', 'bps']
+IPS_MAGIC       = b'PATCH'
+IPS_EOF         = b'EOF'
+IPS_EOF_OFFSET  = int.from_bytes(IPS_EOF, 'big')
+IPS_MAX_OFFSET  = 0xffffff
+BPS_MAGIC       = b'BPS1'
+BPS_SOURCE_READ = 0
+BPS_TARGET_READ = 1
+BPS_SOURCE_COPY = 2
+BPS_TARGET_COPY = 3
+
+# The rows of the puzzle board (as indexes into 'Preset.length_of_puzzles')
+# that are used by a puzzle with the given number of lines.
+PUZZLE_BOARD_ROWS = {
+    1: (1,),
+    2: (1, 2),
+    3: (0, 1, 2),
+    4: (0, 1, 2, 3),
+}
+
+# The layouts tried by 'layout_puzzle' (in this order) as the number of lines
+# of a puzzle and the rows of these lines that hold its words. The other
+# lines are filled with spaces, e.g. to put a 3-line puzzle whose first line
+# is too long for row 0 into rows 1 to 3.
+PUZZLE_LAYOUTS = [
+    (1, (1,)),
+    (2, (1, 2)),
+    (3, (0, 1, 2)),
+    (4, (1, 2, 3)),
+    (4, (0, 1, 2, 3)),
+]
+
+# Converted images are cached on disk, keyed by the content of the image file.
+# The version needs to be increased whenever the result of 'image_to_nes' or
+# 'generate_tilemap2' changes to invalidate all existing cache entries.
+CHR_CACHE_DIR      = pathlib.Path(os.environ.get('XDG_CACHE_HOME', '~/.cache')).expanduser() / 'octowheel' / 'chr'
+CHR_CACHE_MAX_SIZE = 64 * 1024 * 1024
+CHR_CACHE_MAGIC    = b'OWCHR'
+CHR_CACHE_VERSION  = 1
+
+# Incremental builds record the inputs and patches of each stage in a file next
+# to the outfile. The version needs to be increased whenever its structure
+# changes.
+STAGE_MANIFEST_SUFFIX  = '.stages.json'
+STAGE_MANIFEST_VERSION = 2
+
+# Puzzle databases (see 'import_puzzle_files') are SQLite files. The version
+# needs to be increased whenever the schema or the stored layouts change.
+SQLITE_MAGIC       = b'SQLite format 3\x00'
+PUZZLE_DB_VERSION  = 1
+PUZZLE_DB_SCHEMA   = '''
+    CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS puzzles (
+        id             INTEGER PRIMARY KEY,
+        category       TEXT    NOT NULL,
+        text           TEXT    NOT NULL,  -- as in the puzzle file (upper case, maybe with “@”)
+        layout         TEXT,              -- the wrapped puzzle, NULL if it does not fit
+        family_length  INTEGER,           -- the length of the encoded puzzle in the family edition
+        classic_length INTEGER,           -- the length of the encoded puzzle in the classic edition
+        source         TEXT    NOT NULL,
+        UNIQUE (category, text)
+    );
+    CREATE TABLE IF NOT EXISTS tags (
+        puzzle_id INTEGER NOT NULL REFERENCES puzzles(id),
+        tag       TEXT    NOT NULL,
+        PRIMARY KEY (tag, puzzle_id)
+    );
+    CREATE INDEX IF NOT EXISTS puzzles_by_family_length  ON puzzles (category, family_length);
+    CREATE INDEX IF NOT EXISTS puzzles_by_classic_length ON puzzles (category, classic_length);
+'''
+
+# Compiled puzzle corpora (see 'compile_puzzles') consist of a header, a table
+# of the categories and their puzzle ranges, an offset index for the encoded
+# puzzles of each edition and the encoded puzzles themselves. The version needs
+# to be increased whenever the format or the puzzle encoding changes.
+PUZZLE_CORPUS_MAGIC    = b'OWPZ'
+PUZZLE_CORPUS_VERSION  = 1
+PUZZLE_CORPUS_HEADER   = struct.Struct('<4sH4BHI')  # magic, version, line lengths, number of categories, number of puzzles
+PUZZLE_CORPUS_CATEGORY = struct.Struct('<16sII')    # name (UTF-8), index of the first puzzle, number of puzzles
+
+# The number of puzzles to keep per puzzle slot of the ROM with “--sample-puzzles”.
+# The surplus replaces puzzles that exceed the puzzle area (see 'reduce_to_bounds').
+PUZZLE_SAMPLE_FACTOR = 2
+
+# The options of the command line that are no options of the variants of a manifest
+MANIFEST_EXCLUDED_OPTIONS = {'manifest', 'jobs'}
+
+# The options of the command line that apply to all variants of a manifest
+# (unless the manifest sets them itself)
+MANIFEST_CMD_OPTIONS = ['seed', 'loglevel', 'log-format', 'no-cache']
+
+# The number of functions to show for “--profile”
+PROFILE_TOP_FUNCTIONS = 30
+
 WEDGE_VALUES= {
     100:         0xac,
     150:         0x2c,
@@ -79,6 +208,26 @@ WEDGE_VALUES= {
     'bankrupt':  0xb8,
 }
 
+def parse_puzzle_quota(arg: str) -> tuple[str, int, int]:
+    """
+    Parse a puzzle quota of the form “CATEGORY=MIN:MAX” (MIN or MAX may be
+    left empty) into a tuple of the (upper case) category, MIN and MAX (None
+    if empty).
+    """
+    category, _, quota = arg.partition('=')
+    minimum, colon, maximum = quota.partition(':')
+    try:
+        minimum = int(minimum) if minimum else None
+        maximum = int(maximum) if maximum else None
+    except ValueError:
+        minimum = maximum = -1
+    if not category or not colon or (minimum is not None and minimum < 0) or (maximum is not None and maximum < 0):
+        raise argparse.ArgumentTypeError(f'Must be of the form CATEGORY=MIN:MAX, e.g. PLACE=50:200 or PLACE=:100, not “{arg}”')
+    if minimum is not None and maximum is not None and minimum > maximum:
+        raise argparse.ArgumentTypeError(f'The minimum of “{arg}” exceeds its maximum')
+    return (category.upper(), minimum, maximum)
+
+
 # Taken from https://stackoverflow.com/a/61411431
 class IntRange:
     def __init__(self, imin=None, imax=None):
@@ -138,6 +287,13 @@ class CategoryWithPuzzles:
     puzzles:       list[Puzzle]
 
 
+@dataclass(frozen=True)
+class ConvertedImage:
+    tiles:        list[bytes]  # all tiles of the image, see 'image_to_nes'
+    unique_tiles: list[bytes]  # the tiles without duplicates, see 'generate_tilemap2'
+    tilemap:      list[int]    # the index into 'unique_tiles' for each tile
+
+
 @dataclass(frozen=False)
 class Preset:
     category_addr_range:           range
@@ -260,15 +416,26 @@ ROM_PRESETS = {
 
 cmd_args = argparse.Namespace()
 preset = None
+image_cache = {}          # image path -> converted image, see 'load_image'
+chr_cache_dir = CHR_CACHE_DIR  # None if the on-disk cache is disabled
+shared_rom_memory = None  # the shared memory containing the base ROM in a worker process
+shared_rom        = None  # the base ROM in 'shared_rom_memory'
+tracer = None             # the 'Tracer' collecting the spans of the build, None if tracing is disabled
 
 
-def parse_arguments() -> None:
+def argument_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description = 'Convert videos via ffmpeg')
 
-    parser.add_argument('romfile',                                 type=pathlib.Path,    help='the ROM file to operate on')
-    parser.add_argument('outfile',                                 type=pathlib.Path,    help='the ROM file to write to')
+    parser.add_argument('romfile',               nargs='?',        type=pathlib.Path,    help='the ROM file to operate on')
+    parser.add_argument('outfile',               nargs='?',        type=pathlib.Path,    help='the ROM file to write to')
+    parser.add_argument(      '--manifest',                        type=pathlib.Path,    help='a TOML file describing several variants to build from the same ROM (replaces romfile and outfile)')
+    parser.add_argument('-j', '--jobs',                            type=IntRange(1),     help='the number of processes to build the variants of a manifest with (default: 1)')
+    parser.add_argument(      '--seed',                            type=int,             help='the seed for the random choice of puzzles and player names (makes builds reproducible, default: a random seed that is logged)')
     parser.add_argument(      '--preset', choices=PRESETS,         type=str,             help='the preset to use for the ROM addresses (if it could not be autodetected)')
-    parser.add_argument('-z', '--puzzles',                         type=pathlib.Path,    help='the file containing the puzzles to use for the hack')
+    parser.add_argument('-z', '--puzzles',                         type=pathlib.Path,    help='the file containing the puzzles to use for the hack, a compiled puzzle corpus, or a puzzle database with an optional query, e.g. “corpus.db?category=PLACE,THING&max_length=20&tag=octonauts&limit=5000”')
+    parser.add_argument(      '--sample-puzzles',                  action='store_true',  help='stream the puzzle file and only keep a random sample of as many puzzles as the ROM can hold (for huge puzzle files)')
+    parser.add_argument(      '--optimize-puzzles',                action='store_true',  help='select the puzzles of the family edition by the quotas of “--puzzle-quota” to get as many distinct puzzles as fit into the ROM (default quota: half an even share of the slots per category)')
+    parser.add_argument(      '--puzzle-quota', action='append',   type=parse_puzzle_quota, help='the minimum and maximum number of puzzles of a category for “--optimize-puzzles” (implies it), e.g. “PLACE=50:200” (may be given several times)')
     parser.add_argument('-p', '--players',                         type=pathlib.Path,    help='the file containing the computer player names to use for the hack')
     parser.add_argument(      '--custom-hacks',                    type=pathlib.Path,    help='the (python) file containing the additional custom hacks')
 
@@ -292,13 +459,64 @@ def parse_arguments() -> None:
     parser.add_argument(      '--palette-wall-floor',              type=str,             help='Palette (3 colors) to use for the letter wall floor tiles, e.g: (0x01, 0x2a, 0x3c')
     parser.add_argument(      '--bg-color-wall',                   type=IntRange(0x00,0x3f),  help='Backdrop color of the screen with the letter wall')
 
+    parser.add_argument(      '--no-cache',                        action='store_true',  help=f'do not use the cache of converted images (in {CHR_CACHE_DIR})')
+    parser.add_argument(      '--format', choices=OUTPUT_FORMATS, default='nes', type=str, help='the format of the outfile: the hacked ROM (nes) or an IPS/BPS patch for the original ROM (default: nes)')
+    parser.add_argument(      '--incremental',                     action='store_true',  help=f'reuse the patches of all stages whose inputs did not change since the last build (recorded in <outfile>{STAGE_MANIFEST_SUFFIX})')
+    parser.add_argument(      '--stats',                           action='store_true',  help='print the patches and durations of each stage and whether it was skipped')
+    parser.add_argument(      '--trace',                           type=pathlib.Path,    help='write the durations of all stages and custom hacks to the given file in Chrome trace format (for chrome://tracing or Perfetto)')
+    parser.add_argument(      '--profile',                         action='store_true',  help=f'run the build under cProfile and print the {PROFILE_TOP_FUNCTIONS} functions with the highest cumulative time (of the main process only)')
     parser.add_argument('-f', '--force',                           action='store_true',  help='force overwriting an existing target file')
     parser.add_argument('-g', '--loglevel', choices=LOG_LEVELS,    type=str,             help='log level to use') # FIXME: Should be choice
+    parser.add_argument(      '--log-format', choices=LOG_FORMATS, default='text', type=str, help='the format of the log: colored text or one JSON object per line (default: text)')
 
-    args = parser.parse_args()
+    parser.epilog = f'Use “{sys.argv[0]} apply --help” for applying IPS/BPS patches “{sys.argv[0]} import-puzzles --help” for creating puzzle databases and “{sys.argv[0]} compile-puzzles --help” for compiling puzzle corpora.'
+
+    return parser
+
+
+def parse_arguments(argv: list[str] = None) -> argparse.Namespace:
+    parser = argument_parser()
+    args = parser.parse_args(argv)
+    if not args.manifest and (args.romfile is None or args.outfile is None):
+        parser.error('the romfile and outfile are required unless “--manifest” is given')
     return args
 
 
+def parse_apply_arguments(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog = f'{sys.argv[0]} apply', description = 'Apply an IPS or BPS patch to a ROM')
+
+    parser.add_argument('patchfile',                               type=pathlib.Path,    help='the IPS or BPS patch to apply')
+    parser.add_argument('romfile',                                 type=pathlib.Path,    help='the ROM file to apply the patch to')
+    parser.add_argument('outfile',                                 type=pathlib.Path,    help='the ROM file to write to')
+    parser.add_argument('-f', '--force',                           action='store_true',  help='force overwriting an existing target file')
+
+    return parser.parse_args(argv)
+
+
+def parse_import_arguments(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog = f'{sys.argv[0]} import-puzzles', description = 'Import puzzle files into a puzzle database')
+
+    parser.add_argument('database',                                type=pathlib.Path,    help='the puzzle database to import into (created if it does not exist)')
+    parser.add_argument('puzzlefiles',           nargs='+',        type=pathlib.Path,    help='the puzzle files (e.g. written by scrape.py) to import')
+    parser.add_argument('-t', '--tag',           action='append',  default=[],           help='a tag to add to all imported puzzles (may be given several times)')
+    parser.add_argument(      '--preset', choices=PRESETS,         default='family',     help='the preset whose puzzle line lengths are used for the layouts (default: family)')
+    parser.add_argument('-g', '--loglevel', choices=LOG_LEVELS,    type=str,             help='log level to use')
+
+    return parser.parse_args(argv)
+
+
+def parse_compile_arguments(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog = f'{sys.argv[0]} compile-puzzles', description = 'Compile puzzles into a pre-encoded puzzle corpus')
+
+    parser.add_argument('puzzles',                                 type=pathlib.Path,    help='the puzzle file or puzzle database (with an optional query) to compile')
+    parser.add_argument('outfile',                                 type=pathlib.Path,    help='the compiled puzzle corpus to write')
+    parser.add_argument(      '--preset', choices=PRESETS,         default='family',     help='the preset whose puzzle line lengths are used for the layouts (default: family)')
+    parser.add_argument('-f', '--force',                           action='store_true',  help='force overwriting an existing target file')
+    parser.add_argument('-g', '--loglevel', choices=LOG_LEVELS,    type=str,             help='log level to use')
+
+    return parser.parse_args(argv)
+
+
 def autodetect_preset(rom: bytes) -> Preset:
     # FIXME: First evaluate cmdline param 'preset'. raise exc if not found
 
@@ -309,41 +527,374 @@ def autodetect_preset(rom: bytes) -> Preset:
     raise LookupError(f'No preset found for ROM with hash {hash}. Please provide explicit preset to use with the “--preset” parameter.')
 
 
-def log(lvl: str, *args):
-    if log_level <= LOG_LEVELS_ORDER.index(lvl):
-        col = LOG_LEVELS[lvl]
+def log(lvl: int, args: tuple, fields: dict) -> None:
+    """
+    Write a log record. The level must already have been checked by the caller.
+
+    The 'args' are only converted to strings here, so that filtered records
+    cost no formatting. Callers should therefore pass the parts of a message
+    as separate 'args' instead of formatting it themselves. The current
+    stage and the 'fields' (e.g. the number of patches of a stage) only
+    become members of JSON records, text records consist of the 'args'.
+    """
+    if log_format == 'json':
+        if log_stage is not None:
+            fields = {'stage': log_stage} | fields
+        record = {'time': time.time(), 'level': LOG_LEVELS_ORDER[lvl], 'message': ' '.join(str(arg) for arg in args)} | fields
+        print(json.dumps(record, default=str), flush=True)
+    else:
+        col = LOG_LEVELS[LOG_LEVELS_ORDER[lvl]]
         print(col, *args, COL_RST)
-def log_dbg(*args):
-    log('DEBUG', *args)
-def log_vbs(*args):
-    log('VERBOSE', *args)
-def log_nfo(*args):
-    log('INFO', *args)
-def log_wrn(*args):
-    log('WARN', *args)
-def log_err(*args):
-    log('ERROR', *args)
+def log_dbg(*args, **fields):
+    if log_level <= LOG_DEBUG:
+        log(LOG_DEBUG, args, fields)
+def log_vbs(*args, **fields):
+    if log_level <= LOG_VERBOSE:
+        log(LOG_VERBOSE, args, fields)
+def log_nfo(*args, **fields):
+    if log_level <= LOG_INFO:
+        log(LOG_INFO, args, fields)
+def log_wrn(*args, **fields):
+    if log_level <= LOG_WARN:
+        log(LOG_WARN, args, fields)
+def log_err(*args, **fields):
+    if log_level <= LOG_ERROR:
+        log(LOG_ERROR, args, fields)
+
+class Tracer:
+    """
+    Collects the spans of a build as Chrome trace events.
+
+    The written file can be opened offline with chrome://tracing or
+    https://ui.perfetto.dev.
+    """
+    def __init__(self):
+        self.events = []
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter_ns() - start
+            self.events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': start / 1000, 'dur': duration / 1000,
+                                'pid': os.getpid(), 'tid': os.getpid(), 'args': args})
+
+    def write(self, trace_file: pathlib.Path) -> None:
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+NO_SPAN = contextlib.nullcontext()
+
+
+def trace_span(name: str, category: str, **args):
+    """
+    Get a context manager recording a span with the given name if tracing is enabled.
+
+    Without tracing the same no-op context manager is returned every time.
+    """
+    if tracer is None:
+        return NO_SPAN
+    return tracer.span(name, category, **args)
+
+
+def read_rom_from_file(romfile: str) -> mmap.mmap:
+    """
+    Map the given ROM file read-only into memory.
+
+    The map can be sliced and hashed like 'bytes', but nothing is copied
+    until it is accessed. All variants of a build share the same map. It
+    should be closed (e.g. by a 'with' block) once the output is written.
+    """
+    with open(romfile, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f'ROM file {romfile} is empty.')
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 
-def read_rom_from_file(romfile: str) -> bytes:
-    rom = open(romfile, 'rb').read()
-    return rom
+def write_rom_to_file(rom: bytes, outfile: pathlib.Path, force: bool = False, changes: list[tuple[int, bytes]] = ()):
+    """
+    Write 'rom' with the given changed runs (offset and data) applied to 'outfile'.
 
+    The original ROM is written in one go, then only the changed runs are
+    written over it. No patched copy of the ROM is created in memory.
 
-def write_rom_to_file(rom: bytes, outfile: pathlib.Path, force: bool = False):
+    The file is written under a temporary name and then moved into place.
+    Thereby 'outfile' may be the ROM file that 'rom' is mapped from.
+    """
     if outfile.is_file() and not force:
-        log_err(f'Target file {outfile} already exists. Cowardly refusing to overwrite unless “--force” is specified')
+        log_err('Target file', outfile, 'already exists. Cowardly refusing to overwrite unless “--force” is specified')
         sys.exit(1)
 
-    with open(outfile, 'wb') as outfile:
-        outfile.write(rom)
+    tmp_file = outfile.with_name(outfile.name + '.tmp')
+    with open(tmp_file, 'wb') as f:
+        f.write(rom)
+        for offset, data in changes:
+            f.seek(offset)
+            f.write(data)
+    os.replace(tmp_file, outfile)
+
+
+def write_output(rom: bytes, changes: list[tuple[int, bytes]], outfile: pathlib.Path, output_format: str = 'nes', force: bool = False) -> None:
+    """
+    Write the hacked ROM or a patch for 'rom' in the given format ('nes', 'ips' or 'bps').
+
+    The hacked ROM is given by the runs (offset and data) that differ from 'rom'.
+    """
+    with trace_span('write_output', 'io', format=output_format):
+        if output_format == 'nes':
+            write_rom_to_file(rom, outfile, force, changes)
+            return
+
+        new_rom = bytearray(rom)
+        for offset, data in changes:
+            new_rom[offset:offset+len(data)] = data
+        if output_format == 'ips':
+            write_rom_to_file(make_ips_patch(rom, new_rom), outfile, force)
+        else:
+            write_rom_to_file(make_bps_patch(rom, new_rom), outfile, force)
+
+
+def diff_runs(old: bytes, new: bytes, max_gap: int = 0) -> list[tuple[int, int]]:
+    """
+    Find the ranges in which 'old' and 'new' differ.
+
+    The buffers are compared blockwise via memoryviews. Only blocks that
+    differ are XORed and searched for non-zero bytes, which is all done
+    in C instead of a python loop per byte.
 
+    Args:
+      old     (bytes): the original data
+      new     (bytes): the changed data (of the same length)
+      max_gap (int):   differing ranges that are at most this many bytes apart are merged
+    Returns:
+      A list of tuples of offset and length of the differing ranges.
+    """
+    if len(old) != len(new):
+        raise ValueError(f'Cannot diff data of different sizes: {len(old)} and {len(new)} bytes.')
+
+    block_size = 4096
+    old_view = memoryview(old)
+    new_view = memoryview(new)
+
+    runs = []
+    for block_start in range(0, len(old), block_size):
+        block_end = min(block_start + block_size, len(old))
+        old_block = old_view[block_start:block_end]
+        new_block = new_view[block_start:block_end]
+        if old_block == new_block:
+            continue
+
+        xor = (int.from_bytes(old_block, 'big') ^ int.from_bytes(new_block, 'big')).to_bytes(len(old_block), 'big')
+        for match in PATTERN_NON_ZERO_BYTES.finditer(xor):
+            start = block_start + match.start()
+            end   = block_start + match.end()
+            if runs and start - (runs[-1][0] + runs[-1][1]) <= max_gap:
+                runs[-1] = (runs[-1][0], end - runs[-1][0])
+            else:
+                runs.append((start, end - start))
+
+    return runs
+
+
+def make_ips_patch(rom: bytes, new_rom: bytes) -> bytes:
+    """
+    Create an IPS patch that turns 'rom' into 'new_rom'.
+
+    Runs of a single repeated byte are stored as RLE records.
+    """
+    if len(new_rom) > IPS_MAX_OFFSET:
+        raise ValueError(f'ROM of {len(new_rom)} bytes is too big for an IPS patch.')
+
+    patch = bytearray(IPS_MAGIC)
+    # Unchanged gaps up to the size of a record header are cheaper to include
+    for offset, length in diff_runs(rom, new_rom, max_gap=5):
+        # Records may not start at an offset that reads as the end marker
+        if offset == IPS_EOF_OFFSET:
+            offset -= 1
+            length += 1
+        for chunk_start in range(offset, offset + length, 0xffff):
+            chunk = bytes(new_rom[chunk_start:min(chunk_start + 0xffff, offset + length)])
+            patch += chunk_start.to_bytes(3, 'big')
+            if len(chunk) > 8 and chunk.count(chunk[0]) == len(chunk):
+                patch += bytes(2) + len(chunk).to_bytes(2, 'big') + chunk[:1]
+            else:
+                patch += len(chunk).to_bytes(2, 'big') + chunk
+    patch += IPS_EOF
+
+    return bytes(patch)
+
+
+def apply_ips_patch(patch: bytes, rom: bytes) -> bytearray:
+    if not patch.startswith(IPS_MAGIC):
+        raise ValueError('Not an IPS patch.')
+
+    new_rom = bytearray(rom)
+    i = len(IPS_MAGIC)
+    while patch[i:i+3] != IPS_EOF:
+        if i + 5 > len(patch):
+            raise ValueError('IPS patch is truncated.')
+        offset = int.from_bytes(patch[i:i+3], 'big')
+        length = int.from_bytes(patch[i+3:i+5], 'big')
+        i += 5
+        if length == 0:
+            length = int.from_bytes(patch[i:i+2], 'big')
+            data = patch[i+2:i+3] * length
+            i += 3
+        else:
+            data = patch[i:i+length]
+            i += length
+        if offset + length > len(new_rom):
+            new_rom.extend(bytes(offset + length - len(new_rom)))
+        new_rom[offset:offset+length] = data
+
+    return new_rom
+
+
+def _bps_number(value: int) -> bytes:
+    result = bytearray()
+    while True:
+        x = value & 0x7f
+        value >>= 7
+        if value == 0:
+            result.append(0x80 | x)
+            return bytes(result)
+        result.append(x)
+        value -= 1
+
+
+def _read_bps_number(patch: bytes, i: int) -> tuple[int, int]:
+    value = 0
+    shift = 1
+    while True:
+        x = patch[i]
+        i += 1
+        value += (x & 0x7f) * shift
+        if x & 0x80:
+            return (value, i)
+        shift <<= 7
+        value += shift
+
+
+def make_bps_patch(rom: bytes, new_rom: bytes) -> bytes:
+    """
+    Create a BPS patch that turns 'rom' into 'new_rom'.
+
+    The patch contains the CRC32 of 'rom', so applying it to a different
+    ROM fails right away.
+    """
+    patch = bytearray(BPS_MAGIC)
+    patch += _bps_number(len(rom)) + _bps_number(len(new_rom)) + _bps_number(0)
+
+    # Unchanged parts are read from the source, changed parts are stored
+    output_offset = 0
+    for offset, length in diff_runs(rom, new_rom, max_gap=2):
+        if offset > output_offset:
+            patch += _bps_number(((offset - output_offset - 1) << 2) | BPS_SOURCE_READ)
+        patch += _bps_number(((length - 1) << 2) | BPS_TARGET_READ)
+        patch += new_rom[offset:offset+length]
+        output_offset = offset + length
+    if output_offset < len(new_rom):
+        patch += _bps_number(((len(new_rom) - output_offset - 1) << 2) | BPS_SOURCE_READ)
+
+    patch += struct.pack('<II', zlib.crc32(rom), zlib.crc32(new_rom))
+    patch += struct.pack('<I', zlib.crc32(patch))
+
+    return bytes(patch)
+
+
+def apply_bps_patch(patch: bytes, rom: bytes) -> bytearray:
+    """
+    Apply a BPS patch (created by any tool) to the given ROM.
+
+    Raises:
+      ValueError: If the patch is damaged or does not belong to the given ROM.
+    """
+    if not patch.startswith(BPS_MAGIC):
+        raise ValueError('Not a BPS patch.')
+
+    source_crc, target_crc, patch_crc = struct.unpack('<III', patch[-12:])
+    if zlib.crc32(patch[:-4]) != patch_crc:
+        raise ValueError('BPS patch is damaged (checksum mismatch).')
+    if zlib.crc32(rom) != source_crc:
+        raise ValueError(f'BPS patch does not belong to this ROM (expected CRC32 {source_crc:08x}, got {zlib.crc32(rom):08x}).')
+
+    i = len(BPS_MAGIC)
+    source_size,   i = _read_bps_number(patch, i)
+    target_size,   i = _read_bps_number(patch, i)
+    metadata_size, i = _read_bps_number(patch, i)
+    i += metadata_size
+    if source_size != len(rom):
+        raise ValueError(f'BPS patch expects a ROM of {source_size} bytes, got {len(rom)} bytes.')
+
+    new_rom = bytearray(target_size)
+    output_offset = 0
+    source_offset = 0
+    target_offset = 0
+    while i < len(patch) - 12:
+        data, i = _read_bps_number(patch, i)
+        action = data & 3
+        length = (data >> 2) + 1
+        if action == BPS_SOURCE_READ:
+            new_rom[output_offset:output_offset+length] = rom[output_offset:output_offset+length]
+        elif action == BPS_TARGET_READ:
+            new_rom[output_offset:output_offset+length] = patch[i:i+length]
+            i += length
+        else:
+            data, i = _read_bps_number(patch, i)
+            relative = (-1 if data & 1 else 1) * (data >> 1)
+            if action == BPS_SOURCE_COPY:
+                source_offset += relative
+                new_rom[output_offset:output_offset+length] = rom[source_offset:source_offset+length]
+                source_offset += length
+            else:
+                # Target copies may overlap with the bytes being written
+                target_offset += relative
+                for x in range(length):
+                    new_rom[output_offset + x] = new_rom[target_offset + x]
+                target_offset += length
+        output_offset += length
+
+    if zlib.crc32(new_rom) != target_crc:
+        raise ValueError('Patched ROM does not match the checksum of the BPS patch.')
+
+    return new_rom
+
+
+def apply_patch_file(patch_file: pathlib.Path, romfile: pathlib.Path, outfile: pathlib.Path, force: bool = False) -> None:
+    """
+    Apply an IPS or BPS patch file (detected by its header) to a ROM file.
+    """
+    with open(patch_file, 'rb') as f:
+        patch = f.read()
+    with read_rom_from_file(romfile) as rom:
+        if patch.startswith(BPS_MAGIC):
+            new_rom = apply_bps_patch(patch, rom)
+        elif patch.startswith(IPS_MAGIC):
+            new_rom = apply_ips_patch(patch, rom)
+        else:
+            raise ValueError(f'Unknown patch format of {patch_file}. Only IPS and BPS patches are supported.')
+
+    write_rom_to_file(new_rom, outfile, force)
 
-def hack_puzzles(old_rom: bytearray, puzzles: list[CategoryWithPuzzles]) -> None:
+
+def hack_puzzles(plan: 'PatchPlan', puzzles: 'list[CategoryWithPuzzles] | PuzzleCorpus | PuzzleSample', quotas: dict[str, tuple[int, int]] = None) -> None:
+    """
+    Write the given puzzles into the ROM.
+
+    If 'quotas' (category name -> minimum and maximum number of puzzles, each
+    may be None) is given, the puzzles of the family edition are selected by
+    'optimize_puzzle_selection'. The classic edition has a fixed number of
+    puzzles per category and ignores it.
+    """
     if preset.puzzle_hack_function == 'classic':
-        _hack_puzzles_classic_edition(old_rom, puzzles)
+        if quotas is not None:
+            log_wrn('The classic edition has a fixed number of puzzles per category. Ignoring the puzzle quotas.')
+        _hack_puzzles_classic_edition(plan, puzzles)
     elif preset.puzzle_hack_function == 'family':
-        _hack_puzzles_family_edition(old_rom, puzzles)
+        _hack_puzzles_family_edition(plan, puzzles, quotas)
     else:
         raise Exception('Unsupported hack function: ' + str(preset.puzzle_hack_function) + ' This seems to be a bug.')
 
@@ -357,149 +908,161 @@ def _convert_puzzlelist_for_classic(puzzlelist: list[CategoryWithPuzzles]) -> li
     return result
 
 
-def _hack_puzzles_family_edition(old_rom: bytearray, puzzles: list[CategoryWithPuzzles]) -> None:
-    cur_puzzle_addr          = preset.puzzle_addr_range.start
-    cur_puzzle_pointer_addr  = preset.puzzle_pointers_start_add
-    cur_puzzle_pointer_value = preset.puzzle_pointers_first_value
+def _hack_puzzles_family_edition(plan: 'PatchPlan', puzzles: 'list[CategoryWithPuzzles] | PuzzleCorpus | PuzzleSample', quotas: dict[str, tuple[int, int]] = None) -> None:
+    if isinstance(puzzles, (PuzzleCorpus, PuzzleSample)):
+        # The puzzles of a compiled corpus or a sample are already encoded
+        cat_names = [cat_name for cat_name, _ in puzzles.categories]
+        categories = [puzzles.family_puzzles(cat_range) for _, cat_range in puzzles.categories]
+    else:
+        cat_names = [puzzle.category_name for puzzle in puzzles]
+        # encode all puzzles to get their actual lengths
+        categories = [[encode_family_puzzle(puzzle) for puzzle in sanitize_puzzles(cwp.puzzles)] for cwp in puzzles]
 
     # write the category name into the ROM file
-    cat_names = [puzzle.category_name for puzzle in puzzles]
     for cat_idx, cat_name in enumerate(cat_names):
         cat_name_rom_addr = preset.category_addr_range.start + cat_idx * 8
         encoded_cat_name = tbl_encode(cat_name, 8, tbl)
-        new_rom[cat_name_rom_addr:cat_name_rom_addr+8] = encoded_cat_name
-
-    # we don’t need the categories anymore (they are contained in the puzzle list)
-    new_puzzles = []
-    for cwp in puzzles:
-        new_puzzles.extend(cwp.puzzles)
-    puzzles = new_puzzles
-    sane_puzzles = sanitize_puzzles(puzzles)
-    random.shuffle(sane_puzzles)
-    puzzle_count = preset.no_of_puzzles
-
-    while len(sane_puzzles) < puzzle_count:
-        sane_puzzles.extend(sane_puzzles)
+        plan.write(cat_name_rom_addr, encoded_cat_name)
 
-    log_vbs('Importing', len(sane_puzzles), 'puzzles.')
-
-    # encode all puzzles to get their actual lengths
-    encoded_puzzles = [encode_family_puzzle(puzzle) for puzzle in sane_puzzles]
-    puzzles_to_use = reduce_to_bounds(encoded_puzzles, puzzle_count, len(preset.puzzle_addr_range))
-
-    # Write the first puzzle without specifying the pointer address which
-    # is implicitly set to 0xff 0xff. Then prepare the next pointer address.
-    puzzle = puzzles_to_use[0]
-    new_rom[cur_puzzle_addr:cur_puzzle_addr+len(puzzle)] = puzzle
-    cur_puzzle_addr += len(puzzle)
-    cur_puzzle_pointer_value = inc_ptr_by(cur_puzzle_pointer_value, len(puzzle) - 1, False) # -1 because the first puzzle is not on addr 0x00 0x00, but 0xff 0xff
+    puzzle_count = preset.no_of_puzzles
+    log_vbs('Importing', sum(len(category) for category in categories), 'puzzles.')
 
-    # write the remaining puzzles and their pointers into the ROM file
-    for i in range(1, puzzle_count):
-        puzzle = puzzles_to_use[i]
-        log_dbg('Importing puzzle:', puzzle)
-        new_rom[cur_puzzle_addr:cur_puzzle_addr+len(puzzle)] = puzzle
-        new_rom[cur_puzzle_pointer_addr:cur_puzzle_pointer_addr+2] = cur_puzzle_pointer_value
-        cur_puzzle_addr += len(puzzle)
-        cur_puzzle_pointer_addr += 2
-        cur_puzzle_pointer_value = inc_ptr_by(cur_puzzle_pointer_value, len(puzzle), False)
+    if quotas is None:
+        # we don’t need the categories anymore (they are contained in the puzzles)
+        encoded_puzzles = [puzzle for category in categories for puzzle in category]
+        plan.rng.shuffle(encoded_puzzles)
+        puzzles_to_use, repeats = select_puzzles(encoded_puzzles, puzzle_count, len(preset.puzzle_addr_range))
+    else:
+        for category in categories:
+            plan.rng.shuffle(category)
+        category_quotas = resolve_puzzle_quotas(cat_names, categories, quotas, puzzle_count)
+        puzzles_to_use, repeats = optimize_puzzle_selection(categories, category_quotas, puzzle_count, len(preset.puzzle_addr_range), plan.rng)
+    plan.puzzle_repeats = repeats
+    log_vbs('Filled', repeats, 'of', puzzle_count, 'puzzle slots with repeated puzzles.')
+
+    # The first puzzle is written without specifying the pointer address
+    # which is implicitly set to 0xff 0xff. Therefore the pointer table
+    # starts with the second puzzle.
+    # -1 because the first puzzle is not on addr 0x00 0x00, but 0xff 0xff
+    first_pointer = int.from_bytes(preset.puzzle_pointers_first_value, 'big') + len(puzzles_to_use[0]) - 1
+    pointer_table = build_puzzle_pointer_table(puzzles_to_use[1:], first_pointer, 'big')
+
+    # Only loop over the puzzles if they are actually logged
+    if log_level <= LOG_DEBUG:
+        for puzzle in puzzles_to_use:
+            log_dbg('Importing puzzle:', puzzle)
+    cur_puzzle_addr = write_puzzles(plan, puzzles_to_use, pointer_table)
 
     # Fill the remaining parts of the puzzle area with dummy text.
     # This is only done for fun.
     # FIXME: May be replaced by Lorem Ipsum or some ascii art
     remaining_puzzle_space = preset.puzzle_addr_range.stop - cur_puzzle_addr
-    for i in range(remaining_puzzle_space):
-        new_rom[cur_puzzle_addr] = 0xfa
-        cur_puzzle_addr += 1
-
+    plan.write(cur_puzzle_addr, bytes([0xfa]) * remaining_puzzle_space)
+    plan.puzzle_leftover_bytes = remaining_puzzle_space
+    log_vbs(remaining_puzzle_space, 'bytes of the puzzle area are left over.')
 
 
-def _hack_puzzles_classic_edition(new_rom: bytearray, puzzles: list[CategoryWithPuzzles]) -> None:
-    cur_puzzle_addr          = preset.puzzle_addr_range.start
-    cur_puzzle_pointer_addr  = preset.puzzle_pointers_start_add
-    cur_puzzle_pointer_value = preset.puzzle_pointers_first_value
-
+def _hack_puzzles_classic_edition(plan: 'PatchPlan', puzzles: 'list[CategoryWithPuzzles] | PuzzleCorpus | PuzzleSample') -> None:
     #puzzles = _convert_puzzlelist_for_classic(puzzles)
-    puzzles = [(cwp.category_name, cwp.puzzles) for cwp in puzzles]
-
+    if isinstance(puzzles, (PuzzleCorpus, PuzzleSample)):
+        corpus = puzzles
+        puzzles = corpus.categories
+    else:
+        corpus = None
+        puzzles = [(cwp.category_name, cwp.puzzles) for cwp in puzzles]
+    all_puzzles_to_use = []
+    plan.puzzle_repeats = 0
+
+    cat_names      = []
+    padded_puzzles = []
+    puzzle_counts  = []
     for cat_idx, bounds in enumerate(preset.puzzle_category_ranges):
         # FIXME: Handle missing categories here!
         cat_name = puzzles[cat_idx][0]
-        puzzles_in_cat = puzzles[cat_idx][1]
-        sane_puzzles = sanitize_puzzles(puzzles_in_cat)
-        random.shuffle(sane_puzzles)
+        if corpus is not None:
+            # The puzzles of a compiled corpus or a sample are already encoded
+            encoded_puzzles = corpus.classic_puzzles(puzzles[cat_idx][1])
+        else:
+            # encode all puzzles to get their actual lengths
+            encoded_puzzles = [encode_classic_puzzle(puzzle) for puzzle in sanitize_puzzles(puzzles[cat_idx][1])]
+        plan.rng.shuffle(encoded_puzzles)
         puzzle_count = bounds.stop - bounds.start
         # We need to assure that each category has at least one
         # puzzle. Therefore, if this is not the case, we add a default
         # “Wheel of Fortune” to each empty category.
-        if sane_puzzles == []:
-            sane_puzzles.append(Puzzle(cat_name, cat_idx, 'WHEEL\nOF\nFORTUNE'))
-        while len(sane_puzzles) < puzzle_count:
-            sane_puzzles.extend(sane_puzzles)
-
-        log_vbs('Importing', len(sane_puzzles), 'puzzles into category “' + cat_name + '” with', puzzle_count, 'slots.')
-
-        # encode all puzzles to get their actual lengths
-        encoded_puzzles = [encode_classic_puzzle(puzzle) for puzzle in sane_puzzles]
-        puzzles_to_use = reduce_to_bounds(encoded_puzzles, puzzle_count, len(preset.puzzle_addr_range))
-
-        # FIXME: The first pointer is always on FF FF and should not explicitly been set
-        # write the puzzles and their pointers into the ROM file
-        for i in range(puzzle_count):
-            puzzle = puzzles_to_use[i]
-            log_dbg('Importing puzzle:', puzzle)
-            new_rom[cur_puzzle_addr:cur_puzzle_addr+len(puzzle)] = puzzle
-            new_rom[cur_puzzle_pointer_addr:cur_puzzle_pointer_addr+2] = cur_puzzle_pointer_value
-            cur_puzzle_addr += len(puzzle)
-            cur_puzzle_pointer_addr += 2
-            cur_puzzle_pointer_value = inc_ptr_by(cur_puzzle_pointer_value, len(puzzle))
+        if encoded_puzzles == []:
+            encoded_puzzles.append(encode_classic_puzzle(Puzzle(cat_name, cat_idx, 'WHEEL\nOF\nFORTUNE')))
+
+        log_vbs('Importing', len(encoded_puzzles), 'puzzles into category “' + cat_name + '” with', puzzle_count, 'slots.')
+        cat_names.append(cat_name)
+        padded_puzzles.append(pad_puzzles(encoded_puzzles, puzzle_count))
+        puzzle_counts.append(puzzle_count)
+
+    # Split the puzzle area among the categories before anything is written,
+    # so that early categories cannot take the space of later ones.
+    budgets = plan_category_budgets(cat_names, padded_puzzles, puzzle_counts, len(preset.puzzle_addr_range))
+
+    for cat_idx, (cat_name, padded, puzzle_count, budget) in enumerate(zip(cat_names, padded_puzzles, puzzle_counts, budgets)):
+        log_vbs('Category', cat_name, 'gets', budget, 'bytes of the puzzle area.')
+        puzzles_to_use = reduce_to_bounds(padded, puzzle_count, budget)
+        repeats = count_repeats(puzzles_to_use)
+        plan.puzzle_repeats += repeats
+        log_vbs('Filled', repeats, 'of', puzzle_count, 'puzzle slots of category', cat_name, 'with repeated puzzles.')
+        if log_level <= LOG_DEBUG:
+            for puzzle in puzzles_to_use:
+                log_dbg('Importing puzzle:', puzzle)
+        all_puzzles_to_use.extend(puzzles_to_use)
 
         # write the category name into the ROM file
         cat_name_rom_addr = preset.category_addr_range.start + cat_idx * 8
         encoded_cat_name = tbl_encode(cat_name, 8, tbl)
-        new_rom[cat_name_rom_addr:cat_name_rom_addr+8] = encoded_cat_name
+        plan.write(cat_name_rom_addr, encoded_cat_name)
+
+    # FIXME: The first pointer is always on FF FF and should not explicitly been set
+    # write the puzzles of all categories and their pointers into the ROM file
+    first_pointer = int.from_bytes(preset.puzzle_pointers_first_value, 'little')
+    pointer_table = build_puzzle_pointer_table(all_puzzles_to_use, first_pointer, 'little')
+    cur_puzzle_addr = write_puzzles(plan, all_puzzles_to_use, pointer_table)
 
     # Fill the remaning parts of the puzzle area with dummy text.
     # This is only done for fun.
     # FIXME: May be replaced by Lorem Ipsum or some ascii art
     remaining_puzzle_space = preset.puzzle_addr_range.stop - cur_puzzle_addr
-    for i in range(remaining_puzzle_space):
-        new_rom[cur_puzzle_addr] = 0xfa
-        cur_puzzle_addr += 1
+    plan.write(cur_puzzle_addr, bytes([0xfa]) * remaining_puzzle_space)
+    plan.puzzle_leftover_bytes = remaining_puzzle_space
+    log_vbs(remaining_puzzle_space, 'bytes of the puzzle area are left over.')
 
 
-def hack_players(new_rom: bytearray, players: list[str]) -> None:
-    cur_player_name_addr = preset.player_names_addr_range.start
-
+def hack_players(plan: 'PatchPlan', players: list[str]) -> None:
     players = [n.ljust(preset.length_of_player_names) for n in
                     players]
-    random.shuffle(players)
+    plan.rng.shuffle(players)
     players = players[:preset.no_of_player_names]
     log_vbs('Importing', len(players), 'player names.')
-    for i, player in enumerate(players):
-        log_dbg('Importing player name:', player)
-        new_rom[cur_player_name_addr:cur_player_name_addr+preset.length_of_player_names] = encode_str(player)
-        cur_player_name_addr += preset.length_of_player_names
+    if log_level <= LOG_DEBUG:
+        for player in players:
+            log_dbg('Importing player name:', player)
+    plan.write(preset.player_names_addr_range.start, encode_str(''.join(players)))
 
 
-def hack_title_screen(new_rom: bytearray, title_text: list[str]) -> None:
-    tbl = read_tbl_file('assets/title.tbl')
+def hack_title_screen(plan: 'PatchPlan', title_text: list[str]) -> None:
+    tbl = tbl_codec('assets/title.tbl')
     encoded_text = encode_title_text(title_text, len(preset.title_text_addr_range), tbl)
 
     log_vbs('Importing custom text for the title screen.')
-    new_rom[preset.title_text_addr_range.start:preset.title_text_addr_range.stop] = encoded_text
+    plan.write(preset.title_text_addr_range.start, encoded_text)
 
 
-def hack_marquee_text(new_rom: bytearray, marquee_text: list[str]) -> None:
-    tbl = read_tbl_file('assets/marquee.tbl')
+def hack_marquee_text(plan: 'PatchPlan', marquee_text: list[str]) -> None:
+    tbl = tbl_codec('assets/marquee.tbl')
     encoded_text = encode_marquee_text(marquee_text, len(preset.marquee_text_addr_range), tbl)
 
     log_vbs('Importing custom marquee text.')
-    new_rom[preset.marquee_text_addr_range.start:preset.marquee_text_addr_range.stop] = encoded_text
+    plan.write(preset.marquee_text_addr_range.start, encoded_text)
 
 
-def hack_big_logo(new_rom: bytearray, image_path: pathlib.Path) -> None:
-    tiles         = image_to_nes(image_path)
+def hack_big_logo(plan: 'PatchPlan', image_path: pathlib.Path) -> None:
+    tiles         = load_image(image_path).tiles
     tiles_and_map = generate_tilemap(tiles)
     tiles         = tiles_and_map[0]
 
@@ -507,23 +1070,18 @@ def hack_big_logo(new_rom: bytearray, image_path: pathlib.Path) -> None:
         print(f"Error: Too many tiles: {len(tiles)} tiles with {len(tiles) * 16} bytes for a {len(preset.tile_range_big_logo)} byte area.")
         sys.exit(1)
 
-    i= preset.tile_range_big_logo.start
-    for x in range(2, len(tiles)):
-        tile = tiles[x]
-        new_rom[i:i+len(tile)] = tile
-        i += len(tile)
-
-    i= preset.tilemap_range_big_logo.start
-    for b in tiles_and_map[1]:
-        new_rom[i] = b
-        i += 1
+    plan.write(preset.tile_range_big_logo.start,    b''.join(tiles[x] for x in range(2, len(tiles))))
+    plan.write(preset.tilemap_range_big_logo.start, bytes(tiles_and_map[1]))
 
 
 def sanitize_puzzles(l: list[Puzzle])  -> list[Puzzle]:
     r = []
     for item in l:
         try:
-            if '@' in item.puzzle:
+            if '\n' in item.puzzle:
+                # Already laid out (e.g. read from a puzzle database)
+                r.append(item)
+            elif '@' in item.puzzle:
                 wrapped_puzzle = force_wrap(item.puzzle)
                 r.append(Puzzle(item.category, item.category_idx, wrapped_puzzle))
             else:
@@ -547,8 +1105,7 @@ def sanitize(l: list[str]) -> list[str]:
     return r
 
 
-# FIXME: This method is still mainly untested
-def reduce_to_bounds(encoded_puzzles: list[bytes], puzzle_count: int, addr_range: int) -> list[bytes]:
+def reduce_to_bounds(encoded_puzzles: Sequence[bytes], puzzle_count: int, addr_range: int) -> list[bytes]:
     """
     Reduces the given list of puzzles to 'puzzle_count', ensuring that they don’t exceed 'addr_range'.
 
@@ -557,7 +1114,12 @@ def reduce_to_bounds(encoded_puzzles: list[bytes], puzzle_count: int, addr_range
 
     If these items do exceed the given range, the longest item if them is
     replaced by the shortest one in 'encoded_puzzles[puzzle_count:]. This
-    is repeated until the resulting list is <= 'addr_range'.
+    is repeated until the resulting list is <= 'addr_range'. The shortest
+    item is thereby appended again and again to the end of the resulting
+    list.
+
+    The longest items are taken from a heap, so this runs in O(n log n)
+    even for huge lists of puzzles.
 
     The method does _not_ fill the new list with additional entries in case
     'len(encoded_puzzles) < puzzle_count'.
@@ -566,235 +1128,959 @@ def reduce_to_bounds(encoded_puzzles: list[bytes], puzzle_count: int, addr_range
     returns a new list.
 
     Args:
-      encoded_puzzles (list[bytes]): the list to reduce
+      encoded_puzzles (Sequence[bytes]): the list (or e.g. 'CyclicPuzzles') to reduce
       puzzle_count    (int):         the number of items to reduce the given list to
       addr_range      (int):         the number of bytes that may not be exceeded
     Returns:
       A new list[bytes] of 'puzzle_count' puzzles with a length of <= 'addr_range'.
     Raises:
       OverflowError: If the list cannot be reduced to 'puzzle_count' items
-                     while not exceeding 'addr_range'.
+                     while not exceeding 'addr_range', i.e. if there are no
+                     items in 'encoded_puzzles[puzzle_count:]' or replacing
+                     all longer items by the shortest one is not enough.
     """
-    reduced_puzzles   = encoded_puzzles[:puzzle_count]
-    remaining_puzzles = encoded_puzzles[puzzle_count:]
+    reduced_puzzles = list(encoded_puzzles[:puzzle_count])
 
-    while sum_bytes(reduced_puzzles) > addr_range:
-        if len(remaining_puzzles) == 0:
-            raise OverflowError(f"Cannot reduce the size of the given list below {addr_range}. Min size is {sum_bytes(reduced_puzzles)}.")
+    total_bytes = sum_bytes(reduced_puzzles)
+    if total_bytes <= addr_range:
+        return reduced_puzzles
+    if len(encoded_puzzles) <= puzzle_count:
+        raise OverflowError(f"Cannot reduce the size of the given list below {addr_range}. Min size is {total_bytes}.")
 
-        longest_puzzle  = max(reduced_puzzles,   key = len)
-        reduced_puzzles.remove(longest_puzzle)
-        shortest_puzzle = min(remaining_puzzles, key = len)
-        reduced_puzzles.append(shortest_puzzle)
+    shortest_puzzle = min(encoded_puzzles[puzzle_count:], key = len)
 
-    return reduced_puzzles
+    # The index is part of the heap items to pick the first of several
+    # equally long puzzles.
+    longest = [(-len(puzzle), i) for i, puzzle in enumerate(reduced_puzzles)]
+    heapq.heapify(longest)
 
+    replaced_idxs = set()
+    while total_bytes > addr_range:
+        # Stop if the replacements would no longer make the list shorter
+        if len(longest) == 0 or len(shortest_puzzle) >= -longest[0][0]:
+            raise OverflowError(f"Cannot reduce the size of the given list below {addr_range}. Min size is {total_bytes}.")
 
-def sum_bytes(lst: list[bytes]) -> int:
-    return sum(len(item) for item in lst)
-
-
-def inc_ptr_by(ptr_value: bytes, amount: int, reverse: bool = True) -> bytes:
-    val = ptr_value
-    for i in range(amount):
-        if reverse:
-            val = inc_ptr_reverse(val)
-        else:
-            val = inc_ptr(val)
-    return val
-
+        neg_longest_len, longest_idx = heapq.heappop(longest)
+        replaced_idxs.add(longest_idx)
+        total_bytes += len(shortest_puzzle) + neg_longest_len
 
-def inc_ptr(ptr_value: bytes) -> bytes:
-    lo = ptr_value[1]
-    hi = ptr_value[0]
-    if lo == 0xFF:
-        return bytes([hi+1, 0x00])
-    else:
-        return bytes([hi, lo+1])
+    return [puzzle for i, puzzle in enumerate(reduced_puzzles) if i not in replaced_idxs] + [shortest_puzzle] * len(replaced_idxs)
 
 
-def inc_ptr_reverse(ptr_value: bytes) -> bytes:
-    lo = ptr_value[0]
-    hi = ptr_value[1]
-    if lo == 0xFF:
-        return bytes([0x00, hi+1])
-    else:
-        return bytes([lo+1, hi])
+class CyclicPuzzles(Sequence):
+    """
+    A read-only view repeating the given puzzles cyclically up to 'length' items.
 
+    Item 'i' is 'puzzles[i % len(puzzles)]', so all repeats of a puzzle share
+    the same bytes object and no list of repeats is ever built.
+    """
+    def __init__(self, puzzles: list[bytes], length: int):
+        self._puzzles = puzzles
+        self._length  = length
 
-def read_player_names_file(players_file: str) -> list[str]:
-    player_names = []
+    def __len__(self) -> int:
+        return self._length
 
-    with open(players_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line == '' or line.startswith('#'):
-                continue
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._puzzles[i % len(self._puzzles)] for i in range(*index.indices(self._length))]
+        if not -self._length <= index < self._length:
+            raise IndexError('CyclicPuzzles index out of range')
+        return self._puzzles[index % self._length % len(self._puzzles)]
 
-            player_name = line
-            if len(player_name) > preset.length_of_player_names:
-                log_wrn('Player name “' + player_name + '” is too long. Only ' + preset.length_of_player_names + ' characters are allowed.')
-                continue
 
-            player_names.append(player_name.upper())
+def pad_puzzles(encoded_puzzles: list[bytes], puzzle_count: int) -> CyclicPuzzles:
+    """
+    Repeat the given puzzles in a 'CyclicPuzzles' view with at least
+    'puzzle_count' items. The view is as long as doubling the list until it
+    has enough puzzles would make it.
 
-    return player_names
+    Raises:
+      ValueError: If there are no puzzles at all.
+    """
+    if not encoded_puzzles:
+        raise ValueError('There are no puzzles to fill the puzzle slots with.')
 
+    length = len(encoded_puzzles)
+    while length < puzzle_count:
+        length *= 2
+    return CyclicPuzzles(encoded_puzzles, length)
 
-def read_puzzle_file(puzzlefile: str) -> list[CategoryWithPuzzles]:
-    categories = []  # a list of tuples: (category, [puzzles])
 
-    with open(puzzlefile, 'r') as f:
-        cur_category = None
-        category_idx = -1
-        for line in f:
-            line = line.strip().upper()
-            if line == '' or line.startswith('#'):
-                continue
+def plan_category_budgets(cat_names: list[str], padded_puzzles: list[CyclicPuzzles], puzzle_counts: list[int], addr_range: int) -> list[int]:
+    """
+    Split the 'addr_range' bytes of the puzzle area into a byte budget per category.
 
-            category_match = re.search(PATTERN_CATEGORY_LINE, line)
-            if category_match is not None:
-                category_name = category_match.group(1)
-                cur_category = CategoryWithPuzzles(category_name, [])
-                category_idx += 1
-                categories.append(cur_category)
-                continue
+    For each category the bytes of its first 'puzzle_counts' puzzles (the
+    puzzles it would get without any budget) and the least bytes it needs
+    (see 'least_bytes') are determined. If the first puzzles of all categories
+    fit, each category gets their bytes. Otherwise each category gets the
+    bytes it needs at least and the rest of the area is shared in proportion
+    to how much more the categories would need for their first puzzles.
 
-            cur_category.puzzles.append(Puzzle(category_name, category_idx, line))
+    Args:
+      cat_names      (list[str]):           the names of the categories (for the report)
+      padded_puzzles (list[CyclicPuzzles]): the puzzles of each category (see 'pad_puzzles')
+      puzzle_counts  (list[int]):           the number of puzzle slots of each category
+      addr_range     (int):                 the number of bytes of the puzzle area
+    Returns:
+      The budget of each category (in bytes), see 'reduce_to_bounds'.
+    Raises:
+      OverflowError: With a report of the demand of each category, if even
+                     the shortest puzzles don’t fit into 'addr_range'.
+    """
+    desired = [sum_bytes(puzzles[:count]) for puzzles, count in zip(padded_puzzles, puzzle_counts)]
+    minimum = [least_bytes(puzzles, count) for puzzles, count in zip(padded_puzzles, puzzle_counts)]
 
-    return categories
+    if sum(minimum) > addr_range:
+        report = [f'The puzzles need at least {sum(minimum)} bytes, but the puzzle area has only {addr_range} bytes:',
+                  f'  {"category":<10} {"slots":>6} {"puzzles":>8} {"minimum":>8} {"desired":>8}']
+        for cat_name, puzzles, count, cat_minimum, cat_desired in zip(cat_names, padded_puzzles, puzzle_counts, minimum, desired):
+            unique = len({id(puzzle) for puzzle in puzzles})
+            report.append(f'  {cat_name:<10} {count:>6} {unique:>8} {cat_minimum:>8} {cat_desired:>8}')
+        raise OverflowError('\n'.join(report))
 
+    if sum(desired) <= addr_range:
+        return desired
 
-def read_title_text_file(file: str) -> list[str]:
-    with open(file, 'r') as f:
-        content = f.read()
-        lines = content.splitlines()
+    slack = addr_range - sum(minimum)
+    extra = sum(desired) - sum(minimum)
+    return [cat_minimum + slack * (cat_desired - cat_minimum) // extra for cat_minimum, cat_desired in zip(minimum, desired)]
 
-        # Filter out all lines that are not part of the actual text.
-        lines = filter_title_text_lines(lines)
 
-        # Cut off trailing comments
-        lines = [line.split('#')[0] for line in lines]
+def least_bytes(encoded_puzzles: Sequence[bytes], puzzle_count: int) -> int:
+    """
+    Get the fewest bytes 'reduce_to_bounds' can reduce 'puzzle_count' of the given puzzles to.
 
-        # Cut off trailing whitespace
-        lines = [line.rstrip() for line in lines]
+    That is the bytes of the first 'puzzle_count' puzzles, after all of them
+    that are longer than the shortest remaining puzzle are replaced by it.
+    """
+    if len(encoded_puzzles) <= puzzle_count:
+        return sum_bytes(encoded_puzzles[:puzzle_count])
+    shortest_len = min(map(len, encoded_puzzles[puzzle_count:]))
+    return sum(min(len(puzzle), shortest_len) for puzzle in encoded_puzzles[:puzzle_count])
 
-        return lines
 
+def select_puzzles(encoded_puzzles: list[bytes], puzzle_count: int, addr_range: int) -> tuple[list[bytes], int]:
+    """
+    Select 'puzzle_count' of the given (unique) puzzles that fit into 'addr_range' bytes.
 
-def read_marquee_text_file(file: str) -> list[str]:
-    with open(file, 'r') as f:
-        content = f.read()
-        lines = content.splitlines()
+    If there are less puzzles than slots, the puzzles are repeated (see
+    'pad_puzzles'). The puzzles are then reduced to the bounds by
+    'reduce_to_bounds'.
 
-        # Filter out all comment lines
-        lines = [line for line in lines if not line.startswith('#')]
+    Returns:
+      A tuple of the selected puzzles and the number of slots that are filled
+      with a repeat of another selected puzzle.
+    Raises:
+      ValueError:    If there are no puzzles at all.
+      OverflowError: If the puzzles don’t fit into 'addr_range' (see 'reduce_to_bounds').
+    """
+    puzzles_to_use = reduce_to_bounds(pad_puzzles(encoded_puzzles, puzzle_count), puzzle_count, addr_range)
+    return (puzzles_to_use, count_repeats(puzzles_to_use))
 
-        # Filter out all empty lines
-        lines = [line for line in lines if line != '']
 
-        return lines
+def count_repeats(puzzles: list[bytes]) -> int:
+    """
+    Count the puzzles that repeat another one (i.e. share its bytes object, see 'CyclicPuzzles').
+    """
+    return len(puzzles) - len({id(puzzle) for puzzle in puzzles})
 
 
-def force_wrap(line: str) -> str:
+def resolve_puzzle_quotas(cat_names: list[str], categories: list[list[bytes]], quotas: dict[str, tuple[int, int]], puzzle_count: int) -> list[tuple[int, int]]:
     """
-    Wrap a string at predefined positions.
-    The character indicating the wrap position is the '@'.
+    Determine the minimum and maximum number of puzzles of each category for
+    'optimize_puzzle_selection'.
+
+    Quotas that are not given default to half an even share of the
+    'puzzle_count' slots among the categories with puzzles as the minimum
+    and all slots as the maximum. Minimums are lowered to the number of
+    puzzles a category has.
 
     Raises:
-        ValueError: If the line is incorrecly split.
+      ValueError: If a quota is given for an unknown category, the minimums
+                  exceed 'puzzle_count' or the maximums of the categories
+                  with puzzles don’t add up to 'puzzle_count'.
     """
-    words = line.split('@')
-    if puzzle_fits(words):
-        return '\n'.join(words)
-    else:
-        raise ValueError('Line is incorrectly split: ' + line)
+    unknown = set(quotas) - set(cat_names)
+    if unknown:
+        raise ValueError(f'There are puzzle quotas for unknown categories: {", ".join(sorted(unknown))}. Known categories are: {", ".join(cat_names)}.')
 
+    default_minimum = puzzle_count // (2 * max(1, sum(1 for category in categories if category)))
+    result = []
+    for cat_name, category in zip(cat_names, categories):
+        minimum, maximum = quotas.get(cat_name, (None, None))
+        minimum = default_minimum if minimum is None else minimum
+        maximum = puzzle_count if maximum is None else maximum
+        if minimum > len(category):
+            log_vbs('Category', cat_name, 'has only', len(category), 'puzzles for its minimum quota of', minimum)
+            minimum = len(category)
+        result.append((min(minimum, maximum), maximum))
+
+    if sum(minimum for minimum, _ in result) > puzzle_count:
+        raise ValueError(f'The minimum puzzle quotas add up to {sum(minimum for minimum, _ in result)} puzzles, but there are only {puzzle_count} puzzle slots.')
+    capacity = sum(maximum for (_, maximum), category in zip(result, categories) if category)
+    if capacity < puzzle_count:
+        raise ValueError(f'The maximum puzzle quotas of the categories with puzzles add up to {capacity} puzzles, but all {puzzle_count} puzzle slots need to be filled.')
+    return result
 
-def auto_wrap(line: str) -> str:
-    """
-    Automatically wraps the given string into up to 4 lines of length 11,13,13,11.
 
-    Returns (list[str]):
-      A list of strings with 1 to 4 lines into which the string was split.
+def optimize_puzzle_selection(categories: list[list[bytes]], quotas: list[tuple[int, int]], puzzle_count: int, addr_range: int, rng: random.Random) -> tuple[list[bytes], int]:
+    """
+    Select 'puzzle_count' puzzles of the given categories that honor the
+    minimum and maximum number of puzzles per category ('quotas') and fit
+    into 'addr_range' bytes, with as many distinct puzzles as possible.
+
+    This is a greedy algorithm with a repair step:
+
+    1. Each category gets its minimum of puzzles. The remaining slots get the
+       remaining puzzles in random order, unless their category already has
+       its maximum.
+    2. If there are not enough puzzles, the empty slots are filled with
+       repeats of the selected puzzles of the categories below their maximum
+       (see 'choose_repeats').
+    3. As long as the puzzles exceed 'addr_range', the longest selected
+       puzzle is replaced by the shortest unselected one of any category the
+       quotas allow. If there is no shorter one, it is replaced by a repeat.
+
+    Like 'reduce_to_bounds' this uses heaps and runs in O(n log n), as the
+    byte total is kept up to date and the repeats only depend on the shortest
+    selected puzzle of each category. The puzzles of each category should be
+    shuffled, as the minimums are taken
+    from their beginning. All other random choices are made with 'rng'.
 
+    Returns:
+      A tuple of the selected puzzles (shuffled) and the number of slots
+      filled with repeats.
     Raises:
-      ValueError: If the string could not be split to fit into the defined lengths.
+      ValueError:    If there are no puzzles or the empty slots cannot be
+                     filled without exceeding the maximum quotas.
+      OverflowError: If the puzzles cannot be reduced to 'addr_range'.
     """
+    puzzles = [puzzle for category in categories for puzzle in category]
+    cat_of  = [cat for cat, category in enumerate(categories) for _ in category]
+    first   = list(itertools.accumulate((len(category) for category in categories), initial=0))
+    counts  = [minimum for minimum, _ in quotas]
+    selected = bytearray(len(puzzles))
+    for cat, (minimum, _) in enumerate(quotas):
+        selected[first[cat]:first[cat] + minimum] = b'\x01' * minimum
+
+    distinct = sum(counts)
+    rest = [uid for uid in range(len(puzzles)) if not selected[uid]]
+    rng.shuffle(rest)
+    for uid in rest:
+        if distinct == puzzle_count:
+            break
+        cat = cat_of[uid]
+        if counts[cat] < quotas[cat][1]:
+            selected[uid] = 1
+            counts[cat] += 1
+            distinct += 1
+
+    if distinct == 0:
+        raise ValueError('There are no puzzles to fill the puzzle slots with.')
+
+    # The index is part of the heap items to pick the first of several
+    # equally long puzzles. Puzzles that are no longer selected are only
+    # removed from 'shortest_selected' once they come to its top.
+    longest = [(-len(puzzles[uid]), uid) for uid in range(len(puzzles)) if selected[uid]]
+    shortest = [[(len(puzzles[uid]), uid) for uid in range(first[cat], first[cat + 1]) if not selected[uid]] for cat in range(len(categories))]
+    shortest_selected = [[(len(puzzles[uid]), uid) for uid in range(first[cat], first[cat + 1]) if selected[uid]] for cat in range(len(categories))]
+    for heap in [longest, *shortest, *shortest_selected]:
+        heapq.heapify(heap)
+    distinct_bytes = -sum(neg_len for neg_len, _ in longest)
+
+    def choose() -> list[tuple[int, int]]:
+        for heap in shortest_selected:
+            while heap and not selected[heap[0][1]]:
+                heapq.heappop(heap)
+        room = [maximum - count for (_, maximum), count in zip(quotas, counts)]
+        return choose_repeats([heap[0] if heap else None for heap in shortest_selected], room, puzzle_count - distinct)
+
+    def total_bytes(repeats: list[tuple[int, int]]) -> float:
+        if repeats is None:
+            return float('inf')
+        return distinct_bytes + sum(len(puzzles[uid]) * repeat_count for uid, repeat_count in repeats)
+
+    total = total_bytes(choose())
+    if total == float('inf'):
+        raise ValueError(f'Cannot fill all {puzzle_count} puzzle slots without exceeding the maximum puzzle quotas.')
+    while total > addr_range:
+        if not longest:
+            raise OverflowError(f'Cannot reduce the size of the selected puzzles below {addr_range}. Min size is {total}.')
+        neg_longest_len, longest_uid = heapq.heappop(longest)
+        cat = cat_of[longest_uid]
+
+        # The shortest unselected puzzle of the same category or (if this
+        # category has more than its minimum) of any category below its maximum
+        best = None
+        for other_cat, heap in enumerate(shortest):
+            if other_cat != cat and (counts[cat] <= quotas[cat][0] or counts[other_cat] >= quotas[other_cat][1]):
+                continue
+            if heap and heap[0][0] < -neg_longest_len and (best is None or heap[0] < best):
+                best = heap[0]
+
+        if best is not None:
+            shortest_len, shortest_uid = heapq.heappop(shortest[cat_of[best[1]]])
+            selected[longest_uid] = 0
+            selected[shortest_uid] = 1
+            counts[cat] -= 1
+            counts[cat_of[shortest_uid]] += 1
+            heapq.heappush(longest, (-shortest_len, shortest_uid))
+            heapq.heappush(shortest_selected[cat_of[shortest_uid]], (shortest_len, shortest_uid))
+            distinct_bytes += shortest_len + neg_longest_len
+            total = total_bytes(choose())
+        elif counts[cat] > quotas[cat][0] and distinct > 1:
+            # Replace the puzzle by a repeat, if that makes the puzzles shorter
+            selected[longest_uid] = 0
+            counts[cat] -= 1
+            distinct -= 1
+            distinct_bytes += neg_longest_len
+            new_total = total_bytes(choose())
+            if new_total < total:
+                total = new_total
+            else:
+                selected[longest_uid] = 1
+                counts[cat] += 1
+                distinct += 1
+                distinct_bytes -= neg_longest_len
+                heapq.heappush(shortest_selected[cat], (-neg_longest_len, longest_uid))
 
-    LINE_LENGTHS = [11, 13, 13, 11]
+    repeats = choose()
+    result = [puzzles[uid] for uid in range(len(puzzles)) if selected[uid]]
+    for uid, repeat_count in repeats:
+        result.extend([puzzles[uid]] * repeat_count)
+    rng.shuffle(result)
+    return (result, puzzle_count - distinct)
 
-    # Up to 13 characters fit into 1 line (line 2)
-    words = line.split()
-    if chars(words) <= 13:
-        return ' '.join(words)
 
-    # Try to split into 2 lines
-    words = line.split()
-    line2 = ''
-    line1 = ''
-    for word in reversed(words):
-        new_line = (word + ' ' + line2).strip()
-        if len(new_line) <= 13:
-            line2 = new_line
-            del words[-1]
-            continue
-        line1 = ' '.join(words)
-        break
-
-    if len(line1) <= 13:
-        return line1 + '\n' + line2
-
-
-    # Try to split line1 even further (into 3 lines)
-    words = line1.split()
-    line3 = line2
-    line2 = ''
-    line1 = ''
-    for word in reversed(words):
-        new_line = (word + ' ' + line2).strip()
-        if len(new_line) <= 13:
-            line2 = new_line
-            del words[-1]
-            continue
-        line1 = ' '.join(words)
+def choose_repeats(candidates: list[tuple[int, int]], room: list[int], count: int) -> list[tuple[int, int]]:
+    """
+    Choose 'count' repeats of the selected puzzles for the puzzle slots that
+    are left empty (see 'optimize_puzzle_selection').
 
-    if len(line1) <= 11:
-        return line1 + '\n' + line2 + '\n' + line3
+    The 'candidates' are the shortest selected puzzle (as length and id) of
+    each category, None for categories without any. The shortest candidate
+    is repeated as often as the 'room' (slots below the maximum quota) of its
+    category allows, then the next shortest one, and so on. Thereby the
+    repeats need the fewest bytes possible.
 
-    # Try to split into 4 lines (need to start again since the 4th line may
-    # only accomodate 11 chars)
-    words = line.split()
-    lines = ['           ',
-             '             ',
-             '             ',
-             '           ']
-    for i in reversed(range(4)):
-        for word in reversed(words):
-            new_line = (word + ' ' + lines[i]).strip()
-            if len(new_line) <= LINE_LENGTHS[i]:
-                lines[i] = new_line
-                del words[-1]
-                continue
+    Returns:
+      The ids of the chosen candidates with their number of repeats, None if
+      there is not enough room.
+    """
+    chosen = []
+    for (_, uid), cat in sorted((candidate, cat) for cat, candidate in enumerate(candidates) if candidate is not None and room[cat] > 0):
+        if count == 0:
             break
+        repeat_count = min(count, room[cat])
+        chosen.append((uid, repeat_count))
+        count -= repeat_count
+    return chosen if count == 0 else None
 
-    if words == []:
-        return '\n'.join(lines)
 
-    # If even that didn’t work, we are not able to split the line correctly
-    raise ValueError('Line cannot be split automatically: ' + line)
+def sum_bytes(lst: list[bytes]) -> int:
+    return sum(len(item) for item in lst)
 
 
-def chars(words: list[str]) -> int:
+def build_puzzle_pointer_table(puzzles: list[bytes], first_pointer: int, byteorder: str) -> bytes:
     """
-    Get the number of characters of a string of the given words separated by spaces.
+    Build the pointer table for puzzles that are written one after another.
+
+    The first pointer is 'first_pointer'. Each further pointer is the previous
+    one increased by the length of the previous puzzle.
+
+    Args:
+      puzzles       (list[bytes]): the encoded puzzles to build the pointers for
+      first_pointer (int):         the pointer value of the first puzzle
+      byteorder     (str):         'big' or 'little', the byte order of the pointers in the ROM
+    Returns:
+      The pointer table with 2 bytes per puzzle.
+    Raises:
+      OverflowError: If a pointer does not fit into 2 bytes.
     """
-    return len(' '.join(words))
+    pointers = array('H', itertools.accumulate((len(puzzle) for puzzle in puzzles[:-1]), initial=first_pointer))
+    if byteorder != sys.byteorder:
+        pointers.byteswap()
+    return pointers.tobytes()
 
 
-def puzzle_fits(puzzle: list[str]) -> bool:
+def write_puzzles(plan: 'PatchPlan', puzzles: list[bytes], pointer_table: bytes) -> int:
     """
-    Check whether the given lines would fit as a puzzle.
+    Write the given puzzles into the puzzle area and the pointer table into the pointer area.
+
+    Returns:
+      The address after the last written puzzle.
+    Raises:
+      OverflowError: If the puzzles exceed the puzzle area.
+    """
+    puzzle_data = b''.join(puzzles)
+    if len(puzzle_data) > len(preset.puzzle_addr_range):
+        raise OverflowError(f"Puzzles are too big: {len(puzzle_data)} bytes for a {len(preset.puzzle_addr_range)} byte area.")
+
+    plan.write(preset.puzzle_addr_range.start,   puzzle_data)
+    plan.write(preset.puzzle_pointers_start_add, pointer_table)
+
+    return preset.puzzle_addr_range.start + len(puzzle_data)
+
+
+def read_player_names_file(players_file: str) -> list[str]:
+    player_names = []
+
+    with open(players_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+
+            player_name = line
+            if len(player_name) > preset.length_of_player_names:
+                log_wrn('Player name “' + player_name + '” is too long. Only ' + preset.length_of_player_names + ' characters are allowed.')
+                continue
+
+            player_names.append(player_name.upper())
+
+    return player_names
+
+
+def iter_puzzle_file(puzzlefile: str):
+    """
+    Read a puzzle file line by line.
+
+    Yields an empty 'CategoryWithPuzzles' for each category line and a
+    'Puzzle' (not wrapped yet) for each puzzle line of the current category.
+    """
+    with open(puzzlefile, 'r') as f:
+        category_name = None
+        category_idx = -1
+        for line in f:
+            line = line.strip().upper()
+            if line == '' or line.startswith('#'):
+                continue
+
+            category_match = re.search(PATTERN_CATEGORY_LINE, line)
+            if category_match is not None:
+                category_name = category_match.group(1)
+                category_idx += 1
+                yield CategoryWithPuzzles(category_name, [])
+                continue
+
+            yield Puzzle(category_name, category_idx, line)
+
+
+def read_puzzle_file(puzzlefile: str) -> list[CategoryWithPuzzles]:
+    categories = []  # a list of tuples: (category, [puzzles])
+
+    for item in iter_puzzle_file(puzzlefile):
+        if isinstance(item, CategoryWithPuzzles):
+            categories.append(item)
+        else:
+            categories[-1].puzzles.append(item)
+
+    return categories
+
+
+def sample_puzzle_file(puzzlefile: str, rng: random.Random) -> 'PuzzleSample':
+    """
+    Read a random sample of the puzzles of a puzzle file.
+
+    Unlike 'read_puzzle_file' this streams the file and keeps a reservoir
+    sample (see https://en.wikipedia.org/wiki/Reservoir_sampling) of
+    'PUZZLE_SAMPLE_FACTOR' times as many puzzles per category as the global
+    'preset' can hold. Only the puzzles that enter a reservoir are wrapped and
+    encoded, so the memory needed depends on the size of the ROM instead of
+    the size of the file.
+
+    In the family edition each category may fill the whole ROM. Its
+    reservoirs are therefore cut down afterwards to a uniform sample of the
+    puzzles of all categories.
+
+    The random choices are made with 'rng'.
+    """
+    if preset.puzzle_hack_function == 'family':
+        capacities = []
+        family_capacity = preset.no_of_puzzles * PUZZLE_SAMPLE_FACTOR
+    else:
+        capacities = [len(bounds) * PUZZLE_SAMPLE_FACTOR for bounds in preset.puzzle_category_ranges]
+        family_capacity = 0
+
+    names      = []
+    seen       = []  # the number of puzzles read per category
+    reservoirs = []  # the sampled puzzles per category, encoded for both editions
+    for item in iter_puzzle_file(puzzlefile):
+        if isinstance(item, CategoryWithPuzzles):
+            names.append(item.category_name)
+            seen.append(0)
+            reservoirs.append([])
+            capacity = capacities[len(names) - 1] if len(names) <= len(capacities) else family_capacity
+            continue
+
+        reservoir = reservoirs[-1]
+        if len(reservoir) < capacity:
+            slot = len(reservoir)
+        else:
+            slot = rng.randrange(seen[-1] + 1)
+            if slot >= capacity:
+                seen[-1] += 1
+                continue
+
+        # Puzzles that cannot be wrapped are not counted at all
+        sane_puzzles = sanitize_puzzles([item])
+        if not sane_puzzles:
+            continue
+        encoded_puzzle = (encode_family_puzzle(sane_puzzles[0]), encode_classic_puzzle(sane_puzzles[0]))
+        if slot == len(reservoir):
+            reservoir.append(encoded_puzzle)
+        else:
+            reservoir[slot] = encoded_puzzle
+        seen[-1] += 1
+
+    if preset.puzzle_hack_function == 'family':
+        # Draw how many of the sampled puzzles to take from each category
+        counts = [0] * len(names)
+        ends = list(itertools.accumulate(seen))
+        total = ends[-1] if ends else 0
+        for i in rng.sample(range(total), min(total, family_capacity)):
+            counts[bisect.bisect_right(ends, i)] += 1
+        reservoirs = [rng.sample(reservoir, count) for reservoir, count in zip(reservoirs, counts)]
+
+    for name, count, reservoir in zip(names, seen, reservoirs):
+        log_vbs('Sampled', len(reservoir), 'of', count, 'puzzles of category', name, 'from', puzzlefile)
+    return PuzzleSample(list(zip(names, reservoirs)))
+
+
+def split_puzzle_source(puzzles: pathlib.Path) -> tuple[pathlib.Path, str]:
+    """
+    Split the value of “--puzzles” into the file and the query (without the “?”).
+    """
+    path, _, query = str(puzzles).partition('?')
+    return (pathlib.Path(path), query)
+
+
+def read_puzzles(puzzles: pathlib.Path, sample: bool = False, rng: random.Random = None) -> 'list[CategoryWithPuzzles] | PuzzleCorpus | PuzzleSample':
+    """
+    Read the puzzles given by “--puzzles” from a puzzle file, a puzzle
+    database or a compiled puzzle corpus (detected by their headers).
+
+    With 'sample' only a random sample of a puzzle file is read (see
+    'sample_puzzle_file'). Puzzle databases and corpora are always read as
+    a whole, as they only read the puzzles that are actually needed anyway.
+
+    The random choices of samples and database queries with a “limit” are
+    made with 'rng' (default: a new unseeded 'random.Random').
+    """
+    rng = rng or random.Random()
+    puzzle_file, query = split_puzzle_source(puzzles)
+    with open(puzzle_file, 'rb') as f:
+        magic = f.read(len(SQLITE_MAGIC))
+
+    if magic == SQLITE_MAGIC:
+        return read_puzzle_db(puzzle_file, query, rng)
+    if query:
+        raise ValueError(f'Puzzle queries are only supported for puzzle databases, but {puzzle_file} is not a puzzle database.')
+    if magic.startswith(PUZZLE_CORPUS_MAGIC):
+        return PuzzleCorpus(puzzle_file)
+    if sample:
+        return sample_puzzle_file(puzzle_file, rng)
+    return read_puzzle_file(puzzle_file)
+
+
+def open_puzzle_db(db_file: pathlib.Path) -> sqlite3.Connection:
+    db = sqlite3.connect(db_file)
+    db.executescript(PUZZLE_DB_SCHEMA)
+    version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    if version is None:
+        db.execute("INSERT INTO meta VALUES ('version', ?)", (str(PUZZLE_DB_VERSION),))
+    elif int(version[0]) != PUZZLE_DB_VERSION:
+        raise ValueError(f'Puzzle database {db_file} has version {version[0]}, but version {PUZZLE_DB_VERSION} is required. Please import the puzzles again into a new database.')
+    return db
+
+
+def import_puzzle_files(db_file: pathlib.Path, puzzle_files: list[pathlib.Path], tags: list[str]) -> None:
+    """
+    Import the puzzles of the given puzzle files into a puzzle database.
+
+    Each puzzle is stored with its category, its text, its layout (see
+    'force_wrap' and 'auto_wrap') and the length of its encoding for the
+    family and the classic edition, so that builds can select puzzles by
+    indexed queries (see 'read_puzzle_db') instead of parsing and wrapping
+    the whole corpus. Puzzles that are already in the database get the given
+    'tags' added.
+
+    The layouts depend on the line lengths of the global 'preset'.
+    """
+    with open_puzzle_db(db_file) as db:
+        line_lengths = json.dumps(preset.length_of_puzzles)
+        stored_line_lengths = db.execute("SELECT value FROM meta WHERE key = 'line_lengths'").fetchone()
+        if stored_line_lengths is None:
+            db.execute("INSERT INTO meta VALUES ('line_lengths', ?)", (line_lengths,))
+        elif stored_line_lengths[0] != line_lengths:
+            raise ValueError(f'Puzzle database {db_file} contains layouts for the line lengths {stored_line_lengths[0]}, not for {line_lengths}.')
+
+        for puzzle_file in puzzle_files:
+            imported = unfit = 0
+            for category in read_puzzle_file(puzzle_file):
+                for puzzle in category.puzzles:
+                    try:
+                        layout = force_wrap(puzzle.puzzle) if '@' in puzzle.puzzle else auto_wrap(puzzle.puzzle)
+                        laid_out = Puzzle(puzzle.category, puzzle.category_idx, layout)
+                        lengths = (len(encode_family_puzzle(laid_out)), len(encode_classic_puzzle(laid_out)))
+                    except ValueError:
+                        layout, lengths = None, (None, None)
+                        unfit += 1
+
+                    db.execute('INSERT OR IGNORE INTO puzzles (category, text, layout, family_length, classic_length, source) VALUES (?, ?, ?, ?, ?, ?)',
+                               (puzzle.category, puzzle.puzzle, layout, *lengths, str(puzzle_file)))
+                    if tags:
+                        puzzle_id = db.execute('SELECT id FROM puzzles WHERE category = ? AND text = ?', (puzzle.category, puzzle.puzzle)).fetchone()[0]
+                        db.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?)', [(puzzle_id, tag) for tag in tags])
+                    imported += 1
+            log_nfo('Imported', imported, 'puzzles from', puzzle_file, 'of which', unfit, 'do not fit on the board.')
+    db.close()
+
+
+def read_puzzle_db(db_file: pathlib.Path, query: str, rng: random.Random) -> list[CategoryWithPuzzles]:
+    """
+    Select puzzles from a puzzle database (see 'import_puzzle_files').
+
+    The query has the form of a URL query string with the optional keys:
+      - category:   comma separated categories to select (in the order of
+                    the categories in the ROM, default: all in the order of
+                    their import)
+      - max_length: the maximum length of the encoded puzzles (for the
+                    edition of the global 'preset')
+      - tag:        comma separated tags, of which the puzzles need any
+      - limit:      the maximum number of puzzles per category, which are
+                    chosen randomly by 'rng'
+
+    Puzzles that don't fit on the board are never selected. The selected
+    puzzles are returned with their precomputed layout.
+    """
+    params = {key: ','.join(values) for key, values in parse_qs(query, strict_parsing=bool(query)).items()}
+    unknown_params = set(params) - {'category', 'max_length', 'tag', 'limit'}
+    if unknown_params:
+        raise ValueError(f'Unknown puzzle query parameters: {", ".join(sorted(unknown_params))}')
+
+    db = open_puzzle_db(db_file)
+    try:
+        stored_line_lengths = db.execute("SELECT value FROM meta WHERE key = 'line_lengths'").fetchone()
+        if stored_line_lengths is not None and stored_line_lengths[0] != json.dumps(preset.length_of_puzzles):
+            raise ValueError(f'Puzzle database {db_file} contains layouts for the line lengths {stored_line_lengths[0]}, not for {preset.length_of_puzzles}.')
+
+        if 'category' in params:
+            categories = [category.strip().upper() for category in params['category'].split(',')]
+        else:
+            categories = [row[0] for row in db.execute('SELECT category FROM puzzles GROUP BY category ORDER BY MIN(id)')]
+
+        length_column = 'classic_length' if preset.puzzle_hack_function == 'classic' else 'family_length'
+        conditions = ['category = ?', 'layout IS NOT NULL']
+        condition_args = []
+        if 'max_length' in params:
+            conditions.append(f'{length_column} <= ?')
+            condition_args.append(int(params['max_length']))
+        if 'tag' in params:
+            tags = params['tag'].split(',')
+            conditions.append(f'id IN (SELECT puzzle_id FROM tags WHERE tag IN ({", ".join("?" * len(tags))}))')
+            condition_args.extend(tags)
+        where = ' AND '.join(conditions)
+
+        result = []
+        for category_idx, category in enumerate(categories):
+            ids = [row[0] for row in db.execute(f'SELECT id FROM puzzles WHERE {where} ORDER BY id', (category, *condition_args))]
+            if 'limit' in params and len(ids) > int(params['limit']):
+                ids = sorted(rng.sample(ids, int(params['limit'])))
+
+            puzzles = []
+            for chunk_start in range(0, len(ids), 500):
+                chunk = ids[chunk_start:chunk_start + 500]
+                rows = db.execute(f'SELECT layout FROM puzzles WHERE id IN ({", ".join("?" * len(chunk))}) ORDER BY id', chunk)
+                puzzles.extend(Puzzle(category, category_idx, layout) for (layout,) in rows)
+            log_vbs('Selected', len(puzzles), 'puzzles of category', category, 'from', db_file)
+            result.append(CategoryWithPuzzles(category, puzzles))
+    finally:
+        db.close()
+
+    return result
+
+
+def compile_puzzles(puzzles: list[CategoryWithPuzzles], outfile: pathlib.Path, force: bool = False) -> None:
+    """
+    Compile the given puzzles into a puzzle corpus (see 'PuzzleCorpus').
+
+    The puzzles are wrapped and encoded for both editions with the line
+    lengths of the global 'preset'. Puzzles that don't fit on the board are
+    left out.
+    """
+    categories = b''
+    family_puzzles = []
+    classic_puzzles = []
+    for category in puzzles:
+        name = category.category_name.encode()
+        if len(name) > PUZZLE_CORPUS_CATEGORY.size - 8:
+            raise ValueError(f'Category name “{category.category_name}” is too long for a puzzle corpus.')
+        sane_puzzles = sanitize_puzzles(category.puzzles)
+        categories += PUZZLE_CORPUS_CATEGORY.pack(name, len(family_puzzles), len(sane_puzzles))
+        family_puzzles.extend(encode_family_puzzle(puzzle) for puzzle in sane_puzzles)
+        classic_puzzles.extend(encode_classic_puzzle(puzzle) for puzzle in sane_puzzles)
+
+    header = PUZZLE_CORPUS_HEADER.pack(PUZZLE_CORPUS_MAGIC, PUZZLE_CORPUS_VERSION, *preset.length_of_puzzles, len(puzzles), len(family_puzzles))
+    sections = [header, categories]
+    for encoded_puzzles in (family_puzzles, classic_puzzles):
+        offsets = array('I', itertools.accumulate((len(puzzle) for puzzle in encoded_puzzles), initial=0))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        sections.append(offsets.tobytes())
+    sections.append(b''.join(family_puzzles))
+    sections.append(b''.join(classic_puzzles))
+
+    write_rom_to_file(b''.join(sections), outfile, force)
+    log_nfo('Compiled', len(family_puzzles), 'puzzles in', len(puzzles), 'categories into', outfile)
+
+
+class PuzzleCorpus:
+    """
+    A compiled puzzle corpus (see 'compile_puzzles') mapped into memory.
+
+    The puzzles are already wrapped and encoded for both editions. They are
+    sliced directly from the map by their offsets, without any 'Puzzle'
+    objects being created.
+
+    The map should be closed (e.g. by a 'with' block) once the puzzles are
+    taken from it. The sliced puzzles stay valid after that.
+    """
+    def __init__(self, corpus_file: pathlib.Path):
+        with open(corpus_file, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, *line_lengths, category_count, puzzle_count = PUZZLE_CORPUS_HEADER.unpack_from(self._map)
+        if magic != PUZZLE_CORPUS_MAGIC or version != PUZZLE_CORPUS_VERSION:
+            self._map.close()
+            raise ValueError(f'{corpus_file} is no puzzle corpus of version {PUZZLE_CORPUS_VERSION}. Please compile it again.')
+        if tuple(line_lengths) != tuple(preset.length_of_puzzles):
+            self._map.close()
+            raise ValueError(f'Puzzle corpus {corpus_file} is compiled for the line lengths {tuple(line_lengths)}, not for {preset.length_of_puzzles}.')
+
+        self.categories = []  # tuples of category name and the range of its puzzles
+        pos = PUZZLE_CORPUS_HEADER.size
+        for _ in range(category_count):
+            name, first, count = PUZZLE_CORPUS_CATEGORY.unpack_from(self._map, pos)
+            self.categories.append((name.rstrip(b'\x00').decode(), range(first, first + count)))
+            pos += PUZZLE_CORPUS_CATEGORY.size
+
+        index_size = (puzzle_count + 1) * 4
+        self._family_offsets  = self._offsets(pos, puzzle_count)
+        self._classic_offsets = self._offsets(pos + index_size, puzzle_count)
+        self._family_start    = pos + 2 * index_size
+        self._classic_start   = self._family_start + self._family_offsets[-1]
+
+    def __enter__(self) -> 'PuzzleCorpus':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Close the map of the corpus. No puzzles can be taken from it afterwards.
+        """
+        # The map can only be closed once no views of it are left
+        for offsets in (self._family_offsets, self._classic_offsets):
+            if isinstance(offsets, memoryview):
+                offsets.release()
+        self._map.close()
+
+    def _offsets(self, pos: int, puzzle_count: int):
+        if sys.byteorder == 'little':
+            return memoryview(self._map)[pos:pos + (puzzle_count + 1) * 4].cast('I')
+        offsets = array('I', self._map[pos:pos + (puzzle_count + 1) * 4])
+        offsets.byteswap()
+        return offsets
+
+    def family_puzzles(self, puzzle_range: range = None) -> list[bytes]:
+        """
+        Get the encoded family edition puzzles of the given range (default: all).
+        """
+        return self._slice(self._family_start, self._family_offsets, puzzle_range)
+
+    def classic_puzzles(self, puzzle_range: range = None) -> list[bytes]:
+        """
+        Get the encoded classic edition puzzles of the given range (default: all).
+        """
+        return self._slice(self._classic_start, self._classic_offsets, puzzle_range)
+
+    def _slice(self, start: int, offsets, puzzle_range: range) -> list[bytes]:
+        if puzzle_range is None:
+            puzzle_range = range(len(offsets) - 1)
+        data = self._map
+        return [data[start + offsets[i]:start + offsets[i + 1]] for i in puzzle_range]
+
+
+class PuzzleSample:
+    """
+    A random sample of the puzzles of a puzzle file (see 'sample_puzzle_file').
+
+    Like a 'PuzzleCorpus' the puzzles are already wrapped and encoded for
+    both editions.
+    """
+    def __init__(self, categories: list[tuple[str, list[tuple[bytes, bytes]]]]):
+        self.categories = []  # tuples of category name and the range of its puzzles
+        self._family_puzzles  = []
+        self._classic_puzzles = []
+        for name, encoded_puzzles in categories:
+            first = len(self._family_puzzles)
+            self.categories.append((name, range(first, first + len(encoded_puzzles))))
+            for family_puzzle, classic_puzzle in encoded_puzzles:
+                self._family_puzzles.append(family_puzzle)
+                self._classic_puzzles.append(classic_puzzle)
+
+    def family_puzzles(self, puzzle_range: range = None) -> list[bytes]:
+        """
+        Get the encoded family edition puzzles of the given range (default: all).
+        """
+        if puzzle_range is None:
+            return list(self._family_puzzles)
+        return self._family_puzzles[puzzle_range.start:puzzle_range.stop]
+
+    def classic_puzzles(self, puzzle_range: range = None) -> list[bytes]:
+        """
+        Get the encoded classic edition puzzles of the given range (default: all).
+        """
+        if puzzle_range is None:
+            return list(self._classic_puzzles)
+        return self._classic_puzzles[puzzle_range.start:puzzle_range.stop]
+
+
+def read_title_text_file(file: str) -> list[str]:
+    with open(file, 'r') as f:
+        content = f.read()
+        lines = content.splitlines()
+
+        # Filter out all lines that are not part of the actual text.
+        lines = filter_title_text_lines(lines)
+
+        # Cut off trailing comments
+        lines = [line.split('#')[0] for line in lines]
+
+        # Cut off trailing whitespace
+        lines = [line.rstrip() for line in lines]
+
+        return lines
+
+
+def read_marquee_text_file(file: str) -> list[str]:
+    with open(file, 'r') as f:
+        content = f.read()
+        lines = content.splitlines()
+
+        # Filter out all comment lines
+        lines = [line for line in lines if not line.startswith('#')]
+
+        # Filter out all empty lines
+        lines = [line for line in lines if line != '']
+
+        return lines
+
+
+def force_wrap(line: str) -> str:
+    """
+    Wrap a string at predefined positions.
+    The character indicating the wrap position is the '@'.
+
+    Raises:
+        ValueError: If the line is incorrecly split.
+    """
+    words = line.split('@')
+    if puzzle_fits(words):
+        return '\n'.join(words)
+    else:
+        raise ValueError('Line is incorrectly split: ' + line)
+
+
+def auto_wrap(line: str) -> str:
+    """
+    Automatically wraps the given string into up to 4 lines of length 11,13,13,11.
+
+    See 'layout_puzzle' for how the lines are chosen.
+
+    Returns (str):
+      The string with 1 to 4 lines into which the string was split.
+
+    Raises:
+      ValueError: If the string could not be split to fit into the defined lengths.
+    """
+    return layout_puzzle(line, preset.length_of_puzzles)[0]
+
+
+@lru_cache(maxsize=65536)
+def layout_puzzle(line: str, line_lengths: tuple[int, int, int, int]) -> tuple[str, int]:
+    """
+    Find the best layout of the given string on the puzzle board.
+
+    The board has 4 rows with the given 'line_lengths'. Puzzles with less
+    lines use the rows given in 'PUZZLE_BOARD_ROWS'. The layouts in
+    'PUZZLE_LAYOUTS' are tried in order and the first one that fits is
+    chosen. Within a layout the words are split with the most words in the
+    last line (then in the second to last line, etc.). Thereby the result is
+    the same as that of the former greedy 'auto_wrap'.
+
+    The layout is found via dynamic programming, so every string that fits
+    on the board is found. The results are cached per string, therefore
+    duplicate puzzles are only laid out once.
+
+    Returns (tuple[str, int]):
+      The string with 1 to 4 lines into which the string was split and the
+      number of bytes it needs when encoded (without the category byte of
+      the family edition).
+
+    Raises:
+      ValueError: If the string could not be split to fit into the defined lengths.
+    """
+    words = line.split()
+
+    for line_count, rows in PUZZLE_LAYOUTS:
+        lengths = [line_lengths[row] for row in rows]
+
+        # fits_prefix[k][i]: whether words[:i] can be laid out in the first
+        # k lines (each of them not empty)
+        fits_prefix = [[False] * (len(words) + 1) for _ in range(len(rows) + 1)]
+        fits_prefix[0][0] = True
+        for k in range(1, len(rows) + 1):
+            for i in range(1, len(words) + 1):
+                fits_prefix[k][i] = any(fits_prefix[k-1][j] and chars(words[j:i]) <= lengths[k-1]
+                                        for j in range(i))
+
+        if not fits_prefix[len(rows)][len(words)]:
+            continue
+
+        # Going back from the last line, put as many words as possible into
+        # each line, as long as the remaining words still fit.
+        word_lines = []
+        end = len(words)
+        for k in reversed(range(len(rows))):
+            start = min(j for j in range(end)
+                        if fits_prefix[k][j] and chars(words[j:end]) <= lengths[k])
+            word_lines.insert(0, ' '.join(words[start:end]))
+            end = start
+
+        row_words = dict(zip(rows, word_lines))
+        lines = [row_words.get(row, ' ' * line_lengths[row]) for row in PUZZLE_BOARD_ROWS[line_count]]
+
+        return ('\n'.join(lines), sum(len(l) for l in lines))
+
+    # If even that didn’t work, we are not able to split the line correctly
+    raise ValueError('Line cannot be split automatically: ' + line)
+
+
+def chars(words: list[str]) -> int:
+    """
+    Get the number of characters of a string of the given words separated by spaces.
+    """
+    return len(' '.join(words))
+
+
+def puzzle_fits(puzzle: list[str]) -> bool:
+    """
+    Check whether the given lines would fit as a puzzle.
     """
 
     if len(puzzle) == 1:
@@ -863,21 +2149,20 @@ def encode_family_puzzle(puzzle: Puzzle):
 
 
 def encode_str(s: str) -> bytes:
-    result = []
-    for c in s:
-        result.append(ord(c))
-    return bytes(result)
+    return s.encode('latin-1')
 
 
-def tbl_encode(s: str, n: int, tbl: dict[str, int]) -> bytes:
-    result = [0x00] * n
-    for i, c in enumerate(s):
-        hex_value = tbl[c]
-        result[i] = hex_value
-    return bytes(result)
+def tbl_encode(s: str, n: int, tbl: 'TblCodec') -> bytes:
+    encoded = tbl.encode(s)
+    if len(encoded) > n:
+        raise IndexError(f"Error: Text “{s}” is too long: {len(encoded)} bytes for a {n} byte area.")
+    return encoded.ljust(n, b'\x00')
+
 
+def encode_title_text(lines: list[str], n: int, tbl: 'TblCodec') -> bytes:
+    # Check all lines at once to report all characters that cannot be encoded
+    tbl.check(''.join(lines).upper())
 
-def encode_title_text(lines: list[str], n: int, tbl: dict[str, int]) -> bytes:
     result = []
 
     for i, line in enumerate(lines):
@@ -890,11 +2175,7 @@ def encode_title_text(lines: list[str], n: int, tbl: dict[str, int]) -> bytes:
         line_offset = calc_title_row_offset(i, h_idx)
         result.append(line_offset[0])
         result.append(line_offset[1])
-        for c in text_in_line:
-            if c == '\n':
-                result[-1] |= 0x80  # Mark the end of a line on the last character
-            else:
-                result.append(tbl[c.upper()])
+        result.extend(tbl.encode(text_in_line.upper()))
         result[-1] |= 0x80  # Mark the end of a line on the last character
 
     result[-1] |= 0x80  # The last character must be indicated as the end of the line
@@ -907,7 +2188,7 @@ def encode_title_text(lines: list[str], n: int, tbl: dict[str, int]) -> bytes:
     # Appending the zerofill leads to strange glitches. Putting them at the
     # beginning works (most of the time…)
     #result.extend([tbl[' ']] * diff)
-    zerofill= [tbl[' ']] * diff
+    zerofill= [tbl.mapping[' ']] * diff
     zerofill[0:2] = [0x23, 0x00]
     zerofill[-1] |= 0x80
     result = zerofill + result
@@ -915,7 +2196,10 @@ def encode_title_text(lines: list[str], n: int, tbl: dict[str, int]) -> bytes:
     return bytes(result)
 
 
-def encode_marquee_text(lines: list[str], n: int, tbl: dict[str, int]) -> bytes:
+def encode_marquee_text(lines: list[str], n: int, tbl: 'TblCodec') -> bytes:
+    # Check all text lines at once to report all characters that cannot be encoded
+    tbl.check(''.join(line for line in lines if line[0] != '$').upper())
+
     result = []
 
     for line in lines:
@@ -924,8 +2208,7 @@ def encode_marquee_text(lines: list[str], n: int, tbl: dict[str, int]) -> bytes:
             hex_values = [int(b, 16) for b in bytevalues]
             result.extend(hex_values)
         else:
-            for c in line:
-                result.append(tbl[c.upper()])
+            result.extend(tbl.encode(line.upper()))
 
     result.append(0x00)   # Text end marker
 
@@ -981,6 +2264,174 @@ def read_tbl_file(f: str) -> dict[str, int]:
     return result
 
 
+class TblCodec:
+    """
+    Encodes text according to the mapping of a TBL file.
+
+    The mapping is compiled into a translation table once, so that whole
+    strings are encoded at once instead of character by character.
+    Use 'tbl_codec' to get the (cached) codec for a TBL file.
+    """
+    def __init__(self, tbl_file: str, mapping: dict[str, int]):
+        self.tbl_file = tbl_file
+        self.mapping  = mapping
+        # Translate each character to the character with the code point of
+        # its byte value. Encoding the result as latin-1 gives the bytes.
+        self._table   = str.maketrans({printable: chr(value) for printable, value in mapping.items()})
+
+    def unmappable_chars(self, s: str) -> list[str]:
+        """
+        Get all characters of the given string that are not defined in the TBL file.
+        """
+        return sorted(set(s).difference(self.mapping))
+
+    def check(self, s: str) -> None:
+        """
+        Raises:
+          ValueError: If the given string contains characters that are not
+                      defined in the TBL file. All of them are listed.
+        """
+        unmappable = self.unmappable_chars(s)
+        if unmappable:
+            chars = ', '.join(f'“{c}”' for c in unmappable)
+            raise ValueError(f'Characters not defined in {self.tbl_file}: {chars}')
+
+    def encode(self, s: str) -> bytes:
+        """
+        Encode the given string.
+
+        Raises:
+          ValueError: If the given string contains characters that are not
+                      defined in the TBL file.
+        """
+        self.check(s)
+        return s.translate(self._table).encode('latin-1')
+
+
+@cache
+def tbl_codec(tbl_file: str) -> TblCodec:
+    """
+    Get the codec for the given TBL file. Each file is only read once.
+    """
+    return TblCodec(tbl_file, read_tbl_file(tbl_file))
+
+
+def load_image(image_path: pathlib.Path) -> ConvertedImage:
+    """
+    Get the given image converted to NES tiles.
+
+    Each image is only converted once. Further calls with the same path
+    return the same object, which therefore must not be modified.
+    """
+    if image_path not in image_cache:
+        image_cache[image_path] = convert_image(image_path)
+    return image_cache[image_path]
+
+
+def convert_image(image_path: pathlib.Path) -> ConvertedImage:
+    """
+    Convert the given image to NES tiles and a deduplicated tilemap.
+
+    The result is taken from the on-disk cache in 'chr_cache_dir' if the
+    image has been converted before. Otherwise it is converted and stored in
+    that cache.
+    """
+    with open(image_path, 'rb') as f:
+        image_data = f.read()
+
+    cache_file = None
+    if chr_cache_dir is not None:
+        key = sha1(image_data + CHR_CACHE_MAGIC + bytes([CHR_CACHE_VERSION])).hexdigest()
+        cache_file = chr_cache_dir / (key + '.chr')
+        image = _read_chr_cache_file(cache_file)
+        if image is not None:
+            log_dbg('Using cached tiles for', image_path)
+            return image
+
+    tiles = image_to_nes(image_path)
+    unique_tiles, tilemap = generate_tilemap2(tiles)
+    image = ConvertedImage(tiles, list(unique_tiles.values()), tilemap)
+
+    if cache_file is not None:
+        _write_chr_cache_file(cache_file, image)
+
+    return image
+
+
+def _read_chr_cache_file(cache_file: pathlib.Path) -> ConvertedImage:
+    """
+    Read a converted image from the cache.
+
+    Returns:
+      The converted image or None if it is not (validly) cached.
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            data = f.read()
+        # Mark the entry as recently used for the LRU eviction
+        os.utime(cache_file)
+    except OSError:
+        return None
+
+    header_size = len(CHR_CACHE_MAGIC) + 8
+    if not data.startswith(CHR_CACHE_MAGIC) or len(data) < header_size:
+        return None
+    tile_count, unique_count = struct.unpack_from('<II', data, len(CHR_CACHE_MAGIC))
+    if len(data) != header_size + (tile_count + unique_count) * 16 + tile_count * 2:
+        return None
+
+    i = header_size
+    tiles = [data[i + x*16:i + x*16 + 16] for x in range(tile_count)]
+    i += tile_count * 16
+    unique_tiles = [data[i + x*16:i + x*16 + 16] for x in range(unique_count)]
+    i += unique_count * 16
+    tilemap = list(struct.unpack_from(f'<{tile_count}H', data, i))
+
+    return ConvertedImage(tiles, unique_tiles, tilemap)
+
+
+def _write_chr_cache_file(cache_file: pathlib.Path, image: ConvertedImage) -> None:
+    data = CHR_CACHE_MAGIC \
+         + struct.pack('<II', len(image.tiles), len(image.unique_tiles)) \
+         + b''.join(image.tiles) \
+         + b''.join(image.unique_tiles) \
+         + struct.pack(f'<{len(image.tilemap)}H', *image.tilemap)
+
+    # A failing cache must never fail the build
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that concurrent builds never
+        # see a partially written entry.
+        tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, cache_file)
+        _evict_chr_cache(cache_file.parent, CHR_CACHE_MAX_SIZE)
+    except OSError as err:
+        log_wrn('Cannot write to the cache of converted images:', err)
+
+
+def _evict_chr_cache(cache_dir: pathlib.Path, max_size: int) -> None:
+    """
+    Remove the least recently used entries until the cache is at most 'max_size' bytes.
+    """
+    entries = []
+    for entry in cache_dir.glob('*.chr'):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue  # removed by a concurrent build
+        entries.append((stat.st_mtime, stat.st_size, entry))
+
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if cache_size <= max_size:
+            break
+        log_dbg('Evicting cached tiles', entry)
+        entry.unlink(missing_ok=True)
+        cache_size -= size
+
+
 def image_to_nes(image_path: pathlib.Path) -> list[bytes]:
     """
     Convert an image (usually an indexed .png with at max 4 colors) to the
@@ -994,10 +2445,38 @@ def image_to_nes(image_path: pathlib.Path) -> list[bytes]:
       A list of byte sequences. Each tile is represented by two byte
       sequences of length 16. The bytes in that list can directly be
       written to rom sequentially.
+
+    If NumPy is installed, the conversion is done vectorized (which is much
+    faster for big images). Otherwise each pixel is converted by python.
     """
     with Image.open(image_path) as im:
         im = im.convert('P')
-    pix_data = tuple(im.getdata())
+
+    if np is not None:
+        return _image_to_nes_numpy(im)
+    else:
+        return _image_to_nes_python(im)
+
+
+def _image_to_nes_numpy(im: Image.Image) -> list[bytes]:
+    twidth  = im.width  // 8
+    theight = im.height // 8
+
+    # Cut the image into tiles of 8x8 pixels, ordered row by row
+    pix_data = np.asarray(im, dtype=np.uint8)[:theight * 8, :twidth * 8]
+    pix_data = pix_data.reshape(theight, 8, twidth, 8).swapaxes(1, 2).reshape(-1, 8, 8)
+
+    # Each pixel row of a tile becomes one byte per bitplane. The first 8
+    # bytes of a tile hold the low bits, the second 8 bytes the high bits.
+    low_plane  = np.packbits(pix_data & 1,        axis=2).reshape(-1, 8)
+    high_plane = np.packbits((pix_data >> 1) & 1, axis=2).reshape(-1, 8)
+    tile_data  = np.concatenate((low_plane, high_plane), axis=1).tobytes()
+
+    return [tile_data[i:i+16] for i in range(0, len(tile_data), 16)]
+
+
+def _image_to_nes_python(im: Image.Image) -> list[bytes]:
+    pix_data = im.tobytes()
     tile_count = len(pix_data) // 64
     twidth = im.width // 8
 
@@ -1040,7 +2519,9 @@ def generate_tilemap(tiles: list[bytes]):
     return (no_dup_tiles, tilemap)
 
 
-def generate_tilemap2(tiles: list[bytes], no_dup_tiles: dict[bytes, int] = {}):
+def generate_tilemap2(tiles: list[bytes], no_dup_tiles: dict[bytes, int] = None):
+    if no_dup_tiles is None:
+        no_dup_tiles = {}
     tilemap      = []
 
     next_tindex = 0
@@ -1058,8 +2539,8 @@ def generate_tilemap2(tiles: list[bytes], no_dup_tiles: dict[bytes, int] = {}):
     return (no_dup_tiles, tilemap)
 
 
-def replace_tiles(rom: bytearray, image_path: pathlib.Path, addr_range: range):
-    tiles = image_to_nes(image_path)
+def replace_tiles(plan: 'PatchPlan', image_path: pathlib.Path, addr_range: range):
+    tiles = load_image(image_path).tiles
 
     # Check that the tiles from the image don’t exceed the given range
     if len(tiles) * 16 > len(addr_range):
@@ -1068,176 +2549,879 @@ def replace_tiles(rom: bytearray, image_path: pathlib.Path, addr_range: range):
 
     log_vbs('Writing tiles with ', len(tiles) * 16, 'bytes into addr range of ', len(addr_range), 'bytes.')
 
-    i= addr_range.start
-    for t in tiles:
-        rom[i:i+len(t)] = t
-        i += len(t)
+    plan.write(addr_range.start, b''.join(tiles))
 
 
-def replace_tiles_and_map(rom: bytearray, image_path: pathlib.Path, tiles_addr_range: range, tilemap_addr_range: range) -> None:
-    tiles         = image_to_nes(image_path)
-    tiles_and_map = generate_tilemap2(tiles)
-    tiles         = tiles_and_map[0]
-    tilemap       = tiles_and_map[1]
+def replace_tiles_and_map(plan: 'PatchPlan', image_path: pathlib.Path, tiles_addr_range: range, tilemap_addr_range: range) -> None:
+    image         = load_image(image_path)
+    tiles         = image.unique_tiles
+    tilemap       = image.tilemap
 
     if len(tiles) * 16 > len(tiles_addr_range):
         print(f"Error: Too many tiles: {len(tiles)} tiles with {len(tiles) * 16} bytes for a {len(tiles_addr_range)} byte area.")
         sys.exit(1)
 
-    i= tiles_addr_range.start
-    for x in range(0, len(tiles)):
-        tile = tiles[x]
-        rom[i:i+len(tile)] = tile
-        i += len(tile)
+    plan.write(tiles_addr_range.start,   b''.join(tiles))
+    plan.write(tilemap_addr_range.start, bytes(b+1 for b in tilemap))
 
-    i= tilemap_addr_range.start
-    for b in tilemap:
-        rom[i] = b+1
-        i += 1
 
-
-def replace_palette(rom: bytearray, palette: tuple[int, int, int], addr: int):
+def replace_palette(plan: 'PatchPlan', palette: tuple[int, int, int], addr: int):
     palette = ast.literal_eval(palette)
 
     if len(palette) != 3:
         raise ValueError('Given palette must be a tuple of exactly 3 values. ', len(palette), 'were given.')
 
-    rom[addr:addr+3] = palette
+    plan.write(addr, bytes(palette))
 
 
-if __name__ == "__main__":
-    cmd_args = parse_arguments()
-    if cmd_args.loglevel:
-        log_level = LOG_LEVELS_ORDER.index(cmd_args.loglevel)
+@cache
+def load_custom_hacks(custom_hacks_file: pathlib.Path) -> list:
+    """
+    Execute the given custom hacks script and return its list 'custom_hacks'.
 
-    tbl = read_tbl_file(TBL_FILE)
-    rom = read_rom_from_file(cmd_args.romfile)
-    new_rom = bytearray(rom)
-    if cmd_args.preset:
-        preset = PRESETS[cmd_args.preset]
-    else:
-        preset = autodetect_preset(rom)
+    The script is only executed once per path. Subsequent calls (e.g. for
+    further variants in a batch build) return the already loaded list.
+    """
+    with open(custom_hacks_file, 'r') as f:
+        hack_src = f.read()
+    # Attention! We execute arbitrary code here! Do not execute
+    # untrusted code!
+    hack_globals = {}
+    exec(hack_src, hack_globals)
+    return hack_globals['custom_hacks']
+
+
+def apply_custom_hacks(plan: 'PatchPlan', custom_hacks: list) -> None:
+    for hack in custom_hacks:
+        # The hack classes are defined in the custom hacks script itself,
+        # therefore we can only compare them by name.
+        hack_type = type(hack).__name__
+        with trace_span(hack.msg, 'custom_hack', type=hack_type):
+            if hack_type == 'ReplaceBytesHack':
+                if len(hack.addr_range) != len(hack.new_bytes):
+                    raise ValueError(f'Number of bytes to write must be equal to the addr range. {len(hack.new_bytes)} bytes, {len(hack.addr_range)} addr range')
+                plan.write(hack.addr_range.start, hack.new_bytes)
+            elif hack_type == 'ReplaceSingleBytesHack':
+                for addr, value in hack.new_bytes.items():
+                    plan.write_byte(addr, value)
+            elif hack_type == 'ReplaceTilesHack':
+                replace_tiles(plan, hack.image_path, hack.addr_range)
+            elif hack_type == 'ReplaceTilesAndMapHack':
+                replace_tiles_and_map(plan, hack.image_path, hack.tiles_addr_range, hack.tilemap_addr_range)
+            elif hack_type == 'ReplaceTblTextHack':
+                encoded_text = tbl_encode(hack.text.upper(), len(hack.text), tbl)
+                if len(encoded_text) != len(hack.addr_range):
+                    raise ValueError(f'Number of characters to write must be equal to the length of the addr range. text length={len(encoded_text)} ({hack.text}), byte range={len(hack.addr_range)}')
+                plan.write(hack.addr_range.start, encoded_text)
+            else:
+                raise ValueError('Unsupported hack type: '+str(type(hack)))
+
+
+class Patch:
+    """
+    A byte sequence to write to a specific offset of the ROM.
+    """
+    __slots__ = ('offset', 'data', 'stage')
+
+    def __init__(self, offset: int, data: bytes, stage: str):
+        self.offset = offset
+        self.data   = data
+        self.stage  = stage  # the name of the stage that created this patch
 
-    if cmd_args.puzzles:
+    def __repr__(self):
+        return f'Patch(0x{self.offset:05x}, {len(self.data)} bytes, {self.stage})'
+
+
+class PatchPlan:
+    """
+    An ordered list of patches to apply to a ROM.
+
+    The stages of a build don’t write into the ROM directly, but into a
+    patch plan. Each patch records the stage that wrote it (the current
+    'stage' of the plan). The plan can then be inspected and is applied in
+    one go by 'apply'. Later patches win over earlier ones where they
+    overlap.
+    """
+    def __init__(self):
+        self.patches         = []
+        self.stage           = None
+        self.stage_durations = {}     # the seconds each stage took to run
+        self.reused_stages   = set()  # the stages whose patches were reused from a previous build
+        self.puzzle_repeats  = None   # the number of puzzle slots filled with repeated puzzles, see 'select_puzzles'
+        self.puzzle_leftover_bytes = None  # the number of bytes left over in the puzzle area
+        self.seed            = None   # the seed of the build, see 'build_patch_plan'
+        self.stage_seeds     = {}     # the seed each random stage was run with, see 'derive_stage_seed'
+        self.rng             = random.Random()  # the random number generator of the current stage (if it is random)
+
+    def write(self, offset: int, data: bytes) -> None:
+        if len(data) > 0:
+            self.patches.append(Patch(offset, bytes(data), self.stage))
+
+    def write_byte(self, offset: int, value: int) -> None:
+        self.write(offset, bytes([value]))
+
+    def runs(self) -> list[tuple[int, bytes]]:
+        """
+        Coalesce the patches into contiguous runs.
+
+        Overlapping and adjacent patches are merged into a single run.
+
+        Returns:
+          The runs as tuples of offset and data, ordered by offset.
+        """
+        runs = []
+        cluster = []
+        cluster_end = 0
+        for idx in sorted(range(len(self.patches)), key=lambda idx: self.patches[idx].offset):
+            patch = self.patches[idx]
+            patch_end = patch.offset + len(patch.data)
+            if cluster and patch.offset <= cluster_end:
+                cluster.append(idx)
+                cluster_end = max(cluster_end, patch_end)
+            else:
+                if cluster:
+                    runs.append(self._merge(cluster))
+                cluster = [idx]
+                cluster_end = patch_end
+        if cluster:
+            runs.append(self._merge(cluster))
+        return runs
+
+    def _merge(self, cluster: list[int]) -> tuple[int, bytes]:
+        if len(cluster) == 1:
+            patch = self.patches[cluster[0]]
+            return (patch.offset, patch.data)
+
+        start = min(self.patches[idx].offset for idx in cluster)
+        end   = max(self.patches[idx].offset + len(self.patches[idx].data) for idx in cluster)
+        data  = bytearray(end - start)
+        # Apply the patches in the order they were written
+        for idx in sorted(cluster):
+            patch = self.patches[idx]
+            data[patch.offset - start:patch.offset - start + len(patch.data)] = patch.data
+        return (start, bytes(data))
+
+    def dirty_runs(self, rom: bytes) -> list[tuple[int, bytes]]:
+        """
+        Get the runs that actually change the given ROM.
+
+        Only the patched ranges of the ROM are compared, not the whole ROM.
+
+        Raises:
+          IndexError: If a patch exceeds the ROM.
+        """
+        runs = self.runs()
+        dirty = []
+        for offset, data in runs:
+            if offset < 0 or offset + len(data) > len(rom):
+                raise IndexError(f'Patch of {len(data)} bytes at 0x{offset:05x} exceeds the ROM of {len(rom)} bytes.')
+            if rom[offset:offset+len(data)] != data:
+                dirty.append((offset, data))
+        log_vbs('Coalesced', len(self.patches), 'patches into', len(runs), 'runs, of which', len(dirty), 'change the ROM.')
+        return dirty
+
+    def apply(self, rom: bytearray) -> None:
+        """
+        Apply all patches to the given ROM.
+
+        Raises:
+          IndexError: If a patch exceeds the ROM.
+        """
+        for offset, data in self.dirty_runs(rom):
+            rom[offset:offset+len(data)] = data
+
+
+def stage_puzzles(plan: PatchPlan, args: argparse.Namespace) -> None:
+    if args.puzzles:
         log_nfo('Importing custom puzzles')
-        puzzles = read_puzzle_file(cmd_args.puzzles)
-        hack_puzzles(new_rom, puzzles)
+        puzzles = read_puzzles(args.puzzles, args.sample_puzzles, plan.rng)
+        quotas = None
+        if args.optimize_puzzles or args.puzzle_quota:
+            quotas = {category: (minimum, maximum) for category, minimum, maximum in args.puzzle_quota or []}
+        try:
+            hack_puzzles(plan, puzzles, quotas)
+        finally:
+            if isinstance(puzzles, PuzzleCorpus):
+                puzzles.close()
 
-    if cmd_args.players:
+
+def stage_players(plan: PatchPlan, args: argparse.Namespace) -> None:
+    if args.players:
         log_nfo('Importing custom computer player names')
-        players = read_player_names_file(cmd_args.players)
-        hack_players(new_rom, players)
+        players = read_player_names_file(args.players)
+        hack_players(plan, players)
+
 
-    if cmd_args.title_text:
+def stage_title_text(plan: PatchPlan, args: argparse.Namespace) -> None:
+    if args.title_text:
         log_nfo('Importing custom title text')
-        title_text= read_title_text_file(cmd_args.title_text)
-        hack_title_screen(new_rom, title_text)
+        title_text= read_title_text_file(args.title_text)
+        hack_title_screen(plan, title_text)
+
 
-    if cmd_args.marquee:
+def stage_marquee(plan: PatchPlan, args: argparse.Namespace) -> None:
+    if args.marquee:
         log_nfo('Importing custom marquee text')
-        marquee_text= read_marquee_text_file(cmd_args.marquee)
-        hack_marquee_text(new_rom, marquee_text)
+        marquee_text= read_marquee_text_file(args.marquee)
+        hack_marquee_text(plan, marquee_text)
 
-    if cmd_args.select_consonant_timer:
+
+def stage_timers(plan: PatchPlan, args: argparse.Namespace) -> None:
+    if args.select_consonant_timer:
         log_nfo('Setting timer for selecting consonants')
-        new_rom[preset.timer_addr_select_consonant] = cmd_args.select_consonant_timer
-    elif cmd_args.timers:
+        plan.write_byte(preset.timer_addr_select_consonant, args.select_consonant_timer)
+    elif args.timers:
         log_nfo('Setting timer for selecting consonants')
-        new_rom[preset.timer_addr_select_consonant] = cmd_args.timers
+        plan.write_byte(preset.timer_addr_select_consonant, args.timers)
 
-    if cmd_args.select_action_timer:
+    if args.select_action_timer:
         log_nfo('Setting timer for selecting next action')
-        new_rom[preset.timer_addr_choose_action] = cmd_args.select_action_timer
-    elif cmd_args.timers:
+        plan.write_byte(preset.timer_addr_choose_action, args.select_action_timer)
+    elif args.timers:
         log_nfo('Setting timer for selecting next action')
-        new_rom[preset.timer_addr_choose_action] = cmd_args.timers
+        plan.write_byte(preset.timer_addr_choose_action, args.timers)
 
-    if cmd_args.select_bonus_letter_timer:
+    if args.select_bonus_letter_timer:
         log_nfo('Setting timer for selecting letters in bonus round')
-        new_rom[preset.timer_addr_bonus_round_select] = cmd_args.select_bonus_letter_timer
-    elif cmd_args.timers:
+        plan.write_byte(preset.timer_addr_bonus_round_select, args.select_bonus_letter_timer)
+    elif args.timers:
         log_nfo('Setting timer for selecting letters in bonus round')
-        new_rom[preset.timer_addr_bonus_round_select] = cmd_args.timers
+        plan.write_byte(preset.timer_addr_bonus_round_select, args.timers)
 
-    if cmd_args.select_vowel_timer:
+    if args.select_vowel_timer:
         log_nfo('Setting timer for selecting vowels')
-        new_rom[preset.timer_addr_select_vowel] = cmd_args.select_vowel_timer
-    elif cmd_args.timers:
+        plan.write_byte(preset.timer_addr_select_vowel, args.select_vowel_timer)
+    elif args.timers:
         log_nfo('Setting timer for selecting vowels')
-        new_rom[preset.timer_addr_select_vowel] = cmd_args.timers
+        plan.write_byte(preset.timer_addr_select_vowel, args.timers)
 
-    if cmd_args.solve_timer:
+    if args.solve_timer:
         log_nfo('Setting timer for solving a normal puzzle')
-        new_rom[preset.timer_addr_solve] = cmd_args.solve_timer
-    elif cmd_args.timers:
+        plan.write_byte(preset.timer_addr_solve, args.solve_timer)
+    elif args.timers:
         log_nfo('Setting timer for solving a normal puzzle')
-        new_rom[preset.timer_addr_solve] = cmd_args.timers
+        plan.write_byte(preset.timer_addr_solve, args.timers)
 
-    if cmd_args.bonus_solve_timer:
+    if args.bonus_solve_timer:
         log_nfo('Setting timer for solving the bonus puzzle')
-        new_rom[preset.timer_addr_solve_bonus] = cmd_args.bonus_solve_timer
-    elif cmd_args.timers:
+        plan.write_byte(preset.timer_addr_solve_bonus, args.bonus_solve_timer)
+    elif args.timers:
         log_nfo('Setting timer for solving the bonus puzzle')
-        new_rom[preset.timer_addr_solve_bonus] = cmd_args.timers
+        plan.write_byte(preset.timer_addr_solve_bonus, args.timers)
+
 
-    if cmd_args.no_harm:
+def stage_no_harm(plan: PatchPlan, args: argparse.Namespace) -> None:
+    if args.no_harm:
         log_nfo('Replacing harmful wheel wedges with money wedges')
-        new_rom[preset.wedge_lose_turn_addr] = WEDGE_VALUES[2000]
-        new_rom[preset.wedge_bankrupt_addr] = WEDGE_VALUES[3000]
+        plan.write_byte(preset.wedge_lose_turn_addr, WEDGE_VALUES[2000])
+        plan.write_byte(preset.wedge_bankrupt_addr,  WEDGE_VALUES[3000])
+
 
-    if cmd_args.tiles_wall_deco:
+def stage_letter_wall(plan: PatchPlan, args: argparse.Namespace) -> None:
+    if args.tiles_wall_deco:
         log_nfo('Replacing tiles for the letter wall decoration')
-        replace_tiles(new_rom, cmd_args.tiles_wall_deco, preset.tile_range_letter_wall_deco)
+        replace_tiles(plan, args.tiles_wall_deco, preset.tile_range_letter_wall_deco)
 
-    if cmd_args.tiles_wall_floor:
+    if args.tiles_wall_floor:
         log_nfo('Replacing tiles for the letter wall floor')
-        replace_tiles(new_rom, cmd_args.tiles_wall_floor, preset.tile_range_letter_wall_floor)
+        replace_tiles(plan, args.tiles_wall_floor, preset.tile_range_letter_wall_floor)
 
-    if cmd_args.palette_wall_floor:
+    if args.palette_wall_floor:
         log_nfo('Replacing palette for the letter wall floor')
-        replace_palette(new_rom, cmd_args.palette_wall_floor, preset.pal_addr_letter_wall_floor)
+        replace_palette(plan, args.palette_wall_floor, preset.pal_addr_letter_wall_floor)
 
-    if cmd_args.palette_wall_deco:
+    if args.palette_wall_deco:
         log_nfo('Replacing palette for the letter wall deco')
-        replace_palette(new_rom, cmd_args.palette_wall_deco, preset.pal_addr_letter_wall_deco)
+        replace_palette(plan, args.palette_wall_deco, preset.pal_addr_letter_wall_deco)
 
-    if cmd_args.bg_color_wall:
+    if args.bg_color_wall:
         log_nfo('Replacing backdrop color for the letter wall screen')
-        new_rom[preset.bg_addr_letter_wall] = cmd_args.bg_color_wall
+        plan.write_byte(preset.bg_addr_letter_wall, args.bg_color_wall)
 
-    if cmd_args.logo:
+
+def stage_logo(plan: PatchPlan, args: argparse.Namespace) -> None:
+    if args.logo:
         log_nfo('Replacing big logo in the second title screen')
-        hack_big_logo(new_rom, cmd_args.logo)
-
-    if cmd_args.custom_hacks:
-        with open(cmd_args.custom_hacks, 'r') as custom_hacks_file:
-            hack_src = custom_hacks_file.read()
-        # Attention! We execute arbitrary code here! Do not execute
-        # untrusted code!
-        exec(hack_src)
-        for hack in custom_hacks:
-            if isinstance(hack, ReplaceBytesHack):
-                if len(hack.addr_range) != len(hack.new_bytes):
-                    raise ValueError(f'Number of bytes to write must be equal to the addr range. {len(hack.new_bytes)} bytes, {len(hack.addr_range)} addr range')
-                new_rom[hack.addr_range.start:hack.addr_range.stop] = hack.new_bytes
-            elif isinstance(hack, ReplaceSingleBytesHack):
-                for addr, value in hack.new_bytes.items():
-                    new_rom[addr] = value
-            elif isinstance(hack, ReplaceTilesHack):
-                replace_tiles(new_rom, hack.image_path, hack.addr_range)
-            elif isinstance(hack, ReplaceTilesAndMapHack):
-                replace_tiles_and_map(new_rom, hack.image_path, hack.tiles_addr_range, hack.tilemap_addr_range)
-            elif isinstance(hack, ReplaceTblTextHack):
-                encoded_text = tbl_encode(hack.text.upper(), len(hack.text), tbl)
-                if len(encoded_text) != len(hack.addr_range):
-                    raise ValueError(f'Number of characters to write must be equal to the length of the addr range. text length={len(encoded_text)} ({hack.text}), byte range={len(hack.addr_range)}')
-                new_rom[hack.addr_range.start:hack.addr_range.stop] = encoded_text
+        hack_big_logo(plan, args.logo)
+
+
+def stage_custom_hacks(plan: PatchPlan, args: argparse.Namespace) -> None:
+    if args.custom_hacks:
+        log_nfo('Applying custom hacks')
+        apply_custom_hacks(plan, load_custom_hacks(args.custom_hacks))
+
+
+# All stages of a build in the order they are run
+STAGES = {
+    'puzzles':      stage_puzzles,
+    'players':      stage_players,
+    'title_text':   stage_title_text,
+    'marquee':      stage_marquee,
+    'timers':       stage_timers,
+    'no_harm':      stage_no_harm,
+    'letter_wall':  stage_letter_wall,
+    'logo':         stage_logo,
+    'custom_hacks': stage_custom_hacks,
+}
+
+
+# The inputs each stage depends on besides the ROM, the preset and this script.
+# Paths are inputs by their content, all other values by their repr.
+STAGE_INPUTS = {
+    'puzzles':      lambda args: [args.seed, str(args.puzzles), args.sample_puzzles, args.optimize_puzzles, args.puzzle_quota, args.puzzles and split_puzzle_source(args.puzzles)[0], pathlib.Path(TBL_FILE)],
+    'players':      lambda args: [args.seed, args.players],
+    'title_text':   lambda args: [args.title_text, pathlib.Path('assets/title.tbl')],
+    'marquee':      lambda args: [args.marquee, pathlib.Path('assets/marquee.tbl')],
+    'timers':       lambda args: [args.select_consonant_timer, args.select_action_timer, args.select_bonus_letter_timer,
+                                  args.select_vowel_timer, args.solve_timer, args.bonus_solve_timer, args.timers],
+    'no_harm':      lambda args: [args.no_harm],
+    'letter_wall':  lambda args: [args.tiles_wall_deco, args.tiles_wall_floor, args.palette_wall_deco, args.palette_wall_floor, args.bg_color_wall],
+    'logo':         lambda args: [args.logo],
+    'custom_hacks': lambda args: [args.custom_hacks, pathlib.Path(TBL_FILE), *sorted(custom_hack_image_paths(args))],
+}
+
+# The stages making random choices (with the 'rng' of the plan). Only these
+# get a seed, so the seed of the build does not affect any other stage.
+RANDOM_STAGES = {'puzzles', 'players'}
+
+# The statistics (attributes of the plan) each stage sets besides its patches.
+# These are recorded with the stage, so they are also known if it is reused.
+STAGE_STATS = {
+    'puzzles': ['puzzle_repeats', 'puzzle_leftover_bytes'],
+}
+
+
+def custom_hack_image_paths(args: argparse.Namespace) -> set[pathlib.Path]:
+    """
+    Get the paths of all images the custom hacks given in 'args' will convert.
+    """
+    if not args.custom_hacks:
+        return set()
+    return {hack.image_path for hack in load_custom_hacks(args.custom_hacks) if hasattr(hack, 'image_path')}
+
+
+@cache
+def file_digest(path: pathlib.Path) -> str:
+    """
+    Get the SHA-1 of the content of the given file (or of nothing if it does not exist).
+    """
+    if not path.is_file():
+        return sha1().hexdigest()
+    with open(path, 'rb') as f:
+        return sha1(f.read()).hexdigest()
+
+
+def hash_stage_inputs(stage_name: str, rom_digest: str, args: argparse.Namespace) -> str:
+    """
+    Hash everything the output of the given stage depends on.
+
+    This covers the ROM (given by its digest), the preset, this script itself
+    and the stage specific inputs in 'STAGE_INPUTS'.
+    """
+    inputs = [rom_digest, repr(preset), file_digest(pathlib.Path(__file__))]
+    for value in STAGE_INPUTS[stage_name](args):
+        inputs.append(file_digest(value) if isinstance(value, pathlib.Path) else repr(value))
+    return sha1('\0'.join([stage_name] + inputs).encode()).hexdigest()
+
+
+def stage_manifest_path(outfile: pathlib.Path) -> pathlib.Path:
+    return outfile.with_name(outfile.name + STAGE_MANIFEST_SUFFIX)
+
+
+def read_stage_manifest(manifest_file: pathlib.Path) -> tuple[int, dict[str, dict]]:
+    """
+    Read the seed and the stages recorded by a previous incremental build.
+
+    Returns:
+      The seed of the build and the recorded stages by name, each with the
+      hash of its 'inputs', its 'seed', its 'patches' as a list of offset
+      and hex encoded data and its 'stats' (see 'STAGE_STATS'). If there is no usable manifest, no seed and no
+      stages are returned.
+    """
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None, {}
+    except (OSError, ValueError) as e:
+        log_wrn('Ignoring the unreadable stage manifest', manifest_file, 'due to', e)
+        return None, {}
+
+    if not isinstance(manifest, dict) or manifest.get('version') != STAGE_MANIFEST_VERSION:
+        log_wrn('Ignoring stage manifest', manifest_file, 'of an unsupported version.')
+        return None, {}
+    return manifest.get('seed'), manifest['stages']
+
+
+def write_stage_manifest(manifest_file: pathlib.Path, plan: 'PatchPlan', stage_hashes: dict[str, str]) -> None:
+    """
+    Record the seed of 'plan' and the input hashes, seeds, patches and statistics of all its stages.
+    """
+    stages = {}
+    for stage_name, inputs in stage_hashes.items():
+        patches = [[patch.offset, patch.data.hex()] for patch in plan.patches if patch.stage == stage_name]
+        stats = {name: getattr(plan, name) for name in STAGE_STATS.get(stage_name, [])}
+        stages[stage_name] = {'inputs': inputs, 'seed': plan.stage_seeds.get(stage_name), 'patches': patches, 'stats': stats}
+
+    tmp_file = manifest_file.with_name(manifest_file.name + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump({'version': STAGE_MANIFEST_VERSION, 'seed': plan.seed, 'stages': stages}, f, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+
+def derive_stage_seed(seed: int, stage_name: str) -> int:
+    """
+    Derive the seed of a stage from the seed of the build and the name of the stage.
+    """
+    return int.from_bytes(sha1(f'{seed}:{stage_name}'.encode()).digest()[:8], 'big')
+
+
+def build_patch_plan(args: argparse.Namespace, stage_hashes: dict[str, str] = None, recorded_stages: dict[str, dict] = None, recorded_seed: int = None) -> PatchPlan:
+    """
+    Run all stages requested by 'args' and collect their patches.
+
+    For incremental builds the 'stage_hashes' of the current inputs are
+    compared to the 'recorded_stages' of a previous build. Stages whose inputs
+    and seed did not change are not run, but their recorded patches and
+    statistics are reused.
+
+    Each stage in 'RANDOM_STAGES' makes its random choices with its own
+    'random.Random' (the 'rng' of the plan), seeded by 'derive_stage_seed'.
+    Thereby the result of a stage only depends on its inputs and the seed, no
+    matter which other stages are run, reused or in which order. The other
+    stages don’t get a seed, so they are reused with any seed. Without “--seed” the
+    'recorded_seed' of the previous build is kept, so that the seed of the
+    plan reproduces the reused stages, or else a random seed is chosen. The
+    seeds are logged and recorded in the plan.
+
+    The global 'preset' must already be set to the preset of the ROM to patch.
+    """
+    global log_stage
+
+    plan = PatchPlan()
+    stage_hashes    = stage_hashes or {}
+    recorded_stages = recorded_stages or {}
+
+    if args.seed is not None:
+        plan.seed = args.seed
+    elif recorded_seed is not None:
+        plan.seed = recorded_seed
+    else:
+        plan.seed = random.randrange(2**32)
+    log_vbs('Building with seed', plan.seed)
+
+    for stage_name, stage in STAGES.items():
+        plan.stage = stage_name
+        log_stage  = stage_name
+        start = time.perf_counter()
+        first_patch = len(plan.patches)
+
+        stage_seed = None
+        if stage_name in RANDOM_STAGES:
+            stage_seed = derive_stage_seed(plan.seed, stage_name)
+            plan.stage_seeds[stage_name] = stage_seed
+
+        recorded = recorded_stages.get(stage_name)
+        if recorded is not None and recorded['inputs'] == stage_hashes.get(stage_name) and recorded.get('seed') == stage_seed:
+            log_vbs('Reusing the patches of unchanged stage', stage_name)
+            with trace_span(stage_name, 'stage', reused=True):
+                for offset, data in recorded['patches']:
+                    plan.write(offset, bytes.fromhex(data))
+                for name in STAGE_STATS.get(stage_name, []):
+                    setattr(plan, name, recorded['stats'].get(name))
+            plan.reused_stages.add(stage_name)
+        else:
+            if stage_seed is None:
+                plan.rng = None
+                log_dbg('Running stage', stage_name)
             else:
-                raise ValueError('Unsupported hack type: '+str(type(hack)))
+                plan.rng = random.Random(stage_seed)
+                log_dbg('Running stage', stage_name, 'with seed', stage_seed)
+            with trace_span(stage_name, 'stage', reused=False, seed=stage_seed):
+                stage(plan, args)
+
+        plan.stage_durations[stage_name] = time.perf_counter() - start
+        if log_level <= LOG_DEBUG:
+            patches = plan.patches[first_patch:]
+            patch_bytes = sum(len(patch.data) for patch in patches)
+            log_dbg('Stage', stage_name, 'wrote', len(patches), 'patches with', patch_bytes, 'bytes.', patches=len(patches), bytes=patch_bytes)
+
+    log_stage = None
+    return plan
 
-    if rom == new_rom:
+
+def print_stage_stats(plan: PatchPlan) -> None:
+    """
+    Print the seed of the build and the number of patches and bytes each
+    stage wrote, how long it took, its seed and whether it was skipped in
+    favour of the patches of a previous build.
+    Also print how many puzzle slots had to be filled with repeated puzzles
+    and how many bytes of the puzzle area are left over.
+    """
+    print(f'seed {plan.seed}')
+    print(f'{"stage":<14} {"status":<8} {"patches":>8} {"bytes":>8} {"time":>10} {"seed":>20}')
+    for stage_name, duration in plan.stage_durations.items():
+        patches = [patch for patch in plan.patches if patch.stage == stage_name]
+        if stage_name in plan.reused_stages:
+            status = 'skipped'
+        elif patches:
+            status = 'run'
+        else:
+            status = 'unused'
+        stage_seed = plan.stage_seeds.get(stage_name)
+        print(f'{stage_name:<14} {status:<8} {len(patches):>8} {sum(len(patch.data) for patch in patches):>8} {duration * 1000:>8.2f}ms {"-" if stage_seed is None else stage_seed:>20}')
+    if plan.puzzle_repeats is not None:
+        print(f'{plan.puzzle_repeats} puzzle slots are filled with repeated puzzles, {plan.puzzle_leftover_bytes} bytes of the puzzle area are left over.')
+
+
+def build_changes(rom: bytes, args: argparse.Namespace) -> list[tuple[int, bytes]]:
+    """
+    Determine the changes to 'rom' for all hacks requested by 'args'.
+
+    With “--incremental” the stages of the previous build of the same outfile
+    are reused where possible, and the stages of this build are recorded for
+    the next one.
+
+    The global 'preset' must already be set to the preset matching 'rom'.
+
+    Returns:
+      The runs of the hacked ROM (as offset and data) that differ from 'rom',
+      ordered by offset. An empty list means that the ROM is left unchanged.
+    """
+    if args.incremental:
+        rom_digest = sha1(rom).hexdigest()
+        stage_hashes = {stage_name: hash_stage_inputs(stage_name, rom_digest, args) for stage_name in STAGES}
+        manifest_file = stage_manifest_path(args.outfile)
+        recorded_seed, recorded_stages = read_stage_manifest(manifest_file)
+        plan = build_patch_plan(args, stage_hashes, recorded_stages, recorded_seed)
+    else:
+        plan = build_patch_plan(args)
+
+    if args.stats:
+        print_stage_stats(plan)
+
+    changes = plan.dirty_runs(rom)
+
+    if args.incremental:
+        write_stage_manifest(manifest_file, plan, stage_hashes)
+    return changes
+
+
+def read_manifest(manifest_file: pathlib.Path, cmd_defaults: dict = None) -> tuple[pathlib.Path, list[argparse.Namespace]]:
+    """
+    Read a TOML manifest describing several variants to build from the same ROM.
+
+    The manifest has the following structure:
+
+        romfile = "Wheel of Fortune - Family Edition (USA).nes"
+
+        [defaults]               # options shared by all variants
+        no-harm = true
+        timers  = 99
+
+        [[variant]]              # one table per variant to build
+        outfile = "build/octowheel-en.nes"
+        puzzles = "okto_patches-en/puzzlelist-octonauts"
+
+    The keys of 'defaults' and 'variant' are the long options of this script
+    (without the leading “--”), except for the ones in
+    'MANIFEST_EXCLUDED_OPTIONS'. Options of a variant override the defaults.
+    Flags take a boolean, options that may be given several times (e.g.
+    “puzzle-quota”) a value or a list of values and all other options a
+    single string or number. The 'cmd_defaults' (options of the command line,
+    see 'manifest_defaults') are used unless the manifest defines them
+    itself.
+
+    Returns:
+      A tuple of the ROM file and the parsed arguments for each variant.
+    Raises:
+      ValueError: If the manifest is incomplete, has an unknown option or an
+                  option with a value of the wrong type.
+    """
+    with open(manifest_file, 'rb') as f:
+        manifest = tomllib.load(f)
+
+    if 'romfile' not in manifest:
+        raise ValueError(f'Manifest {manifest_file} does not define a “romfile”.')
+    if not manifest.get('variant'):
+        raise ValueError(f'Manifest {manifest_file} does not define any “[[variant]]”.')
+
+    romfile = pathlib.Path(manifest['romfile'])
+    defaults = (cmd_defaults or {}) | manifest.get('defaults', {})
+    actions = {option[2:]: action for action in argument_parser()._actions for option in action.option_strings if option.startswith('--')}
+
+    variants = []
+    for variant in manifest['variant']:
+        options = defaults | variant
+        if 'outfile' not in options:
+            raise ValueError(f'Variant {variant} in manifest {manifest_file} does not define an “outfile”.')
+
+        argv = [str(romfile), str(options.pop('outfile'))]
+        for key, value in options.items():
+            argv.extend(manifest_option_argv(key, value, actions.get(key), manifest_file))
+        variants.append(parse_arguments(argv))
+
+    return (romfile, variants)
+
+
+def manifest_option_argv(key: str, value, action: argparse.Action, manifest_file: pathlib.Path) -> list[str]:
+    """
+    Convert an option of a manifest (see 'read_manifest') to command line arguments.
+
+    Raises:
+      ValueError: If the option is unknown or its value has the wrong type.
+    """
+    if action is None or key in MANIFEST_EXCLUDED_OPTIONS:
+        raise ValueError(f'Unknown option “{key}” in manifest {manifest_file}.')
+
+    if action.nargs == 0:
+        if not isinstance(value, bool):
+            raise ValueError(f'Option “{key}” in manifest {manifest_file} must be true or false, not {value!r}.')
+        return ['--' + key] if value else []
+
+    values = value if isinstance(action, argparse._AppendAction) and isinstance(value, list) else [value]
+    for single_value in values:
+        if isinstance(single_value, bool) or not isinstance(single_value, (str, int, float)):
+            raise ValueError(f'Option “{key}” in manifest {manifest_file} must be a string or a number, not {value!r}.')
+    return [arg for single_value in values for arg in ('--' + key, str(single_value))]
+
+
+def manifest_defaults(args: argparse.Namespace) -> dict:
+    """
+    Get the options of the command line 'args' that apply to all variants of
+    a manifest (unless the manifest sets them itself), see 'MANIFEST_CMD_OPTIONS'.
+    """
+    parser = argument_parser()
+    defaults = {}
+    for key in MANIFEST_CMD_OPTIONS:
+        dest = key.replace('-', '_')
+        value = getattr(args, dest)
+        if value != parser.get_default(dest):
+            defaults[key] = value
+    return defaults
+
+
+def collect_image_paths(args: argparse.Namespace) -> set[pathlib.Path]:
+    """
+    Get the paths of all images a build with the given 'args' will convert.
+    """
+    image_paths = {path for path in (args.logo, args.tiles_wall_deco, args.tiles_wall_floor) if path}
+    return image_paths | custom_hack_image_paths(args)
+
+
+def build_variant(rom: bytes, args: argparse.Namespace, variant_preset: Preset, force: bool = False) -> float:
+    """
+    Build a single variant of a manifest and write it to its outfile.
+
+    The log level and format, “--no-cache”, “--trace” and “--profile” of the
+    variant only apply while it is built. Its trace events are also added to
+    the trace of the whole build (if any).
+
+    Returns:
+      The number of seconds it took to build the variant.
+    """
+    global preset, log_level, log_format, chr_cache_dir, tracer
+
+    outer = (log_level, log_format, chr_cache_dir, tracer)
+    if args.loglevel:
+        log_level = LOG_LEVELS_ORDER.index(args.loglevel)
+    log_format = args.log_format
+    if args.no_cache:
+        chr_cache_dir = None
+    if args.trace:
+        tracer = Tracer()
+
+    try:
+        start = time.perf_counter()
+        log_nfo('Building variant', args.outfile)
+
+        preset = variant_preset
+        with trace_span(str(args.outfile), 'variant'):
+            if args.profile:
+                profiler = cProfile.Profile()
+                profiler.runcall(write_variant, rom, args, force)
+                pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            else:
+                write_variant(rom, args, force)
+        duration = time.perf_counter() - start
+
+        if args.trace:
+            tracer.write(args.trace)
+            log_nfo('Trace written to:', args.trace)
+            if outer[3] is not None:
+                outer[3].events.extend(tracer.events)
+    finally:
+        log_level, log_format, chr_cache_dir, tracer = outer
+
+    return duration
+
+
+def write_variant(rom: bytes, args: argparse.Namespace, force: bool) -> None:
+    changes = build_changes(rom, args)
+    if not changes:
         log_wrn('No changes detected. New ROM will be exactly the same as the original one.')
+    write_output(rom, changes, args.outfile, args.format, force or args.force)
+
+
+def _init_variant_worker(shm_name: str, rom_size: int, tbl_: TblCodec, log_level_: int, log_format_: str, chr_cache_dir_: pathlib.Path, tracing: bool) -> None:
+    global shared_rom_memory, shared_rom, tbl, log_level, log_format, chr_cache_dir, tracer
+
+    # Keep a reference to the shared memory, otherwise it would be closed
+    # while the ROM is still in use.
+    shared_rom_memory = shared_memory.SharedMemory(shm_name)
+    shared_rom = shared_rom_memory.buf[:rom_size]
+    tbl = tbl_
+    log_level = log_level_
+    log_format = log_format_
+    chr_cache_dir = chr_cache_dir_
+    tracer = Tracer() if tracing else None
+
 
-    write_rom_to_file(bytes(new_rom), cmd_args.outfile, cmd_args.force)
-    log_nfo('New ROM written to:', cmd_args.outfile)
+def _convert_image_job(image_path: pathlib.Path, use_cache: bool) -> ConvertedImage:
+    global chr_cache_dir
+
+    if use_cache:
+        return convert_image(image_path)
+    cache_dir, chr_cache_dir = chr_cache_dir, None
+    try:
+        return convert_image(image_path)
+    finally:
+        chr_cache_dir = cache_dir
+
+
+def _build_variant_job(args: argparse.Namespace, variant_preset: Preset, images: dict[pathlib.Path, ConvertedImage], force: bool) -> tuple[float, list[dict]]:
+    image_cache.update(images)
+    duration = build_variant(shared_rom, args, variant_preset, force)
+
+    # Hand the trace events of this variant over to the main process
+    if tracer is None:
+        return (duration, [])
+    events, tracer.events = tracer.events, []
+    return (duration, events)
+
+
+def build_manifest(manifest_file: pathlib.Path, force: bool = False, jobs: int = 1, cmd_defaults: dict = None) -> None:
+    """
+    Build all variants described in the given manifest.
+
+    The ROM, its preset and the TBL file are only read once and images are
+    only converted once for all variants.
+
+    With 'jobs' > 1 the variants are built in parallel by that many processes.
+    These access the ROM via shared memory. The images are converted in
+    parallel up front, so that no process converts an image that another one
+    already did. Since each variant is built from the same inputs either way,
+    the result only depends on the “--seed” and not on the number of jobs.
+    The 'cmd_defaults' (see 'manifest_defaults') apply to all variants that
+    don’t define these options themselves.
+    """
+    romfile, variants = read_manifest(manifest_file, cmd_defaults)
+    with read_rom_from_file(romfile) as rom:
+        variant_presets = []
+        detected_preset = None
+        for args in variants:
+            if args.preset:
+                variant_presets.append(PRESETS[args.preset])
+            else:
+                if detected_preset is None:
+                    detected_preset = autodetect_preset(rom)
+                variant_presets.append(detected_preset)
+
+        total_start = time.perf_counter()
+        if jobs == 1:
+            for args, variant_preset in zip(variants, variant_presets):
+                duration = build_variant(rom, args, variant_preset, force)
+                log_nfo('Variant', args.outfile, 'built in', round(duration, 3), 's')
+        else:
+            image_paths = sorted(set().union(*[collect_image_paths(args) for args in variants]))
+            # An image is only taken from the cache if no variant using it has “--no-cache”
+            uncached_paths = set().union(*[collect_image_paths(args) for args in variants if args.no_cache])
+
+            rom_memory = shared_memory.SharedMemory(create=True, size=len(rom))
+            try:
+                rom_memory.buf[:len(rom)] = rom
+                with ProcessPoolExecutor(jobs, initializer=_init_variant_worker, initargs=(rom_memory.name, len(rom), tbl, log_level, log_format, chr_cache_dir, tracer is not None)) as executor:
+                    images = dict(zip(image_paths, executor.map(_convert_image_job, image_paths, [path not in uncached_paths for path in image_paths])))
+                    futures = [executor.submit(_build_variant_job, args, variant_preset, images, force)
+                               for args, variant_preset in zip(variants, variant_presets)]
+                    for args, future in zip(variants, futures):
+                        duration, events = future.result()
+                        if tracer is not None:
+                            tracer.events.extend(events)
+                        log_nfo('Variant', args.outfile, 'built in', round(duration, 3), 's')
+            finally:
+                rom_memory.close()
+                rom_memory.unlink()
+
+        log_nfo(len(variants), 'variants built in', round(time.perf_counter() - total_start, 3), 's')
+
+
+def build(args: argparse.Namespace) -> None:
+    """
+    Build the ROM (or the variants of the manifest) requested by the command line 'args'.
+    """
+    global preset
+
+    if args.manifest:
+        build_manifest(args.manifest, args.force, args.jobs or 1, manifest_defaults(args))
+        return
+
+    with read_rom_from_file(args.romfile) as rom:
+        if args.preset:
+            preset = PRESETS[args.preset]
+        else:
+            preset = autodetect_preset(rom)
+
+        changes = build_changes(rom, args)
+
+        if not changes:
+            log_wrn('No changes detected. New ROM will be exactly the same as the original one.')
+
+        write_output(rom, changes, args.outfile, args.format, args.force)
+        log_nfo('Output written to:', args.outfile)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['apply']:
+        apply_args = parse_apply_arguments(sys.argv[2:])
+        apply_patch_file(apply_args.patchfile, apply_args.romfile, apply_args.outfile, apply_args.force)
+        log_nfo('New ROM written to:', apply_args.outfile)
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['compile-puzzles']:
+        compile_args = parse_compile_arguments(sys.argv[2:])
+        if compile_args.loglevel:
+            log_level = LOG_LEVELS_ORDER.index(compile_args.loglevel)
+        preset = PRESETS[compile_args.preset]
+        compile_puzzles(read_puzzles(compile_args.puzzles), compile_args.outfile, compile_args.force)
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['import-puzzles']:
+        import_args = parse_import_arguments(sys.argv[2:])
+        if import_args.loglevel:
+            log_level = LOG_LEVELS_ORDER.index(import_args.loglevel)
+        preset = PRESETS[import_args.preset]
+        import_puzzle_files(import_args.database, import_args.puzzlefiles, import_args.tag)
+        sys.exit(0)
+
+    cmd_args = parse_arguments()
+    if cmd_args.loglevel:
+        log_level = LOG_LEVELS_ORDER.index(cmd_args.loglevel)
+    log_format = cmd_args.log_format
+
+    tbl = tbl_codec(TBL_FILE)
+    if cmd_args.no_cache:
+        chr_cache_dir = None
+    if cmd_args.trace:
+        tracer = Tracer()
+
+    if cmd_args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(build, cmd_args)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    else:
+        build(cmd_args)
 
+    if tracer is not None:
+        tracer.write(cmd_args.trace)
+        log_nfo('Trace written to:', cmd_args.trace)
@@ -1,7 +1,29 @@
 #!/bin/env python3
 
-import requests
-import bs4
+import argparse
+import asyncio
+import codecs
+import html.parser
+import json
+import os
+import pathlib
+
+from concurrent.futures import ProcessPoolExecutor
+from hashlib            import sha1
+from typing             import Iterable, Iterator
+
+import aiohttp
+
+URL              = 'https://buyavowel.boards.net/page/compendium%i'
+PAGES            = range(1, 42)
+CONNECTION_LIMIT = 8
+RETRIES          = 4
+RETRY_BACKOFF    = 1.0  # seconds to wait before the first retry, doubled for each further one
+RETRY_STATUS     = {429, 500, 502, 503, 504}
+PUZZLE_TABLE     = 4          # the index of the table containing the puzzles on each page
+PARSE_CHUNK_SIZE = 16 * 1024  # the number of characters to parse at once
+READ_CHUNK_SIZE  = 16 * 1024  # the number of bytes to read (and parse) at once while downloading
+CACHE_DIR        = pathlib.Path(os.environ.get('XDG_CACHE_HOME', '~/.cache')).expanduser() / 'octowheel' / 'http'
 
 PLACE          = 'Place'
 PERSON         = 'Person'
@@ -80,47 +102,398 @@ CLEAN_CATS = {
     u'Occupation': PERSON
 }
 
-url='https://buyavowel.boards.net/page/compendium%i'
-
-results = {}
-unknown_categories = {}
-
-for i in range(1, 42):
-    print('Scraping URL', url % i)
-    html = requests.get(url % i).text
-    soup = bs4.BeautifulSoup(html, features="lxml")
-    table = soup.find_all('table')[4]
-    for row in table.find_all('tr'):
-        cols = row.find_all('td')[:2]
-        puzzle = cols[0].text
-        category = cols[1].text
-        if category not in CLEAN_CATS:
-            if category not in unknown_categories:
-                unknown_categories[category] = []
-            unknown_categories[category].append(puzzle)
-            continue
-        category = CLEAN_CATS[category]
-        if category not in results:
-            results[category] = []
-        results[category].append(puzzle)
-
-with open('puzzlelist-scraped', 'a') as out:
-    for category, puzzles in results.items():
-        out.write('\n[' + category + ']\n')
-        for puzzle in puzzles:
-            out.write(puzzle + '\n')
-
-if unknown_categories:
-    with open('puzzlefails', 'w') as fails:
-        for category, puzzles in unknown_categories.items():
-            print('Unknown category:', category, '('+ str(len(puzzles))+ ' occurrences)')
-            fails.write('\n[' + category + ']\n')
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'Scrape the puzzles of the Wheel of Fortune Puzzle Compendium into a puzzlelist')
+
+    parser.add_argument(      '--url',          type=str,          default=URL,              help=f'the URL of the compendium pages with “%%i” for the page number (default: {URL.replace("%", "%%")})')
+    parser.add_argument(      '--pages',        type=int, nargs=2, default=[PAGES.start, PAGES.stop - 1], metavar=('FIRST', 'LAST'), help='the first and last page to scrape')
+    parser.add_argument('-j', '--connections',  type=int,          default=CONNECTION_LIMIT, help=f'the maximum number of concurrent connections (default: {CONNECTION_LIMIT})')
+    parser.add_argument(      '--retries',      type=int,          default=RETRIES,          help=f'the number of retries for a failed request (default: {RETRIES})')
+    parser.add_argument('-o', '--output',       type=pathlib.Path, default=pathlib.Path('puzzlelist-scraped'), help='the file to write the puzzles to')
+    parser.add_argument(      '--fails',        type=pathlib.Path, default=pathlib.Path('puzzlefails'),        help='the file to write the puzzles of unknown categories to')
+    parser.add_argument(      '--checkpoint',   type=pathlib.Path,                           help='the file recording the parsed pages (default: <output>.checkpoint)')
+    parser.add_argument(      '--since',        action='store_true',                         help='only parse the pages whose content changed since the last run (as recorded in the checkpoint)')
+    parser.add_argument(      '--no-cache',     action='store_true',                         help=f'do not cache the downloaded pages (in {CACHE_DIR})')
+
+    return parser.parse_args()
+
+
+class PuzzleTableParser(html.parser.HTMLParser):
+    """
+    Collects the rows of the puzzle table of a compendium page from the
+    events of the HTML parser, without building a document tree.
+
+    The text of the first two cells of each row is collected as puzzle and
+    category. Everything after the puzzle table is ignored.
+    """
+    def __init__(self):
+        super().__init__()
+        self.tables = 0     # the number of tables started so far
+        self.depth  = 0     # the nesting depth of tables inside the puzzle table
+        self.done   = False
+        self.rows   = []    # the complete rows not yet taken by 'take_rows'
+        self._row   = None  # the texts of the cells of the current row
+        self._cell  = None  # the text fragments of the current cell
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            if self.depth > 0:
+                self.depth += 1
+            elif self.tables == PUZZLE_TABLE:
+                self.depth = 1
+            self.tables += 1
+        elif self.depth > 0 and not self.done:
+            # Rows and cells end implicitly when the next one starts
+            if tag == 'tr':
+                self._end_row()
+                self._row = []
+            elif tag in ('td', 'th'):
+                self._end_cell()
+                if tag == 'td':
+                    self._row = [] if self._row is None else self._row
+                    self._cell = []
+
+    def handle_endtag(self, tag):
+        if self.depth == 0 or self.done:
+            return
+        if tag == 'td':
+            self._end_cell()
+        elif tag == 'tr':
+            self._end_row()
+        elif tag == 'table':
+            self.depth -= 1
+            if self.depth == 0:
+                self._end_row()
+                self.done = True
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def _end_cell(self):
+        if self._cell is not None:
+            self._row.append(''.join(self._cell))
+            self._cell = None
+
+    def _end_row(self):
+        self._end_cell()
+        if self._row is not None and len(self._row) >= 2:
+            self.rows.append((self._row[0], self._row[1]))
+        self._row = None
+
+    def close(self):
+        super().close()
+        # The puzzle table may be cut off at the end of the page
+        if self.depth > 0:
+            self._end_row()
+        elif not self.done:
+            raise ValueError(f'Page contains only {self.tables} tables, but the puzzles are expected in table {PUZZLE_TABLE + 1}.')
+
+    def take_rows(self) -> list[tuple[str, str]]:
+        rows, self.rows = self.rows, []
+        return rows
+
+
+def iter_puzzles(chunks: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """
+    Extract the puzzles of a compendium page given in chunks of text.
+
+    Yields:
+      Tuples of puzzle and (raw) category as soon as their rows are parsed.
+      No further chunks are consumed once the puzzle table has ended.
+    """
+    parser = PuzzleTableParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.take_rows()
+        if parser.done:
+            return
+    parser.close()
+    yield from parser.take_rows()
+
+
+def parse_page(html: str) -> list[tuple[str, str]]:
+    """
+    Extract the puzzles of a compendium page as tuples of puzzle and (raw) category.
+    """
+    return list(iter_puzzles(html[i:i + PARSE_CHUNK_SIZE] for i in range(0, len(html), PARSE_CHUNK_SIZE)))
+
+
+def cache_file(cache_dir: pathlib.Path, url: str) -> pathlib.Path:
+    return cache_dir / (sha1(url.encode()).hexdigest() + '.json')
+
+
+def read_cached_response(cache_dir: pathlib.Path, url: str) -> dict:
+    """
+    Get the cached response for the given URL with its 'body', 'etag' and
+    'last_modified' or None if it is not cached.
+    """
+    try:
+        with open(cache_file(cache_dir, url), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cached_response(cache_dir: pathlib.Path, url: str, response: aiohttp.ClientResponse, body: str) -> None:
+    cached = {
+        'url':           url,
+        'etag':          response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'body':          body,
+    }
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = cache_file(cache_dir, url)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(cached, f)
+    os.replace(tmp_path, path)
+
+
+async def read_page(response: aiohttp.ClientResponse, parse: bool) -> tuple[str, list[tuple[str, str]]]:
+    """
+    Read the text of a response in chunks of 'READ_CHUNK_SIZE' bytes.
+
+    With 'parse' each chunk is fed to a 'PuzzleTableParser' as soon as it
+    arrives, so the page is parsed while it is downloaded. Once the puzzle
+    table has ended, the rest of the page is only read, not parsed.
+
+    Returns:
+      A tuple of the text and the puzzles (see 'parse_page') of the page, or
+      None instead of the puzzles without 'parse'.
+    """
+    decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')()
+    parser = PuzzleTableParser() if parse else None
+    chunks = []
+    async for data in response.content.iter_chunked(READ_CHUNK_SIZE):
+        chunks.append(decoder.decode(data))
+        if parser is not None and not parser.done:
+            parser.feed(chunks[-1])
+    chunks.append(decoder.decode(b'', final=True))
+
+    if parser is None:
+        return (''.join(chunks), None)
+    if not parser.done:
+        parser.feed(chunks[-1])
+        parser.close()
+    return (''.join(chunks), parser.take_rows())
+
+
+async def fetch(session: aiohttp.ClientSession, url: str, retries: int, cache_dir: pathlib.Path = None, parse: bool = False) -> tuple[str, list[tuple[str, str]]]:
+    """
+    Get the text of the given URL and, with 'parse', its puzzles (see 'read_page').
+
+    With a 'cache_dir' the response is cached on disk. A cached response is
+    revalidated by a conditional request (via its ETag and Last-Modified
+    headers) and only downloaded again if it changed.
+
+    Connection errors, timeouts and responses with a status in 'RETRY_STATUS'
+    are retried up to 'retries' times with an exponential backoff.
+
+    Returns:
+      A tuple of the text and the puzzles of the page. The puzzles are None
+      without 'parse' or if the page was taken from the cache.
+    """
+    cached = read_cached_response(cache_dir, url) if cache_dir else None
+    headers = {}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached['last_modified']:
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304 and cached:
+                    return (cached['body'], None)
+                response.raise_for_status()
+                body, puzzles = await read_page(response, parse)
+                if cache_dir:
+                    # A failed cache write must not lose the downloaded page
+                    try:
+                        write_cached_response(cache_dir, url, response, body)
+                    except OSError as e:
+                        print(f'Cannot cache URL {url} ({e.__class__.__name__}: {e})')
+                return (body, puzzles)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == retries or (isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUS):
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            print(f'Retrying URL {url} in {delay:.0f}s ({e.__class__.__name__}: {e})')
+            await asyncio.sleep(delay)
+
+
+class Checkpoint:
+    """
+    Records the puzzles of each parsed page, so that an interrupted run can be
+    resumed and later runs can skip unchanged pages.
+
+    The checkpoint file contains one JSON object per line: one per page with
+    its 'url', the SHA-1 'hash' of its content and its 'puzzles', and a final
+    one marking the run as 'complete'. Each line is written as soon as its
+    page is parsed, so a crash loses at most the page being written.
+
+    The file stays open from 'start' until 'finish' or 'close'. Use the
+    checkpoint as a context manager to close it if the run fails.
+    """
+    def __init__(self, path: pathlib.Path):
+        self.path     = path
+        self.pages    = {}     # url -> record of the previous run
+        self.complete = False  # whether the previous run completed
+        self._file    = None
+
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # the rest of an interrupted write
+                    if record.get('complete'):
+                        self.complete = True
+                    else:
+                        self.pages[record['url']] = record
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self) -> 'Checkpoint':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def start(self, records: list[dict]) -> None:
+        """
+        Start a new checkpoint containing the given records carried over from the previous run.
+        """
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a')
+
+    def record(self, url: str, content_hash: str, puzzles: list[tuple[str, str]]) -> None:
+        self._file.write(json.dumps({'url': url, 'hash': content_hash, 'puzzles': puzzles}) + '\n')
+        self._file.flush()
+
+    def finish(self) -> None:
+        self._file.write(json.dumps({'complete': True}) + '\n')
+        self.close()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+async def scrape(urls: list[str], connections: int, retries: int, checkpoint: Checkpoint, since: bool = False, cache_dir: pathlib.Path = None) -> list[list[tuple[str, str]]]:
+    """
+    Download the given compendium pages and extract their puzzles.
+
+    All requests share one connection pool of at most 'connections'
+    connections. Each page is parsed while it is downloaded (see
+    'read_page'). Pages that are not parsed that way (those taken from the
+    cache and those only parsed if they changed) are parsed in a process pool,
+    so parsing overlaps with the remaining downloads.
+
+    If the previous run recorded in the 'checkpoint' was interrupted, its
+    pages are taken from the checkpoint without downloading them again. With
+    'since' the pages of a complete previous run are downloaded (which is
+    cheap with the cache), but only parsed if their content changed.
+
+    Returns:
+      The puzzles of each page (see 'parse_page') in the order of 'urls'.
+    """
+    loop = asyncio.get_running_loop()
+
+    if checkpoint.complete:
+        resumed = {}
+        previous = checkpoint.pages if since else {}
+    else:
+        resumed = {url: record for url, record in checkpoint.pages.items() if url in urls}
+        previous = {}
+        if resumed:
+            print('Resuming interrupted run with', len(resumed), 'pages from', checkpoint.path)
+    checkpoint.start(list(resumed.values()))
+
+    with checkpoint, ProcessPoolExecutor() as parser_pool:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections)) as session:
+            async def scrape_page(url: str) -> list[tuple[str, str]]:
+                if url in resumed:
+                    return resumed[url]['puzzles']
+
+                html, puzzles = await fetch(session, url, retries, cache_dir, parse=url not in previous)
+                content_hash = sha1(html.encode()).hexdigest()
+                if url in previous and previous[url]['hash'] == content_hash:
+                    print('Unchanged URL', url)
+                    puzzles = previous[url]['puzzles']
+                else:
+                    print('Scraped URL', url)
+                    if puzzles is None:
+                        puzzles = await loop.run_in_executor(parser_pool, parse_page, html)
+                checkpoint.record(url, content_hash, puzzles)
+                return puzzles
+
+            pages = await asyncio.gather(*[scrape_page(url) for url in urls])
+
+        checkpoint.finish()
+    return pages
+
+
+def sort_by_category(pages: list[list[tuple[str, str]]]) -> tuple[dict[str, list[str]], dict[str, list[str]]]:
+    """
+    Sort the scraped puzzles into the categories of 'CLEAN_CATS'.
+
+    Returns:
+      A tuple of the puzzles by clean category and the puzzles by unknown
+      (raw) category.
+    """
+    results = {}
+    unknown_categories = {}
+    for page in pages:
+        for puzzle, category in page:
+            if category not in CLEAN_CATS:
+                unknown_categories.setdefault(category, []).append(puzzle)
+                continue
+            results.setdefault(CLEAN_CATS[category], []).append(puzzle)
+    return (results, unknown_categories)
+
+
+def write_puzzle_file(path: pathlib.Path, puzzles_by_category: dict[str, list[str]]) -> None:
+    """
+    Write the puzzles in the puzzlelist format to 'path'.
+
+    The file is replaced atomically, so it either contains the complete
+    result of a run or stays untouched.
+    """
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as out:
+        for category, puzzles in puzzles_by_category.items():
+            out.write('\n[' + category + ']\n')
             for puzzle in puzzles:
-                fails.write(puzzle + '\n')
+                out.write(puzzle + '\n')
+    os.replace(tmp_path, path)
+
 
-successful_puzzles = sum([len(puzzles) for puzzles in results.values()])
-failed_puzzles = sum([len(puzzles) for puzzles in unknown_categories.values()])
-print(successful_puzzles, 'puzzles successfully parsed and written to: puzzlelist-scraped')
-print(failed_puzzles, 'puzzles in', len(unknown_categories), 'categories that could not be parsed were written to: puzzlefails')
+if __name__ == "__main__":
+    args = parse_arguments()
 
+    urls = [args.url % i for i in range(args.pages[0], args.pages[1] + 1)]
+    checkpoint = Checkpoint(args.checkpoint or args.output.with_name(args.output.name + '.checkpoint'))
+    cache_dir = None if args.no_cache else CACHE_DIR
+    pages = asyncio.run(scrape(urls, args.connections, args.retries, checkpoint, args.since, cache_dir))
+    results, unknown_categories = sort_by_category(pages)
+
+    write_puzzle_file(args.output, results)
+
+    if unknown_categories:
+        for category, puzzles in unknown_categories.items():
+            print('Unknown category:', category, '('+ str(len(puzzles))+ ' occurrences)')
+        write_puzzle_file(args.fails, unknown_categories)
 
+    successful_puzzles = sum([len(puzzles) for puzzles in results.values()])
+    failed_puzzles = sum([len(puzzles) for puzzles in unknown_categories.values()])
+    print(successful_puzzles, 'puzzles successfully parsed and written to:', args.output)
+    print(failed_puzzles, 'puzzles in', len(unknown_categories), 'categories that could not be parsed were written to:', args.fails)
@@ -0,0 +1,61 @@
+import importlib.util
+import pathlib
+import random
+import sys
+
+import pytest
+
+# The root of the repository. The scripts refer to their assets relative to it.
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+
+def load_script(name: str, file_name: str):
+    # The hack script is no importable module (due to the dash in its name),
+    # therefore the scripts are loaded directly from their files. They are
+    # registered as modules, so that their functions can be pickled for
+    # process pools.
+    spec = importlib.util.spec_from_file_location(name, REPO_DIR / 'src' / file_name)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def hack_game_module():
+    return load_script('hack_game', 'hack-game.py')
+
+
+@pytest.fixture
+def hack_game(hack_game_module, monkeypatch):
+    """
+    The hack script with the family preset, quiet logging, no on-disk cache
+    of converted images and the repository as working directory.
+    """
+    monkeypatch.chdir(REPO_DIR)
+    monkeypatch.setattr(hack_game_module, 'preset', hack_game_module.PRESETS['family'])
+    monkeypatch.setattr(hack_game_module, 'tbl', hack_game_module.tbl_codec(hack_game_module.TBL_FILE), raising=False)
+    monkeypatch.setattr(hack_game_module, 'log_level', hack_game_module.LOG_ERROR)
+    monkeypatch.setattr(hack_game_module, 'tracer', None)
+    monkeypatch.setattr(hack_game_module, 'chr_cache_dir', None)
+    return hack_game_module
+
+
+@pytest.fixture
+def rom(hack_game):
+    """
+    A ROM of random bytes covering all address ranges of the family preset.
+    """
+    preset = hack_game.PRESETS['family']
+    highest_addr = max(value.stop for value in vars(preset).values() if isinstance(value, range))
+    return random.Random(0).randbytes(16 + (1 << (highest_addr - 16).bit_length()))
+
+
+@pytest.fixture
+def scrape(monkeypatch):
+    """
+    The scrape script without any delay before retries.
+    """
+    module = sys.modules.get('scrape') or load_script('scrape', 'scrape.py')
+    monkeypatch.setattr(module, 'RETRY_BACKOFF', 0)
+    return module
@@ -0,0 +1,84 @@
+import json
+import shutil
+
+import pytest
+
+from conftest import REPO_DIR
+
+
+@pytest.fixture
+def players_file(tmp_path):
+    path = tmp_path / 'players'
+    shutil.copy(REPO_DIR / 'okto_patches-en' / 'players', path)
+    return path
+
+
+def build_args(hack_game, tmp_path, players_file, *options: str):
+    argv = [str(tmp_path / 'rom.nes'), str(tmp_path / 'out.nes'), '--preset', 'family',
+            '--puzzles', 'okto_patches-en/puzzlelist-octonauts', '--players', str(players_file), *options]
+    return hack_game.parse_arguments(argv)
+
+
+def recorded_manifest(tmp_path) -> dict:
+    return json.loads((tmp_path / 'out.nes.stages.json').read_text())
+
+
+@pytest.mark.parametrize('seed_options', [[], ['--seed', '7']], ids=['random_seed', 'given_seed'])
+def test_reused_stages_give_the_same_rom_as_a_full_build(hack_game, rom, tmp_path, players_file, seed_options):
+    hack_game.build_changes(rom, build_args(hack_game, tmp_path, players_file, '--incremental', *seed_options))
+
+    # Only the players stage has to be run again
+    with open(players_file, 'a') as f:
+        f.write('Tweak\n')
+    hack_game.file_digest.cache_clear()
+    incremental = hack_game.build_changes(rom, build_args(hack_game, tmp_path, players_file, '--incremental', *seed_options))
+    manifest = recorded_manifest(tmp_path)
+
+    full = hack_game.build_changes(rom, build_args(hack_game, tmp_path, players_file, '--seed', str(manifest['seed'])))
+    assert incremental == full
+    for stage_name, stage in manifest['stages'].items():
+        if stage_name in hack_game.RANDOM_STAGES:
+            assert stage['seed'] == hack_game.derive_stage_seed(manifest['seed'], stage_name)
+        else:
+            assert stage['seed'] is None
+
+
+def test_only_the_random_stages_are_run_again_with_another_seed(hack_game, rom, tmp_path, players_file, capsys):
+    hack_game.build_changes(rom, build_args(hack_game, tmp_path, players_file, '--incremental', '--no-harm', '--seed', '7'))
+    capsys.readouterr()
+    incremental = hack_game.build_changes(rom, build_args(hack_game, tmp_path, players_file, '--incremental', '--no-harm', '--seed', '8', '--stats'))
+    stats = capsys.readouterr().out
+
+    full = hack_game.build_changes(rom, build_args(hack_game, tmp_path, players_file, '--no-harm', '--seed', '8'))
+    assert incremental == full
+    assert recorded_manifest(tmp_path)['seed'] == 8
+    assert [line.split()[:2] for line in stats.splitlines() if line.startswith(('puzzles ', 'players ', 'no_harm '))] == [
+        ['puzzles', 'run'], ['players', 'run'], ['no_harm', 'skipped']]
+
+
+def test_reused_puzzle_stage_keeps_its_statistics(hack_game, rom, tmp_path, players_file, capsys):
+    hack_game.build_changes(rom, build_args(hack_game, tmp_path, players_file, '--incremental', '--seed', '7', '--stats'))
+    full_stats = capsys.readouterr().out
+
+    with open(players_file, 'a') as f:
+        f.write('Tweak\n')
+    hack_game.file_digest.cache_clear()
+    hack_game.build_changes(rom, build_args(hack_game, tmp_path, players_file, '--incremental', '--seed', '7', '--stats'))
+    incremental_stats = capsys.readouterr().out
+
+    assert 'puzzles        skipped' in incremental_stats
+    puzzle_line = [line for line in full_stats.splitlines() if 'repeated puzzles' in line]
+    assert puzzle_line and puzzle_line == [line for line in incremental_stats.splitlines() if 'repeated puzzles' in line]
+
+
+def test_build_can_overwrite_its_input_rom(hack_game, rom, tmp_path, players_file):
+    rom_file = tmp_path / 'rom.nes'
+    rom_file.write_bytes(rom)
+    hack_game.build(build_args(hack_game, tmp_path, players_file, '--seed', '3'))
+
+    argv = [str(rom_file), str(rom_file), '--preset', 'family', '--puzzles', 'okto_patches-en/puzzlelist-octonauts',
+            '--players', str(players_file), '--seed', '3', '-f']
+    hack_game.build(hack_game.parse_arguments(argv))
+
+    assert rom_file.read_bytes() == (tmp_path / 'out.nes').read_bytes()
+    assert not list(tmp_path.glob('*.tmp'))
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+from PIL import Image
+
+from conftest import REPO_DIR
+
+IMAGES = sorted((REPO_DIR / 'images' / 'patches').glob('*.png'))
+
+
+@pytest.mark.parametrize('image_path', IMAGES, ids=[image.name for image in IMAGES])
+def test_image_to_nes_numpy_matches_python(hack_game, image_path):
+    if hack_game.np is None:
+        pytest.skip('numpy is not installed')
+    with Image.open(image_path) as im:
+        im = im.convert('P')
+
+    assert hack_game._image_to_nes_numpy(im) == hack_game._image_to_nes_python(im)
+
+
+def test_converted_image_is_taken_from_the_chr_cache(hack_game, tmp_path, monkeypatch):
+    monkeypatch.setattr(hack_game, 'chr_cache_dir', tmp_path / 'chr')
+    image = hack_game.convert_image(IMAGES[0])
+    assert len(list((tmp_path / 'chr').glob('*.chr'))) == 1
+
+    def fail(image_path):
+        raise AssertionError(f'{image_path} converted again')
+    monkeypatch.setattr(hack_game, 'image_to_nes', fail)
+
+    assert hack_game.convert_image(IMAGES[0]) == image
+
+
+def test_damaged_chr_cache_entry_is_converted_again(hack_game, tmp_path, monkeypatch):
+    monkeypatch.setattr(hack_game, 'chr_cache_dir', tmp_path / 'chr')
+    image = hack_game.convert_image(IMAGES[0])
+    (cache_file,) = (tmp_path / 'chr').glob('*.chr')
+    cache_file.write_bytes(cache_file.read_bytes()[:-1])
+
+    assert hack_game.convert_image(IMAGES[0]) == image
+    assert hack_game._read_chr_cache_file(cache_file) == image
+
+
+def test_chr_cache_evicts_the_least_recently_used_entries(hack_game, tmp_path):
+    for i, name in enumerate(['old', 'used', 'new']):
+        entry = tmp_path / f'{name}.chr'
+        entry.write_bytes(bytes(100))
+        os.utime(entry, (i, i))
+    os.utime(tmp_path / 'used.chr', (10, 10))
+
+    hack_game._evict_chr_cache(tmp_path, 250)
+
+    assert sorted(entry.name for entry in tmp_path.glob('*.chr')) == ['new.chr', 'used.chr']
@@ -0,0 +1,96 @@
+import random
+
+
+def old_auto_wrap(line: str) -> str:
+    # The greedy 'auto_wrap' before 'layout_puzzle' (for the line lengths 11, 13, 13, 11)
+    def chars(words):
+        return len(' '.join(words))
+
+    LINE_LENGTHS = [11, 13, 13, 11]
+
+    words = line.split()
+    if chars(words) <= 13:
+        return ' '.join(words)
+
+    words = line.split()
+    line2 = ''
+    line1 = ''
+    for word in reversed(words):
+        new_line = (word + ' ' + line2).strip()
+        if len(new_line) <= 13:
+            line2 = new_line
+            del words[-1]
+            continue
+        line1 = ' '.join(words)
+        break
+
+    if len(line1) <= 13:
+        return line1 + '\n' + line2
+
+    words = line1.split()
+    line3 = line2
+    line2 = ''
+    line1 = ''
+    for word in reversed(words):
+        new_line = (word + ' ' + line2).strip()
+        if len(new_line) <= 13:
+            line2 = new_line
+            del words[-1]
+            continue
+        line1 = ' '.join(words)
+
+    if len(line1) <= 11:
+        return line1 + '\n' + line2 + '\n' + line3
+
+    words = line.split()
+    lines = ['           ',
+             '             ',
+             '             ',
+             '           ']
+    for i in reversed(range(4)):
+        for word in reversed(words):
+            new_line = (word + ' ' + lines[i]).strip()
+            if len(new_line) <= LINE_LENGTHS[i]:
+                lines[i] = new_line
+                del words[-1]
+                continue
+            break
+
+    if words == []:
+        return '\n'.join(lines)
+
+    raise ValueError('Line cannot be split automatically: ' + line)
+
+
+def random_line(rng: random.Random) -> str:
+    return ' '.join(''.join(rng.choice('ABCDE') for _ in range(rng.randint(1, 13))) for _ in range(rng.randint(1, 7)))
+
+
+def test_layout_puzzle_matches_the_old_greedy_layout(hack_game):
+    rng = random.Random(1)
+    layouts = 0
+    blank_first_rows = 0
+    for _ in range(20000):
+        line = random_line(rng)
+        try:
+            expected = old_auto_wrap(line)
+        except ValueError:
+            continue
+        # The old 3-line split could mix up the words, these layouts are no reference
+        if expected.split() != line.split():
+            continue
+
+        layout, length = hack_game.layout_puzzle(line, (11, 13, 13, 11))
+        assert layout == expected
+        assert length == len(expected.replace('\n', ''))
+        layouts += 1
+        blank_first_rows += layout.startswith(' ')
+
+    assert layouts > 10000
+    assert blank_first_rows > 100
+
+
+def test_layout_puzzle_puts_a_long_first_line_into_the_second_row(hack_game):
+    layout, length = hack_game.layout_puzzle('INTERNATIONAL SPACE STATION IN ORBIT', (11, 13, 13, 11))
+    assert layout == '           \nINTERNATIONAL\nSPACE STATION\nIN ORBIT'
+    assert length == 11 + 13 + 13 + 8
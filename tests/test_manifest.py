@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+
+def write_manifest(tmp_path, defaults: str = '', variants: list[str] = ('outfile = "out.nes"',)):
+    manifest_file = tmp_path / 'builds.toml'
+    manifest_file.write_text(f'romfile = "{tmp_path / "rom.nes"}"\n\n[defaults]\n{defaults}\n'
+                             + ''.join(f'\n[[variant]]\n{variant}\n' for variant in variants))
+    return manifest_file
+
+
+def test_read_manifest_maps_the_options(hack_game, tmp_path):
+    manifest_file = write_manifest(tmp_path, 'no-harm = true\ntimers = 99\nloglevel = "DEBUG"\nlog-format = "json"\nno-cache = true',
+                                   ['outfile = "a.nes"\npuzzle-quota = ["ANIMAL=:5", "PLACE=2:"]\ntrace = "a.json"\nprofile = true',
+                                    'outfile = "b.nes"\nno-harm = false\nlog-format = "text"'])
+
+    romfile, (a, b) = hack_game.read_manifest(manifest_file, {'seed': 3, 'log-format': 'json'})
+
+    assert romfile == tmp_path / 'rom.nes'
+    assert (a.no_harm, a.timers, a.loglevel, a.log_format, a.no_cache, a.seed) == (True, 99, 'DEBUG', 'json', True, 3)
+    assert a.puzzle_quota == [('ANIMAL', None, 5), ('PLACE', 2, None)]
+    assert (str(a.trace), a.profile) == ('a.json', True)
+    assert (b.no_harm, b.log_format, b.trace, b.profile) == (False, 'text', None, False)
+
+
+@pytest.mark.parametrize('option, message', [
+    ('unknown-option = 1', 'Unknown option “unknown-option”'),
+    ('jobs = 2',           'Unknown option “jobs”'),
+    ('timers = [1, 2]',    'must be a string or a number'),
+    ('timers = true',      'must be a string or a number'),
+    ('no-harm = "yes"',    'must be true or false'),
+], ids=['unknown', 'command_line_only', 'list', 'bool', 'flag'])
+def test_read_manifest_rejects_invalid_options(hack_game, tmp_path, option, message):
+    manifest_file = write_manifest(tmp_path, option)
+
+    with pytest.raises(ValueError, match=message):
+        hack_game.read_manifest(manifest_file)
+
+
+def test_manifest_defaults_only_takes_the_given_options(hack_game):
+    args = hack_game.parse_arguments(['--manifest', 'builds.toml', '--seed', '5', '--log-format', 'json', '--no-harm'])
+
+    assert hack_game.manifest_defaults(args) == {'seed': 5, 'log-format': 'json'}
+
+
+def test_build_manifest_applies_the_trace_of_a_variant(hack_game, rom, tmp_path):
+    (tmp_path / 'rom.nes').write_bytes(rom)
+    manifest_file = write_manifest(tmp_path, 'preset = "family"\nno-harm = true',
+                                   [f'outfile = "{tmp_path / "a.nes"}"\ntrace = "{tmp_path / "a.json"}"',
+                                    f'outfile = "{tmp_path / "b.nes"}"'])
+
+    hack_game.build_manifest(manifest_file, force=True)
+
+    trace = json.loads((tmp_path / 'a.json').read_text())
+    assert {event['name'] for event in trace['traceEvents']} >= {str(tmp_path / 'a.nes'), 'no_harm'}
+    assert hack_game.tracer is None
+    assert (tmp_path / 'a.nes').read_bytes() == (tmp_path / 'b.nes').read_bytes()
+
+
+def test_parallel_build_gives_the_same_roms_as_a_sequential_one(hack_game, rom, tmp_path):
+    (tmp_path / 'rom.nes').write_bytes(rom)
+    for name, jobs in [('sequential', 1), ('parallel', 2)]:
+        manifest_file = write_manifest(tmp_path, 'preset = "family"\nno-harm = true\nseed = 7', [
+            f'outfile = "{tmp_path / name}-a.nes"\npuzzles = "okto_patches-en/puzzlelist-octonauts"\ntrace = "{tmp_path / name}-a.json"',
+            f'outfile = "{tmp_path / name}-b.nes"\npuzzles = "okto_patches-de/puzzlelist-octonauts"\nloglevel = "DEBUG"',
+        ])
+        hack_game.build_manifest(manifest_file, force=True, jobs=jobs)
+
+    for variant in ['a', 'b']:
+        assert (tmp_path / f'parallel-{variant}.nes').read_bytes() == (tmp_path / f'sequential-{variant}.nes').read_bytes()
+    trace = json.loads((tmp_path / 'parallel-a.json').read_text())
+    assert {event['name'] for event in trace['traceEvents']} >= {str(tmp_path / 'parallel-a.nes'), 'no_harm'}
@@ -0,0 +1,85 @@
+import pytest
+
+
+def build_args(hack_game, tmp_path, output_format: str):
+    argv = [str(tmp_path / 'rom.nes'), str(tmp_path / f'out.{output_format}'), '--preset', 'family', '--format', output_format,
+            '--puzzles', 'okto_patches-en/puzzlelist-octonauts', '--players', 'okto_patches-en/players',
+            '--marquee', 'okto_patches-en/marquee_text', '--no-harm', '--timers', '99', '--seed', '3']
+    return hack_game.parse_arguments(argv)
+
+
+@pytest.mark.parametrize('output_format', ['ips', 'bps'])
+def test_applied_patch_gives_the_built_rom(hack_game, rom, tmp_path, output_format):
+    (tmp_path / 'rom.nes').write_bytes(rom)
+    hack_game.build(build_args(hack_game, tmp_path, 'nes'))
+    hack_game.build(build_args(hack_game, tmp_path, output_format))
+
+    hack_game.apply_patch_file(tmp_path / f'out.{output_format}', tmp_path / 'rom.nes', tmp_path / 'applied.nes')
+
+    built_rom = (tmp_path / 'out.nes').read_bytes()
+    assert built_rom != rom
+    assert (tmp_path / 'applied.nes').read_bytes() == built_rom
+
+
+def test_bps_patch_rejects_another_rom(hack_game):
+    rom = bytes(range(256)) * 4
+    new_rom = bytearray(rom)
+    new_rom[100:110] = b'\xff' * 10
+    patch = hack_game.make_bps_patch(rom, new_rom)
+
+    assert hack_game.apply_bps_patch(patch, rom) == new_rom
+    with pytest.raises(ValueError, match='does not belong to this ROM'):
+        hack_game.apply_bps_patch(patch, rom[::-1])
+
+
+def test_ips_patch_stores_repeated_bytes_as_rle(hack_game):
+    rom = bytes(0x20000)
+    new_rom = bytearray(rom)
+    new_rom[0x100:0x200] = b'\xfa' * 0x100
+    new_rom[0x1fff0:0x20000] = bytes(range(1, 17))
+
+    patch = hack_game.make_ips_patch(rom, new_rom)
+
+    assert len(patch) < 0x100
+    assert hack_game.apply_ips_patch(patch, rom) == new_rom
+
+
+def test_patch_plan_coalesces_overlapping_and_adjacent_patches(hack_game):
+    plan = hack_game.PatchPlan()
+    plan.write(10, b'abcd')
+    plan.write(0, b'xy')
+    plan.write(12, b'ZZZZ')  # overlaps the first patch and wins
+    plan.write(16, b'!')     # adjacent to the previous patch
+    plan.write(30, b'')      # empty patches are dropped
+
+    assert plan.runs() == [(0, b'xy'), (10, b'abZZZZ!')]
+    assert [patch.stage for patch in plan.patches] == [None] * 4
+
+
+def test_patch_plan_dirty_runs_only_contain_changes(hack_game):
+    rom = bytes(range(32))
+    plan = hack_game.PatchPlan()
+    plan.write(2, bytes([2, 3]))        # the bytes already in the ROM
+    plan.write(8, bytes([8, 0xff]))
+    plan.write_byte(20, 0xee)
+
+    assert plan.dirty_runs(rom) == [(8, bytes([8, 0xff])), (20, b'\xee')]
+
+    plan.write(31, b'ab')
+    with pytest.raises(IndexError, match='exceeds the ROM'):
+        plan.dirty_runs(rom)
+
+
+@pytest.mark.parametrize('byteorder', ['little', 'big'])
+def test_puzzle_pointer_table_points_to_each_puzzle(hack_game, byteorder):
+    puzzles = [b'abc', b'de', b'fghij', b'k']
+
+    table = hack_game.build_puzzle_pointer_table(puzzles, 0x8010, byteorder)
+
+    pointers = [int.from_bytes(table[i:i + 2], byteorder) for i in range(0, len(table), 2)]
+    assert pointers == [0x8010, 0x8013, 0x8015, 0x801a]
+
+
+def test_puzzle_pointer_table_rejects_pointers_beyond_two_bytes(hack_game):
+    with pytest.raises(OverflowError):
+        hack_game.build_puzzle_pointer_table([b'x' * 0x100, b'y'], 0xff80, 'little')
@@ -0,0 +1,50 @@
+import pytest
+
+PUZZLE_FILE = 'okto_patches-en/puzzlelist-octonauts'
+
+
+@pytest.fixture
+def corpus_file(hack_game, tmp_path):
+    path = tmp_path / 'corpus.owpz'
+    hack_game.compile_puzzles(hack_game.read_puzzles(PUZZLE_FILE), path)
+    return path
+
+
+def record_instances(init, instances: list):
+    def recording_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        instances.append(self)
+    return recording_init
+
+
+def test_puzzle_corpus_keeps_its_puzzles_after_closing(hack_game, corpus_file):
+    with hack_game.PuzzleCorpus(corpus_file) as corpus:
+        family_puzzles = corpus.family_puzzles()
+        classic_puzzles = corpus.classic_puzzles()
+
+    assert corpus._map.closed
+    puzzles = [puzzle for category in hack_game.read_puzzles(PUZZLE_FILE) for puzzle in hack_game.sanitize_puzzles(category.puzzles)]
+    assert family_puzzles == [hack_game.encode_family_puzzle(puzzle) for puzzle in puzzles]
+    assert classic_puzzles == [hack_game.encode_classic_puzzle(puzzle) for puzzle in puzzles]
+
+
+def test_puzzles_stage_closes_the_corpus(hack_game, corpus_file, monkeypatch):
+    corpora = []
+    monkeypatch.setattr(hack_game.PuzzleCorpus, '__init__', record_instances(hack_game.PuzzleCorpus.__init__, corpora))
+    args = hack_game.parse_arguments(['rom.nes', 'out.nes', '--puzzles', str(corpus_file), '--seed', '1'])
+
+    hack_game.build_patch_plan(args)
+
+    assert len(corpora) == 1 and corpora[0]._map.closed
+
+
+
+@pytest.mark.parametrize('options', [[], ['--optimize-puzzles']], ids=['shuffled', 'optimized'])
+def test_corpus_build_gives_the_same_rom_as_a_text_build(hack_game, rom, corpus_file, options):
+    def build_changes(puzzles):
+        return hack_game.build_changes(rom, hack_game.parse_arguments(['rom.nes', 'out.nes', '--puzzles', str(puzzles), '--seed', '5', *options]))
+
+    corpus_changes = build_changes(corpus_file)
+
+    assert corpus_changes
+    assert corpus_changes == build_changes(PUZZLE_FILE)
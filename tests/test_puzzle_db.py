@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+
+@pytest.fixture
+def db_file(hack_game, tmp_path):
+    animals = tmp_path / 'animals'
+    animals.write_text('[Animal]\nshark\nwhale shark\nhumpback whale\nthe giant pacific octopus of the deep blue sea\n\n[Place]\narctic\n')
+    places = tmp_path / 'places'
+    places.write_text('[Place]\ngreat barrier reef\narctic\nmariana trench\n')
+
+    path = tmp_path / 'corpus.db'
+    hack_game.import_puzzle_files(path, [animals], ['octonauts'])
+    hack_game.import_puzzle_files(path, [places], ['geography'])
+    return path
+
+
+def select(hack_game, db_file, query: str, rng: random.Random = None) -> dict[str, list[str]]:
+    return {category.category_name: [puzzle.puzzle for puzzle in category.puzzles]
+            for category in hack_game.read_puzzles(f'{db_file}?{query}' if query else db_file, rng=rng)}
+
+
+def laid_out(hack_game, *puzzles: str) -> list[str]:
+    return [hack_game.auto_wrap(puzzle) for puzzle in puzzles]
+
+
+def test_puzzle_db_stores_the_layout_of_each_puzzle(hack_game, db_file):
+    assert select(hack_game, db_file, '') == {
+        'ANIMAL': laid_out(hack_game, 'SHARK', 'WHALE SHARK', 'HUMPBACK WHALE'),
+        'PLACE':  laid_out(hack_game, 'ARCTIC', 'GREAT BARRIER REEF', 'MARIANA TRENCH'),
+    }
+
+
+def test_puzzle_db_selects_by_category_and_tag(hack_game, db_file):
+    assert select(hack_game, db_file, 'category=place,animal&tag=geography') == {
+        'PLACE':  laid_out(hack_game, 'ARCTIC', 'GREAT BARRIER REEF', 'MARIANA TRENCH'),
+        'ANIMAL': [],
+    }
+    assert select(hack_game, db_file, 'category=place&tag=octonauts') == {'PLACE': ['ARCTIC']}
+
+
+def test_puzzle_db_selects_by_length_and_limit(hack_game, db_file):
+    assert select(hack_game, db_file, 'max_length=7') == {'ANIMAL': ['SHARK'], 'PLACE': ['ARCTIC']}
+
+    limited = select(hack_game, db_file, 'category=ANIMAL&limit=2', random.Random(1))
+    assert len(limited['ANIMAL']) == 2
+    assert set(limited['ANIMAL']) < set(laid_out(hack_game, 'SHARK', 'WHALE SHARK', 'HUMPBACK WHALE'))
+    assert limited == select(hack_game, db_file, 'category=ANIMAL&limit=2', random.Random(1))
+
+
+def test_puzzle_db_rejects_unknown_query_keys(hack_game, db_file):
+    with pytest.raises(ValueError, match='Unknown puzzle query parameters: size'):
+        select(hack_game, db_file, 'size=3')
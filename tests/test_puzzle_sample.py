@@ -0,0 +1,70 @@
+import random
+import string
+
+import pytest
+
+CATEGORY_SIZES = {'ANIMAL': 2000, 'PLACE': 1000, 'THING': 10}
+
+
+def puzzle_text(i: int) -> str:
+    letters = ''
+    for _ in range(3):
+        i, letter = divmod(i, 26)
+        letters += string.ascii_uppercase[letter]
+    return 'PUZZLE ' + letters
+
+
+@pytest.fixture
+def puzzle_file(tmp_path):
+    path = tmp_path / 'puzzles'
+    lines = []
+    first = 0
+    for category, size in CATEGORY_SIZES.items():
+        lines.append(f'[{category}]')
+        lines.extend(puzzle_text(i) for i in range(first, first + size))
+        first += size
+    path.write_text('\n'.join(lines) + '\n')
+    return path
+
+
+def test_sample_takes_a_uniform_share_of_each_category(hack_game, puzzle_file):
+    sample = hack_game.sample_puzzle_file(puzzle_file, random.Random(1))
+
+    capacity = hack_game.preset.no_of_puzzles * hack_game.PUZZLE_SAMPLE_FACTOR
+    counts = {name: len(puzzle_range) for name, puzzle_range in sample.categories}
+    assert sum(counts.values()) == capacity
+    total = sum(CATEGORY_SIZES.values())
+    for name, size in CATEGORY_SIZES.items():
+        expected = size * capacity / total
+        assert abs(counts[name] - expected) <= max(3, expected * 0.1)
+
+
+def test_sample_only_contains_distinct_puzzles_of_the_file(hack_game, puzzle_file):
+    sample = hack_game.sample_puzzle_file(puzzle_file, random.Random(2))
+
+    puzzles = [puzzle for category in hack_game.read_puzzle_file(puzzle_file) for puzzle in hack_game.sanitize_puzzles(category.puzzles)]
+    family_puzzles = {hack_game.encode_family_puzzle(puzzle) for puzzle in puzzles}
+    classic_puzzles = {hack_game.encode_classic_puzzle(puzzle) for puzzle in puzzles}
+    assert len(set(sample.family_puzzles())) == len(sample.family_puzzles())
+    assert set(sample.family_puzzles()) <= family_puzzles
+    assert set(sample.classic_puzzles()) <= classic_puzzles
+
+
+def test_sample_of_a_small_file_contains_all_puzzles(hack_game):
+    sample = hack_game.sample_puzzle_file('okto_patches-en/puzzlelist-octonauts', random.Random(3))
+
+    puzzles = hack_game.read_puzzle_file('okto_patches-en/puzzlelist-octonauts')
+    assert [name for name, _ in sample.categories] == [category.category_name for category in puzzles]
+    for (_, puzzle_range), category in zip(sample.categories, puzzles):
+        expected = [hack_game.encode_family_puzzle(puzzle) for puzzle in hack_game.sanitize_puzzles(category.puzzles)]
+        assert sorted(sample.family_puzzles(puzzle_range)) == sorted(expected)
+
+
+def test_classic_sample_fills_the_reservoir_of_each_category(hack_game, puzzle_file, monkeypatch):
+    monkeypatch.setattr(hack_game, 'preset', hack_game.PRESETS['classic_prg0'])
+
+    sample = hack_game.sample_puzzle_file(puzzle_file, random.Random(4))
+
+    capacities = [len(bounds) * hack_game.PUZZLE_SAMPLE_FACTOR for bounds in hack_game.preset.puzzle_category_ranges]
+    assert [(name, len(puzzle_range)) for name, puzzle_range in sample.categories] == [
+        (name, min(size, capacity)) for (name, size), capacity in zip(CATEGORY_SIZES.items(), capacities)]
@@ -0,0 +1,118 @@
+import collections
+import random
+
+import pytest
+
+
+def family_categories(sizes: list[int], rng: random.Random) -> list[list[bytes]]:
+    # Like encoded family edition puzzles, the last byte is the category index
+    return [[bytes(rng.randint(3, 20)) + bytes([cat]) for _ in range(size)] for cat, size in enumerate(sizes)]
+
+
+def category_counts(puzzles: list[bytes]) -> collections.Counter:
+    return collections.Counter(puzzle[-1] for puzzle in puzzles)
+
+
+def test_optimize_puzzle_selection_honors_maximum_quotas_for_repeats(hack_game):
+    categories = family_categories([20, 20], random.Random(1))
+    quotas = hack_game.resolve_puzzle_quotas(['A', 'B'], categories, {'A': (None, 5)}, 1090)
+
+    puzzles, repeats = hack_game.optimize_puzzle_selection(categories, quotas, 1090, 0x10000, random.Random(2))
+
+    assert len(puzzles) == 1090
+    assert category_counts(puzzles) == {0: 5, 1: 1085}
+    assert repeats == 1090 - 25
+    assert len({id(puzzle) for puzzle in puzzles}) == 25
+
+
+def test_optimize_puzzle_selection_honors_minimum_quotas_and_budget(hack_game):
+    categories = family_categories([5000, 3000, 100], random.Random(3))
+    quotas = hack_game.resolve_puzzle_quotas(['A', 'B', 'C'], categories, {'C': (80, 90)}, 1090)
+    budget = 12000
+
+    puzzles, repeats = hack_game.optimize_puzzle_selection(categories, quotas, 1090, budget, random.Random(4))
+
+    counts = category_counts(puzzles)
+    assert len(puzzles) == 1090
+    assert repeats == 0
+    assert hack_game.sum_bytes(puzzles) <= budget
+    assert 80 <= counts[2] <= 90
+    assert counts[0] >= quotas[0][0] and counts[1] >= quotas[1][0]
+
+
+def test_resolve_puzzle_quotas_rejects_too_small_maximums(hack_game):
+    categories = family_categories([20, 20], random.Random(5))
+
+    with pytest.raises(ValueError, match='maximum puzzle quotas'):
+        hack_game.resolve_puzzle_quotas(['A', 'B'], categories, {'A': (None, 5), 'B': (None, 100)}, 1090)
+
+
+def old_reduce_to_bounds(encoded_puzzles: list[bytes], puzzle_count: int, addr_range: int) -> list[bytes]:
+    # The quadratic 'reduce_to_bounds' before it used a heap
+    reduced_puzzles   = encoded_puzzles[:puzzle_count]
+    remaining_puzzles = encoded_puzzles[puzzle_count:]
+
+    while sum(len(puzzle) for puzzle in reduced_puzzles) > addr_range:
+        if len(remaining_puzzles) == 0:
+            raise OverflowError()
+
+        longest_puzzle  = max(reduced_puzzles,   key = len)
+        shortest_puzzle = min(remaining_puzzles, key = len)
+        if len(shortest_puzzle) >= len(longest_puzzle):
+            # The old loop never ended in this case
+            raise OverflowError()
+        reduced_puzzles.remove(longest_puzzle)
+        reduced_puzzles.append(shortest_puzzle)
+
+    return reduced_puzzles
+
+
+def small_family_corpus(size: int, rng: random.Random) -> list[bytes]:
+    return [bytes(rng.randrange(0x41, 0x5b) for _ in range(rng.randint(8, 34))) for _ in range(size)]
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_reduce_to_bounds_matches_the_old_selection_on_small_corpora(hack_game, seed):
+    rng = random.Random(seed)
+    padded = hack_game.pad_puzzles(small_family_corpus(rng.randint(300, 600), rng), 1090)
+
+    results = []
+    for addr_range in [30000, 19203, 15000, 12000, 9000]:
+        try:
+            expected = old_reduce_to_bounds(list(padded), 1090, addr_range)
+        except OverflowError:
+            with pytest.raises(OverflowError):
+                hack_game.reduce_to_bounds(padded, 1090, addr_range)
+            results.append(None)
+            continue
+        assert hack_game.reduce_to_bounds(padded, 1090, addr_range) == expected
+        results.append(expected)
+
+    # The family edition puzzle area is reduced by repeating the shortest puzzle
+    assert results[1] is not None
+
+
+def test_reduce_to_bounds_fails_if_the_shortest_puzzle_is_not_shorter(hack_game):
+    puzzles = [bytes([length]) * length for length in [10, 8, 6, 4, 7]]
+    assert [len(puzzle) for puzzle in hack_game.reduce_to_bounds(puzzles, 4, 24)] == [6, 4, 7, 7]
+    with pytest.raises(OverflowError):
+        hack_game.reduce_to_bounds(puzzles, 4, 23)
+
+
+def test_optimize_puzzle_selection_repeats_the_shortest_puzzles(hack_game):
+    # Like encoded family edition puzzles, the last byte is the category index
+    categories = [[bytes(length) + bytes([cat]) for length in [first_length] + [20] * 9] for cat, first_length in enumerate([5, 6])]
+    quotas = hack_game.resolve_puzzle_quotas(['A', 'B'], categories, {'A': (None, 600)}, 1090)
+
+    puzzles, repeats = hack_game.optimize_puzzle_selection(categories, quotas, 1090, 7500, random.Random(6))
+
+    assert len(puzzles) == 1090
+    assert repeats == 1090 - 20
+    assert hack_game.sum_bytes(puzzles) <= 7500
+    # The shortest puzzle of A is repeated up to the maximum of A, then the one of B
+    assert collections.Counter(map(len, puzzles)) == {6: 600 - 9, 7: 1090 - 600 - 9, 21: 18}
+
+
+def test_choose_repeats_prefers_the_shortest_candidates(hack_game):
+    assert hack_game.choose_repeats([(5, 10), (3, 20), None], [10, 2, 5], 5) == [(20, 2), (10, 3)]
+    assert hack_game.choose_repeats([(5, 10), (3, 20), None], [1, 2, 5], 5) is None
@@ -0,0 +1,239 @@
+import asyncio
+import collections
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from conftest import REPO_DIR
+
+FIXTURE_DIR = REPO_DIR / 'tests' / 'fixtures'
+REQUESTS      = web.AppKey('requests', collections.Counter)
+NOT_MODIFIED  = web.AppKey('not_modified', collections.Counter)
+LAST_MODIFIED = 'Mon, 02 Jan 1984 12:00:00 GMT'
+
+PAGE_1 = [
+    ('A BIRD IN THE HAND',     'Phrase'),
+    ('MOUNT RUSHMORE',         'On the Map'),
+    ('THE SOUND OF MUSIC',     'Movie Title'),
+    ('PEANUT BUTTER & JELLY',  'Food & Drink'),
+    ('ALBERT EINSTEIN',        'Proper Name'),
+]
+PAGE_2 = [
+    ('GOLDEN GATE BRIDGE',     'Landmark'),
+    ('SHERLOCK HOLMES',        'Fictional Character'),
+    ('ROLLER COASTER',         'Thing'),
+    ('HAPPY BIRTHDAY',         'Weather Report'),
+]
+
+
+def fixture_app(failures: dict[str, int] = None, validator: str = None) -> web.Application:
+    """
+    Serve the fixture pages as “/<name>”. The first 'failures[name]' requests
+    of a page fail with “503 Service Unavailable”. The number of requests
+    per page is counted in 'app[REQUESTS]'.
+
+    With a 'validator' ('etag' or 'last_modified') the pages are sent with
+    that header and conditional requests matching it are answered with “304
+    Not Modified” (counted in 'app[NOT_MODIFIED]').
+    """
+    failures = failures or {}
+    requests = collections.Counter()
+    not_modified = collections.Counter()
+
+    async def page(request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        requests[name] += 1
+        if requests[name] <= failures.get(name, 0):
+            raise web.HTTPServiceUnavailable()
+        path = FIXTURE_DIR / (name + '.html')
+        if not path.exists():
+            raise web.HTTPNotFound()
+
+        headers = {}
+        if validator == 'etag':
+            headers['ETag'] = f'"{name}-v1"'
+            if request.headers.get('If-None-Match') == headers['ETag']:
+                not_modified[name] += 1
+                return web.Response(status=304, headers=headers)
+        elif validator == 'last_modified':
+            headers['Last-Modified'] = LAST_MODIFIED
+            if request.headers.get('If-Modified-Since') == LAST_MODIFIED:
+                not_modified[name] += 1
+                return web.Response(status=304, headers=headers)
+        return web.Response(text=path.read_text(), content_type='text/html', headers=headers)
+
+    app = web.Application()
+    app.router.add_get('/{name}', page)
+    app[REQUESTS] = requests
+    app[NOT_MODIFIED] = not_modified
+    return app
+
+
+def page_urls(server: TestServer, names: list[str]) -> list[str]:
+    return [str(server.make_url('/' + name)) for name in names]
+
+
+def serve(app: web.Application, client):
+    """
+    Run the coroutine function 'client' with a test server serving 'app'.
+    """
+    async def run():
+        async with TestServer(app) as server:
+            return await client(server)
+    return asyncio.run(run())
+
+
+async def scrape_pages(scrape, server: TestServer, names: list[str], checkpoint_path, retries: int = 2, **kwargs):
+    return await scrape.scrape(page_urls(server, names), 2, retries, scrape.Checkpoint(checkpoint_path), **kwargs)
+
+
+def run_scrape(scrape, app: web.Application, names: list[str], checkpoint_path, **kwargs):
+    return serve(app, lambda server: scrape_pages(scrape, server, names, checkpoint_path, **kwargs))
+
+
+def test_scrape_extracts_the_puzzles_of_all_pages(scrape, tmp_path):
+    app = fixture_app()
+
+    pages = run_scrape(scrape, app, ['compendium1', 'compendium2'], tmp_path / 'checkpoint')
+
+    assert pages == [PAGE_1, PAGE_2]
+    assert app[REQUESTS] == {'compendium1': 1, 'compendium2': 1}
+    results, unknown = scrape.sort_by_category(pages)
+    assert results[scrape.LANDMARK] == ['MOUNT RUSHMORE', 'GOLDEN GATE BRIDGE']
+    assert unknown == {'Weather Report': ['HAPPY BIRTHDAY']}
+
+
+def test_scrape_retries_server_errors(scrape, tmp_path):
+    app = fixture_app(failures={'compendium2': 2})
+
+    pages = run_scrape(scrape, app, ['compendium1', 'compendium2'], tmp_path / 'checkpoint', retries=2)
+
+    assert pages == [PAGE_1, PAGE_2]
+    assert app[REQUESTS] == {'compendium1': 1, 'compendium2': 3}
+
+
+def test_scrape_gives_up_after_the_last_retry(scrape, tmp_path):
+    app = fixture_app(failures={'compendium1': 10})
+
+    with pytest.raises(aiohttp.ClientResponseError) as excinfo:
+        run_scrape(scrape, app, ['compendium1'], tmp_path / 'checkpoint', retries=2)
+
+    assert excinfo.value.status == 503
+    assert app[REQUESTS] == {'compendium1': 3}
+
+
+def test_scrape_does_not_retry_client_errors(scrape, tmp_path):
+    app = fixture_app()
+
+    with pytest.raises(aiohttp.ClientResponseError) as excinfo:
+        run_scrape(scrape, app, ['missing'], tmp_path / 'checkpoint', retries=2)
+
+    assert excinfo.value.status == 404
+    assert app[REQUESTS] == {'missing': 1}
+
+
+def test_scrape_closes_the_checkpoint_of_a_failed_run(scrape, tmp_path):
+    app = fixture_app()
+    checkpoint = scrape.Checkpoint(tmp_path / 'checkpoint')
+
+    async def client(server):
+        return await scrape.scrape(page_urls(server, ['compendium1', 'missing']), 2, 0, checkpoint)
+    with pytest.raises(aiohttp.ClientResponseError):
+        serve(app, client)
+
+    assert checkpoint._file is None
+    assert not scrape.Checkpoint(tmp_path / 'checkpoint').complete
+
+
+@pytest.mark.parametrize('validator', ['etag', 'last_modified'])
+def test_scrape_revalidates_cached_pages(scrape, tmp_path, validator):
+    app = fixture_app(validator=validator)
+    cache_dir = tmp_path / 'cache'
+
+    async def client(server):
+        first  = await scrape_pages(scrape, server, ['compendium1', 'compendium2'], tmp_path / 'checkpoint', cache_dir=cache_dir)
+        second = await scrape_pages(scrape, server, ['compendium1', 'compendium2'], tmp_path / 'checkpoint', cache_dir=cache_dir)
+        return (first, second)
+    first, second = serve(app, client)
+
+    assert first == second == [PAGE_1, PAGE_2]
+    assert app[REQUESTS] == {'compendium1': 2, 'compendium2': 2}
+    assert app[NOT_MODIFIED] == {'compendium1': 1, 'compendium2': 1}
+
+
+def test_scrape_survives_failing_cache_writes(scrape, tmp_path):
+    app = fixture_app(validator='etag')
+    cache_dir = tmp_path / 'cache'
+    cache_dir.write_text('not a directory')
+
+    pages = run_scrape(scrape, app, ['compendium1', 'compendium2'], tmp_path / 'checkpoint', cache_dir=cache_dir)
+
+    assert pages == [PAGE_1, PAGE_2]
+
+
+def test_scrape_resumes_an_interrupted_run(scrape, tmp_path):
+    app = fixture_app()
+    checkpoint_path = tmp_path / 'checkpoint'
+    resumed_puzzles = [['RESUMED PUZZLE', 'Phrase']]
+
+    async def client(server):
+        # An interrupted run that only got the first page (and half a line of the second one)
+        with open(checkpoint_path, 'w') as f:
+            f.write(json.dumps({'url': page_urls(server, ['compendium1'])[0], 'hash': 'x', 'puzzles': resumed_puzzles}) + '\n')
+            f.write('{"url": "')
+        return await scrape_pages(scrape, server, ['compendium1', 'compendium2'], checkpoint_path)
+    pages = serve(app, client)
+
+    assert pages == [resumed_puzzles, PAGE_2]
+    assert app[REQUESTS] == {'compendium2': 1}
+    checkpoint = scrape.Checkpoint(checkpoint_path)
+    assert checkpoint.complete
+    assert len(checkpoint.pages) == 2
+
+
+def test_scrape_since_reuses_the_puzzles_of_unchanged_pages(scrape, tmp_path):
+    app = fixture_app()
+    checkpoint_path = tmp_path / 'checkpoint'
+
+    async def client(server):
+        await scrape_pages(scrape, server, ['compendium1', 'compendium2'], checkpoint_path)
+        # Replace the recorded puzzles to see whether they are reused
+        records = [json.loads(line) for line in checkpoint_path.read_text().splitlines()]
+        for record in records:
+            if 'puzzles' in record:
+                record['puzzles'] = [['RECORDED', 'Phrase']]
+        checkpoint_path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+        return await scrape_pages(scrape, server, ['compendium1', 'compendium2'], checkpoint_path, since=True)
+    pages = serve(app, client)
+
+    assert pages == [[['RECORDED', 'Phrase']]] * 2
+    assert app[REQUESTS] == {'compendium1': 2, 'compendium2': 2}
+
+
+def test_fetch_parses_the_page_while_it_is_downloaded(scrape, monkeypatch):
+    html = (FIXTURE_DIR / 'compendium1.html').read_text().replace('ALBERT EINSTEIN', 'ÉMILE ZOLA')
+
+    async def page(request: web.Request) -> web.StreamResponse:
+        # Send the page in pieces that split the multi-byte characters
+        response = web.StreamResponse(headers={'Content-Type': 'text/html; charset=utf-8'})
+        await response.prepare(request)
+        data = html.encode()
+        for i in range(0, len(data), 5):
+            await response.write(data[i:i + 5])
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get('/{name}', page)
+    monkeypatch.setattr(scrape, 'READ_CHUNK_SIZE', 5)
+
+    async def client(server):
+        async with aiohttp.ClientSession() as session:
+            return await scrape.fetch(session, page_urls(server, ['compendium1'])[0], 0, parse=True)
+    body, puzzles = serve(app, client)
+
+    assert body == html
+    assert puzzles == [*PAGE_1[:-1], ('ÉMILE ZOLA', 'Proper Name')]
@@ -0,0 +1,32 @@
+import pytest
+
+
+@pytest.fixture
+def codec(hack_game, tmp_path):
+    tbl_file = tmp_path / 'test.tbl'
+    tbl_file.write_text('41=A\n42=B\nD4= \nFF==\n# no mapping\n')
+    return hack_game.TblCodec(str(tbl_file), hack_game.read_tbl_file(str(tbl_file)))
+
+
+def test_tbl_codec_encodes_each_character_by_its_mapping(hack_game):
+    codec = hack_game.tbl_codec(hack_game.TBL_FILE)
+    text = ''.join(codec.mapping)
+
+    assert codec.encode(text) == bytes(codec.mapping[c] for c in text)
+
+
+def test_tbl_codec_maps_characters_to_any_byte(codec):
+    assert codec.mapping == {'A': 0x41, 'B': 0x42, ' ': 0xd4, '=': 0xff}
+    assert codec.encode('AB =BA') == b'\x41\x42\xd4\xff\x42\x41'
+
+
+def test_tbl_codec_lists_all_unmappable_characters(codec):
+    assert codec.unmappable_chars('ABCDC') == ['C', 'D']
+    with pytest.raises(ValueError, match='“C”, “D”'):
+        codec.encode('ABCDC')
+
+
+def test_tbl_encode_pads_to_the_area(hack_game, codec):
+    assert hack_game.tbl_encode('AB', 4, codec) == b'\x41\x42\x00\x00'
+    with pytest.raises(IndexError, match='too long'):
+        hack_game.tbl_encode('ABABA', 4, codec)